@@ -1,18 +1,25 @@
 from dcmaid.basebot import Bot
 from dcmaid.state import State
+from dcmaid.storage import config as storage_config, create_storage
 from discord import Intents
 
 from load_secrets import secret
-from load_db import db
+
+if storage_config['STORAGE_BACKEND'] == 'mongo':
+	# Connect only when Mongo is used
+	from load_db import db
+	storage = create_storage(db)
+else:
+	storage = create_storage()
 
 state = State()
 intent = Intents.default()
 intent.message_content = True
 # intent.member = True # Enable it to reduce API call
 if len(servers := secret['debug_server_id']) > 0:
-	bot = Bot(db, state, intents = intent, debug_guilds = servers)
+	bot = Bot(storage, state, intents = intent, debug_guilds = servers)
 else:
-	bot = Bot(db, state, intents = intent)
+	bot = Bot(storage, state, intents = intent)
 
 @bot.event
 async def on_ready():
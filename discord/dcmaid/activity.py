@@ -0,0 +1,158 @@
+'''
+This module records how active each channel is, so that the busiest channels
+can be warmed up right after the bot starts.
+The scores decay with time, and they are kept in a State namespace
+saved into the snapshot (if STATE_SNAPSHOT_PATH is set).
+The top ACTIVITY_PERSIST_TOP channels are also written to the storage now and then,
+so the warm-up works without the snapshot as well.
+'''
+from __future__ import annotations
+import asyncio
+import discord
+from heapq import nlargest
+from time import time
+from typing import Optional, TYPE_CHECKING
+from .utils import generate_config
+
+if TYPE_CHECKING:
+	from .basebot import Bot
+	from .state import Namespace, State
+	from .storage import DocumentRepository
+
+config = generate_config(
+	ACTIVITY_CAPACITY = {'default': 10000, 'cast': int},
+	ACTIVITY_HALF_LIFE = {'default': 7 * 86400, 'cast': float},
+	ACTIVITY_WARMUP_TOP = {'default': 100, 'cast': int},
+	ACTIVITY_WARMUP_CONCURRENCY = {'default': 2, 'cast': int},
+	ACTIVITY_WARMUP_DELAY = {'default': 5.0, 'cast': float},
+	ACTIVITY_COLLECTION = {'default': 'channel-activity'},
+	# 0 to keep the activities in the snapshot only
+	ACTIVITY_PERSIST_TOP = {'default': 1000, 'cast': int},
+	ACTIVITY_PERSIST_INTERVAL = {'default': 3600, 'cast': float},
+)
+
+class ChannelActivity:
+	__slots__ = ('guild_id', 'score', 'updated_at')
+
+	def __init__(self, guild_id: int, score: float = 0, updated_at: float = 0):
+		self.guild_id = guild_id
+		self.score = score
+		self.updated_at = updated_at
+
+	def score_at(self, now: float, half_life: float) -> float:
+		return self.score * 0.5 ** ((now - self.updated_at) / half_life)
+
+class ActivityTracker:
+	def __init__(self, state: State, repo: Optional[DocumentRepository] = None, capacity: Optional[int] = None, half_life: Optional[float] = None):
+		self.half_life: float = config['ACTIVITY_HALF_LIFE'] if half_life is None else half_life
+		self._repo = repo
+		# The channels having a document, to delete those falling out of the top
+		self._persisted: set[int] = set()
+		# The least recently active channels are forgotten first
+		self._d: Namespace[int, ChannelActivity] = state.namespace(
+			'channel_activity',
+			capacity = config['ACTIVITY_CAPACITY'] if capacity is None else capacity
+		)
+		state.register_codec('channel_activity', self._dump, self._load)
+
+	@staticmethod
+	def _dump(activity: ChannelActivity):
+		# Rounded, since the snapshot does not need the precision
+		return [activity.guild_id, round(activity.score, 3), int(activity.updated_at)]
+
+	@staticmethod
+	def _load(channel_id: int, raw) -> ChannelActivity:
+		return ChannelActivity(*raw)
+
+	def record(self, channel: discord.abc.GuildChannel | discord.Thread):
+		# Threads count for their parent channels, which own the maids and the weights
+		channel_id = channel.parent_id if isinstance(channel, discord.Thread) else channel.id
+		now = time()
+		activity = self._d.get(channel_id)
+		if activity is None:
+			activity = ChannelActivity(channel.guild.id)
+		activity.score = activity.score_at(now, self.half_life) + 1
+		activity.updated_at = now
+		self._d.set(channel_id, activity)
+
+	def top(self, n: int, guild_id: Optional[int] = None) -> list[int]:
+		# The ids of the n most active channels (in the guild)
+		now = time()
+		# Restored entries are kept raw until used, so touch them all first
+		for channel_id in self._d.restored_keys():
+			self._d.get(channel_id)
+		candidates = (
+			(activity.score_at(now, self.half_life), channel_id)
+			for channel_id, activity in self._d.items()
+			if guild_id is None or activity.guild_id == guild_id
+		)
+		return [channel_id for _, channel_id in nlargest(n, candidates)]
+
+	def load_sync(self):
+		# Called once at startup; the snapshot is newer, so its channels are kept
+		if self._repo is None:
+			return
+		for document in self._repo.all_sync():
+			channel_id = document['channel']
+			self._persisted.add(channel_id)
+			if channel_id not in self._d:
+				self._d.set(channel_id, ChannelActivity(document['guild'], document['score'], document['updated_at']))
+
+	async def persist(self, n: Optional[int] = None):
+		# Write the n most active channels, and forget the others in the storage
+		if self._repo is None:
+			return
+		top = self.top(config['ACTIVITY_PERSIST_TOP'] if n is None else n)
+		batch: dict[int, Optional[dict]] = {}
+		for channel_id in top:
+			activity = self._d.get(channel_id)
+			if activity is not None:
+				guild_id, score, updated_at = self._dump(activity)
+				batch[channel_id] = {'guild': guild_id, 'score': score, 'updated_at': updated_at}
+		for channel_id in self._persisted - batch.keys():
+			batch[channel_id] = None
+		if len(batch) == 0:
+			return
+		await self._repo.write_many(batch)
+		self._persisted = {channel_id for channel_id, document in batch.items() if document is not None}
+
+async def warm_up(bot: Bot, channel_ids: list[int], concurrency: int):
+	'''
+	Call `warmup_channel(channel)` of every cog defining it for the channels.
+	It is only for speed, so errors are ignored; the commands fetch what they need anyway.
+	'''
+	hooks = [getattr(cog, 'warmup_channel') for cog in bot.cogs.values() if hasattr(cog, 'warmup_channel')]
+	if len(hooks) == 0:
+		return
+
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def warm(channel_id: int):
+		async with semaphore:
+			channel = bot.get_channel(channel_id)
+			if not isinstance(channel, discord.abc.GuildChannel):
+				# Deleted or not visible anymore
+				return
+			for hook in hooks:
+				try:
+					await hook(channel)
+				except Exception:
+					pass
+			# Let the commands go first
+			await asyncio.sleep(0)
+
+	await asyncio.gather(*(warm(channel_id) for channel_id in channel_ids))
+
+async def warm_up_guild(bot: Bot, guild: discord.Guild):
+	'''
+	Call `warmup_guild(guild)` of every cog defining it, e.g. for a guild just joined,
+	which has no activity yet. Errors are ignored as in warm_up().
+	'''
+	for cog in list(bot.cogs.values()):
+		if hasattr(cog, 'warmup_guild'):
+			try:
+				await getattr(cog, 'warmup_guild')(guild)
+			except Exception:
+				pass
+
+__all__ = ['ChannelActivity', 'ActivityTracker', 'warm_up', 'warm_up_guild']
@@ -0,0 +1,38 @@
+'''
+This module defines the thread pool of the blocking db calls (pymongo).
+Every call runs in the pool, so a slow round trip to Mongo never blocks
+the event loop (and the other guilds' interactions) anymore.
+The repositories in .storage run their calls here when they block.
+'''
+from __future__ import annotations
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional, TypeVar
+from .utils import generate_config
+
+config = generate_config(
+	MONGO_EXECUTOR_WORKERS = {'default': 8, 'cast': int},
+)
+
+T = TypeVar('T')
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def get_executor() -> ThreadPoolExecutor:
+	# pymongo is thread-safe, and the pool bounds the connections used at once
+	global _executor
+	if _executor is None:
+		_executor = ThreadPoolExecutor(max_workers = config['MONGO_EXECUTOR_WORKERS'], thread_name_prefix = 'mongo')
+	return _executor
+
+def shutdown_executor():
+	global _executor
+	if _executor is not None:
+		_executor.shutdown(wait = True)
+		_executor = None
+
+async def run_in_executor(f: Callable[..., T], *args, **kwargs) -> T:
+	return await get_running_loop().run_in_executor(get_executor(), partial(f, *args, **kwargs))
+
+__all__ = ['get_executor', 'shutdown_executor', 'run_in_executor']
@@ -1,29 +1,73 @@
 from __future__ import annotations
+import aiohttp
+import asyncio
 import discord
 import re
+from .activity import ActivityTracker, config as activity_config, warm_up, warm_up_guild
+from .asyncdb import run_in_executor
+from .credentials import CredentialStore
 from .maid import Maid
+from .rng import GeneratorStore
+from .state import config as state_config
+from .storage import config as storage_config
 from .utils import generate_config
+from .writebehind import WriteBehind
 from base64 import b64decode
 from collections.abc import Mapping
-from pymongo import ASCENDING
 from types import MappingProxyType
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-	from pymongo.database import Database
 	from typing import Optional
 	from .state import State
+	from .storage import DocumentRepository, MaidRepository, Storage
 
 config = generate_config(
 	MAID_LIST_COLLECTION = {'default': 'maid-list'},
+	STATE_SNAPSHOT_PATH = {'default': ''},
+	STATE_SNAPSHOT_INTERVAL = {'default': 300, 'cast': float},
+	MAID_CREDENTIAL_STORE_PATH = {'default': ''},
+	MAID_CREDENTIAL_KEY = {'default': ''},
 )
 
 class Bot(discord.Bot):
-	def __init__(self, db: Database, state: State, description: Optional[str] = None, *args, **options):
+	def __init__(self, storage: Storage, state: State, description: Optional[str] = None, *args, **options):
 		super().__init__(description, *args, **options)
-		self._db = db
+		# Every db access of the cogs goes through the repositories of the storage
+		self._storage = storage
 		self._state = state
-		self._maids = self._retrieve_maids(db)
+		self._maids = self._retrieve_maids(storage.maids(config['MAID_LIST_COLLECTION']))
+		self._write_behinds: dict[str, WriteBehind] = {}
+		self._webhook_session: Optional[aiohttp.ClientSession] = None
+		self._checkpoint_task: Optional[asyncio.Task] = None
+		self._purge_task: Optional[asyncio.Task] = None
+		self._activity_task: Optional[asyncio.Task] = None
+
+		self._snapshot_path: str = config['STATE_SNAPSHOT_PATH']
+		if self._snapshot_path:
+			state.restore(self._snapshot_path)
+
+		self._activity = ActivityTracker(
+			state,
+			storage.documents(activity_config['ACTIVITY_COLLECTION'], ('channel', ), unique = True)
+			if activity_config['ACTIVITY_PERSIST_TOP'] > 0 else None
+		)
+		self._activity.load_sync()
+		self._warmed_up = False
+		self.add_listener(self._record_activity, 'on_application_command')
+		self.add_listener(self._warm_up_on_ready, 'on_ready')
+		self.add_listener(self._warm_up_on_guild_join, 'on_guild_join')
+		self._schema_verified = False
+		if storage_config['STORAGE_VERIFY_SCHEMA']:
+			self.add_listener(self._verify_schema, 'on_ready')
+
+		self._credentials: Optional[CredentialStore] = None
+		if config['MAID_CREDENTIAL_STORE_PATH']:
+			self._credentials = CredentialStore(config['MAID_CREDENTIAL_STORE_PATH'], config['MAID_CREDENTIAL_KEY'])
+			self._credentials.load()
+
+		# The random generators of the channels, used by RandomMixin
+		self._generators = GeneratorStore(self)
 
 	@staticmethod
 	def _data_base64_to_bytes(img):
@@ -31,23 +75,152 @@ class Bot(discord.Bot):
 			return b64decode(m.group(1))
 
 	@classmethod
-	def _retrieve_maids(cls, db: Database) -> Mapping[str, Maid]:
+	def _retrieve_maids(cls, repo: MaidRepository) -> Mapping[str, Maid]:
 		# The maids information is loaded once per execution.
-		_maids = list(db[config['MAID_LIST_COLLECTION']].find().sort("_id", ASCENDING))
+		_maids = repo.all_sync()
 		_maids_list = list(Maid(m['name'], m['display_name'], cls._data_base64_to_bytes(m['avatar'])) for m in _maids)
 		# This dict provides a way to retrieve maids by names.
 		# Also, with the features of dict, the maid order is kept.
 		maids: Mapping[str, Maid] = MappingProxyType({m.name: m for m in _maids_list})
 		return maids
 
+	def get_write_behind(self, repo: DocumentRepository, **kwargs) -> WriteBehind:
+		# One write-behind layer per repository, shared by every user of the repository.
+		# kwargs are only used at the first call.
+		if repo.name not in self._write_behinds:
+			self._write_behinds[repo.name] = WriteBehind(repo, **kwargs)
+		return self._write_behinds[repo.name]
+
 	@property
-	def db(self):
-		return self._db
+	def webhook_session(self) -> aiohttp.ClientSession:
+		# The session for webhooks built from URLs (e.g. restored from the snapshot)
+		if self._webhook_session is None or self._webhook_session.closed:
+			self._webhook_session = aiohttp.ClientSession()
+		return self._webhook_session
+
+	def webhook_from_url(self, url: str) -> discord.Webhook:
+		return discord.Webhook.from_url(url, session = self.webhook_session, bot_token = self.http.token)
+
+	def webhook_partial(self, id: int, token: str) -> discord.Webhook:
+		return discord.Webhook.partial(id, token, session = self.webhook_session, bot_token = self.http.token)
+
+	async def _record_activity(self, ctx: discord.ApplicationContext):
+		if isinstance(ctx.channel, discord.abc.GuildChannel | discord.Thread):
+			self._activity.record(ctx.channel)
+
+	def record_activity(self, channel: discord.abc.GuildChannel | discord.Thread):
+		# For the activities not through application commands, e.g. text commands
+		self._activity.record(channel)
+
+	async def _warm_up_on_ready(self):
+		# on_ready is called again after reconnections, but the caches are still warm then
+		if self._warmed_up:
+			return
+		self._warmed_up = True
+		await asyncio.sleep(activity_config['ACTIVITY_WARMUP_DELAY'])
+		await warm_up(self, self._activity.top(activity_config['ACTIVITY_WARMUP_TOP']), activity_config['ACTIVITY_WARMUP_CONCURRENCY'])
+
+	async def _warm_up_on_guild_join(self, guild: discord.Guild):
+		# on_guild_available is not dispatched for a guild just joined
+		await warm_up_guild(self, guild)
+		# A guild joined again may have been active before
+		await warm_up(self, self._activity.top(activity_config['ACTIVITY_WARMUP_TOP'], guild.id), activity_config['ACTIVITY_WARMUP_CONCURRENCY'])
+
+	async def _verify_schema(self):
+		# Every cog has created its repositories by now, and once is enough
+		if self._schema_verified:
+			return
+		self._schema_verified = True
+		report = await run_in_executor(self._storage.verify_sync)
+		for line in report:
+			print(f'Collection scan: {line}')
+		print(f'Schema verified: {len(report)} scanning queries.')
+
+	async def start(self, token: str, *, reconnect: bool = True):
+		if self._snapshot_path and config['STATE_SNAPSHOT_INTERVAL'] > 0:
+			self._checkpoint_task = asyncio.create_task(self._checkpoint())
+		if state_config['STATE_PURGE_INTERVAL'] > 0:
+			self._purge_task = asyncio.create_task(self._purge_state())
+		if activity_config['ACTIVITY_PERSIST_TOP'] > 0 and activity_config['ACTIVITY_PERSIST_INTERVAL'] > 0:
+			self._activity_task = asyncio.create_task(self._persist_activity())
+		await super().start(token, reconnect = reconnect)
+
+	async def _checkpoint(self):
+		while True:
+			await asyncio.sleep(config['STATE_SNAPSHOT_INTERVAL'])
+			try:
+				await self._state.checkpoint(self._snapshot_path)
+			except Exception as e:
+				# Try again next time
+				print(f'Failed to checkpoint the state: {e!r}')
+
+	async def _purge_state(self):
+		while True:
+			await asyncio.sleep(state_config['STATE_PURGE_INTERVAL'])
+			try:
+				await self._state.purge()
+			except Exception as e:
+				print(f'Failed to purge the state: {e!r}')
+
+	async def _persist_activity(self):
+		while True:
+			await asyncio.sleep(activity_config['ACTIVITY_PERSIST_INTERVAL'])
+			try:
+				await self._activity.persist()
+			except Exception as e:
+				print(f'Failed to persist the channel activities: {e!r}')
+
+	async def close(self):
+		try:
+			await super().close()
+		finally:
+			if self._checkpoint_task is not None:
+				self._checkpoint_task.cancel()
+			if self._purge_task is not None:
+				self._purge_task.cancel()
+			if self._activity_task is not None:
+				self._activity_task.cancel()
+
+			try:
+				await self._activity.persist()
+			except Exception as e:
+				print(f'Failed to persist the channel activities: {e!r}')
+
+			# Flush the pending writes after no command can run anymore
+			for write_behind in self._write_behinds.values():
+				await write_behind.close()
+			await self._storage.flush()
+			self._storage.close()
+
+			# Everything is flushed, so the snapshot is clean
+			if self._snapshot_path:
+				self._state.save(self._snapshot_path, clean = True)
+
+			if self._credentials is not None:
+				await self._credentials.close()
+
+			if self._webhook_session is not None:
+				await self._webhook_session.close()
+
+			self._state.close()
+
+	@property
+	def storage(self) -> Storage:
+		return self._storage
 
 	@property
 	def state(self):
 		return self._state
 
+	@property
+	def credentials(self):
+		# None if the credential store is not enabled
+		return self._credentials
+
+	@property
+	def generators(self):
+		return self._generators
+
 	@property
 	def maids(self):
 		return self._maids
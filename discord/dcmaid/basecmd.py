@@ -1,29 +1,67 @@
 from __future__ import annotations
+import asyncio
 import discord
 import discord.utils
 import re
+from collections import deque
 from collections.abc import Mapping
 from functools import partial
+from time import monotonic
 from types import MappingProxyType
-from typing import Optional, TYPE_CHECKING
+from typing import Any, Optional, TYPE_CHECKING
 from .basebot import Bot
 from .basecog import BaseCog
+from .cache import cache_stats
+from .constants import MAX_WEBHOOKS_IN_CHANNEL
 from .exception import MaidNotFound
 from .helper import get_help, set_help
 from .perm import admin_only
+from .response import deliver, request_stats
 from .typing import GuildChannel, Webhookable
 from .utils import *
 from .views import YesNoView
-from .weight import Weight
+from .weight import config as weight_config, GuildWeight, Weight, WeightRegistry
+
+if TYPE_CHECKING:
+	from .state import Namespace
 
 config = generate_config(
 	MAID_INSTALLED_COLLECTION = {'default': 'channel-installed-maids'},
+	MAID_INSTALLED_MIGRATE = {'default': False, 'cast': bool},
+	MAID_SYNC_CONCURRENCY = {'default': 4, 'cast': int},
+	MAID_WEBHOOK_CHECK_DELAY = {'default': 2.0, 'cast': float},
+	MAID_WEBHOOK_POOL_SIZE = {'default': 1, 'cast': int},
+	MAID_WEBHOOK_POOL_WINDOW = {'default': 2.0, 'cast': float},
 )
 
 # This cog (name = 'Base') defines the basic commands.
 class BasicCommands(BaseCog, name = 'Base', elementary = True):
 	def __init__(self, bot: Bot):
 		super().__init__(bot)
+		self._installations = self.storage.installations(config['MAID_INSTALLED_COLLECTION'])
+		self._weights = WeightRegistry(bot)
+		if weight_config['MAID_WEIGHT_PRELOAD']:
+			self._weights.preload()
+		# The webhooks restored from the snapshot (or the credential store) are trusted until they fail.
+		# With the credential store, the tokens are not written into the plain snapshot.
+		self.state.register_codec('installed_hooks', self._dump_hooks, self._load_hooks, snapshot = bot.credentials is None)
+		# The extra webhooks of each maid when MAID_WEBHOOK_POOL_SIZE > 1
+		self._pool_enabled = config['MAID_WEBHOOK_POOL_SIZE'] > 1
+		self._pools: Namespace[int, Mapping[str, tuple[discord.Webhook, ...]]] = self.state.namespace('maid_pools', shared = True)
+		self.state.register_codec('maid_pools', self._dump_pools, self._load_pools, snapshot = bot.credentials is None)
+		# Webhook id: the times of the recent sends
+		self._webhook_sends: Namespace[int, deque[float]] = self.state.namespace('webhook_sends', idle = config['MAID_WEBHOOK_POOL_WINDOW'])
+		# When the last sync of each channel started
+		self._synced_at = self.state.namespace('installed_hooks_synced_at')
+		# Bound the webhook API calls made by syncs at once
+		self._sync_semaphore = asyncio.Semaphore(config['MAID_SYNC_CONCURRENCY'])
+		# The guilds whose channels have been warmed up
+		self._warmed_guilds = self.state.namespace('warmed_guilds')
+		# The channels waiting to be checked after on_webhooks_update
+		self._webhook_checks: set[int] = set()
+		if config['MAID_INSTALLED_MIGRATE']:
+			# Before the loop starts, so blocking is fine
+			self._installations.migrate_sync()
 
 	system = discord.SlashCommandGroup(
 		name = "system",
@@ -37,70 +75,388 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		'''
 	)
 
+	@staticmethod
+	def _dump_hooks(hooks: Mapping[str, discord.Webhook]):
+		return {maid_name: webhook.url for maid_name, webhook in hooks.items()}
+
+	def _load_hooks(self, channel_id: int, raw: dict[str, str]) -> Optional[Mapping[str, discord.Webhook]]:
+		if set(raw.keys()) != set(self.maids.keys()):
+			# The maids have changed since the snapshot, so sync again
+			return None
+		return MappingProxyType({maid_name: self.bot.webhook_from_url(raw[maid_name]) for maid_name in self.maids.keys()})
+
+	@staticmethod
+	def _dump_pools(pools: Mapping[str, tuple[discord.Webhook, ...]]):
+		return {maid_name: [webhook.url for webhook in pool] for maid_name, pool in pools.items()}
+
+	def _load_pools(self, channel_id: int, raw: dict[str, list[str]]) -> Optional[Mapping[str, tuple[discord.Webhook, ...]]]:
+		if set(raw.keys()) != set(self.maids.keys()):
+			return None
+		return MappingProxyType({maid_name: tuple(self.bot.webhook_from_url(url) for url in raw[maid_name]) for maid_name in self.maids.keys()})
+
+	def _load_credentials(self, channel_id: int) -> Optional[tuple[Mapping[str, discord.Webhook], Mapping[str, tuple[discord.Webhook, ...]]]]:
+		# Build the webhooks (and the pools) from the credential store without any API call
+		if self.bot.credentials is None:
+			return None
+		credentials = self.bot.credentials.get(channel_id)
+		if credentials is None or set(credentials.keys()) != set(self.maids.keys()):
+			return None
+		if any(credentials[maid_name][2] != maid.digest for maid_name, maid in self.maids.items()):
+			# The maids have been changed, so sync to edit the webhooks
+			return None
+		return (
+			MappingProxyType({
+				maid_name: self.bot.webhook_partial(credentials[maid_name][0], credentials[maid_name][1])
+				for maid_name in self.maids.keys()
+			}),
+			MappingProxyType({
+				maid_name: tuple(self.bot.webhook_partial(id, token) for id, token in (credentials[maid_name][3] if len(credentials[maid_name]) > 3 else ()))
+				for maid_name in self.maids.keys()
+			})
+		)
+
+	async def _install_hooks(self, channel_id: int, installed_hooks: Mapping[str, discord.Webhook], pools: Optional[Mapping[str, tuple[discord.Webhook, ...]]] = None):
+		await self.state.installed_hooks.publish(channel_id, installed_hooks)
+		if self._pool_enabled and pools is not None:
+			await self._pools.publish(channel_id, pools)
+		if self.bot.credentials is not None:
+			self.bot.credentials.set(channel_id, installed_hooks, {maid_name: maid.digest for maid_name, maid in self.maids.items()}, pools)
+
+	async def _evict_hooks(self, channel_id: int):
+		await self.state.installed_hooks.withdraw(channel_id)
+		await self._pools.withdraw(channel_id)
+		if self.bot.credentials is not None:
+			self.bot.credentials.remove(channel_id)
+
 	# After fetch, the state "installed_hooks" should match the maid mapping.
 	# Also, note that we don't store webhook tokens in our db but store the
-	# full webhooks (containing tokens) in the server state.
+	# full webhooks (containing tokens) in the server state (and the local credential store if enabled).
 	async def _fetch_maids(self, channel: GuildChannel, force = False) -> Mapping[str, discord.Webhook]:
 		if not isinstance(channel, Webhookable):
 			return {}
 
 		channel_id = channel.id
 
-		col = self.db[config['MAID_INSTALLED_COLLECTION']]
-
 		# Here, we use "hook" to indicate the webhooks we know from our db,
 		# and "webhook" to the real webhooks in the channel.
-		installed_hooks: Optional[Mapping[str, discord.Webhook]] = self.state.get_installed_hooks(channel_id)
-
-		if force or installed_hooks is None:
-			installed_hooks_dict: dict[str, discord.Webhook] = {}
-
-			# If the state already stores the information, we don't start a
-			# query again. We trust users not to delete the webhooks (maids).
-			channel_webhooks = await channel.webhooks()
-			channel_webhooks_dict = {h.id: h for h in channel_webhooks}
-			channel_webhooks_id = set(h.id for h in channel_webhooks)
-			registered_hooks = list(col.find({'channel_id': channel_id}))
-			registered_hooks_id = set(h['hook_id'] for h in registered_hooks)
-
-			# 1. Check if some hooks are deleted
-			for h_id in (registered_hooks_id - channel_webhooks_id):
-				col.delete_one({'channel_id': channel_id, 'hook_id': h_id})
-
-			# Now, these are in the new version. All registered hooks corresponds an active webhook.
-			# The query operation is supposed to be cheap because we index 'channel_id' and 'hook_id' columns
-			registered_hooks = list(col.find({'channel_id': channel_id}))
-			registered_hooks_id = set(h['hook_id'] for h in registered_hooks)
-
-			undealt_maids = set(self.maids.keys())
-			# 2. Check if some registered maids are removed from our DB and update to new information if any
-			for hook in registered_hooks:
-				maid_name = hook['name']
-				h_id = hook['hook_id']
-				webhook = channel_webhooks_dict[h_id]
-				if maid_name not in undealt_maids:
-					# This maid may be fired by us, or the channel has redundant maids (how can this happen?)
-					await webhook.delete()
-					col.delete_one({'channel_id': channel_id, 'hook_id': h_id})
-				else:
-					# Update maids information
-					maid = self.maids[maid_name]
-					undealt_maids.remove(maid_name)
-					await webhook.edit(reason = 'Fetch maid information', name = maid.display_name, avatar = maid.avatar)
+		installed_hooks: Optional[Mapping[str, discord.Webhook]] = await self.state.installed_hooks.fetch(channel_id)
+		if not force and installed_hooks is not None:
+			if self._pool_enabled and channel_id not in self._pools:
+				# Installed by another process or restored from the snapshot
+				await self._pools.fetch(channel_id)
+			return installed_hooks
+
+		if not force and (credentials := self._load_credentials(channel_id)) is not None:
+			await self._install_hooks(channel_id, *credentials)
+			return credentials[0]
+
+		if not force and channel.guild.id not in self._warmed_guilds:
+			# The first use in the guild, so warm all the channels of the guild at once
+			await self.warmup_guild(channel.guild)
+			installed_hooks = self.state.get_installed_hooks(channel_id)
+			if installed_hooks is not None:
+				return installed_hooks
+
+		requested = monotonic()
+		# Single flight: concurrent callers of the channel wait for the sync in flight and share its result.
+		# A forced caller only shares a sync started after it asked.
+		async with self.state.installed_hooks.lock(channel_id):
+			installed_hooks = await self.state.installed_hooks.fetch(channel_id)
+			synced_at: Optional[float] = self._synced_at.get(channel_id)
+			if installed_hooks is None or (force and (synced_at is None or synced_at < requested)):
+				# Only one process syncs the channel at a time, or we may create the same maids twice.
+				async with self.state.lease('installed_hooks', channel_id):
+					if not force:
+						# Another process may have synced it while we were waiting
+						installed_hooks = await self.state.installed_hooks.fetch(channel_id)
+
+					if force or installed_hooks is None:
+						started = monotonic()
+						installed_hooks, pools = await self._sync_maids(channel)
+						await self._install_hooks(channel_id, installed_hooks, pools)
+						self._synced_at.set(channel_id, started)
+
+		assert installed_hooks is not None
+		return installed_hooks
+
+	async def warmup_guild(self, guild: discord.Guild):
+		'''
+		Fill the installed hooks of every installed channel in the guild with one `guild.webhooks()` call,
+		instead of one `channel.webhooks()` call per channel.
+		Only the channels whose webhooks are all up to date are filled; the others are left to the channel sync.
+		The documents written before the guild id is recorded are found after their channels are synced once.
+		'''
+		async with self._warmed_guilds.lock(guild.id):
+			if guild.id in self._warmed_guilds:
+				return
+			self._warmed_guilds.set(guild.id, True)
+
+			installations = await self._installations.find_guild(guild.id)
+			cold = [channel_id for channel_id in installations.keys() if channel_id not in self.state.installed_hooks]
+			if len(cold) == 0:
+				return
+
+			try:
+				async with self._sync_semaphore:
+					guild_webhooks = await guild.webhooks()
+			except discord.HTTPException:
+				# E.g. no guild-wide permission, so sync channel by channel
+				return
+
+			channel_webhooks: dict[int, dict[int, discord.Webhook]] = {}
+			for webhook in guild_webhooks:
+				channel_webhooks.setdefault(webhook.channel_id, {})[webhook.id] = webhook
+
+			for channel_id in cold:
+				hooks, legacy = installations[channel_id]
+				if legacy or set(hooks.keys()) != set(self.maids.keys()):
+					continue
+
+				webhooks = channel_webhooks.get(channel_id, {})
+				installed_hooks_dict: dict[str, discord.Webhook] = {}
+				pools_dict: dict[str, tuple[discord.Webhook, ...]] = {}
+				for maid_name, maid in self.maids.items():
+					hook = hooks[maid_name]
+					webhook = webhooks.get(hook['hook_id'])
+					if webhook is None or hook.get('digest') != maid.digest or webhook.name != maid.display_name:
+						break
 					installed_hooks_dict[maid_name] = webhook
+					# The pooled ones gone are just left out until the next sync
+					pools_dict[maid_name] = tuple(
+						webhooks[h_id] for h_id in hook.get('pool', ())
+						if h_id in webhooks and webhooks[h_id].name == maid.display_name
+					)
+				else:
+					# A sync may have finished meanwhile, which is newer
+					if channel_id not in self.state.installed_hooks:
+						await self._install_hooks(channel_id, MappingProxyType(installed_hooks_dict), MappingProxyType(pools_dict))
+
+	@discord.Cog.listener()
+	async def on_guild_available(self, guild: discord.Guild):
+		await self.warmup_guild(guild)
+
+	async def warmup_channel(self, channel: discord.abc.GuildChannel):
+		# Called by the bot to warm up active channels; see activity.warm_up()
+		if isinstance(channel, Webhookable):
+			await asyncio.gather(self.fetch_maids(channel), self.fetch_weight(channel))
+
+	async def refresh_maid(self, channel: GuildChannel | discord.Thread, maid_name: str, failed: discord.Webhook) -> Optional[discord.Webhook]:
+		'''
+		Call this when sending with a maid's webhook fails with NotFound.
+		The cached hooks are evicted only if they still contain the failed webhook,
+		so the concurrent failures of a channel lead to one sync.
+		'''
+		channel = await resolve_guild_channel(channel)
+		channel_id = channel.id
+		async with self.state.installed_hooks.lock(channel_id):
+			hooks = self.state.get_installed_hooks(channel_id)
+			pools = self._pools.get(channel_id)
+			if (
+				(hooks is not None and maid_name in hooks and hooks[maid_name].id == failed.id)
+				or (pools is not None and any(webhook.id == failed.id for webhook in pools.get(maid_name, ())))
+			):
+				await self._evict_hooks(channel_id)
+		return (await self._fetch_maids(channel)).get(maid_name, None)
+
+	def maid_refresher(self, channel: GuildChannel | discord.Thread, maid_name: str, webhook: Optional[discord.Webhook]):
+		# The `refresh` argument of send_as()
+		if webhook is None:
+			return None
+		return partial(self.refresh_maid, channel, maid_name, webhook)
+
+	@discord.Cog.listener()
+	async def on_webhooks_update(self, channel: discord.abc.GuildChannel):
+		# Only the channels in the state are checked; the others are synced on their next use anyway.
+		# Our own syncs trigger the event too, so a burst of events is checked once after a while.
+		channel_id = channel.id
+		if channel_id in self._webhook_checks or channel_id not in self.state.installed_hooks:
+			return
+
+		self._webhook_checks.add(channel_id)
+		try:
+			await asyncio.sleep(config['MAID_WEBHOOK_CHECK_DELAY'])
+		finally:
+			self._webhook_checks.discard(channel_id)
+
+		if isinstance(channel, Webhookable):
+			await self._check_maids(channel)
+
+	async def _check_maids(self, channel: Webhookable):
+		channel_id = channel.id
+		async with self.state.installed_hooks.lock(channel_id):
+			installed_hooks = self.state.get_installed_hooks(channel_id)
+			if installed_hooks is None:
+				return
+
+			try:
+				channel_webhooks = {h.id: h for h in await channel.webhooks()}
+			except discord.HTTPException:
+				return
 
-			# 3. Add new cute maids!
-			for maid_name in undealt_maids:
-				maid = self.maids[maid_name]
+			pools = self._pools.get(channel_id, {})
+			if all(
+				w.id in channel_webhooks and channel_webhooks[w.id].name == self.maids[maid_name].display_name
+				for maid_name, webhook in installed_hooks.items()
+				for w in (webhook, *pools.get(maid_name, ()))
+			):
+				return
+
+			# Some maids are deleted or renamed by users
+			await self._evict_hooks(channel_id)
+
+		# Repair it now; the sync only touches the changed maids
+		await self._fetch_maids(channel)
+
+	async def _sync_maids(self, channel: Webhookable) -> tuple[Mapping[str, discord.Webhook], Mapping[str, tuple[discord.Webhook, ...]]]:
+		# Returns the installed hooks and the extra webhooks of the pools
+		channel_id = channel.id
+
+		installed_hooks_dict: dict[str, discord.Webhook] = {}
+		pools_dict: dict[str, list[discord.Webhook]] = {}
+		# The digest of each maid to record; None if some webhooks of the maid failed to update
+		digests: dict[str, Optional[str]] = {}
+
+		# If the state already stores the information, we don't start a query again.
+		# If users delete the webhooks (maids), on_webhooks_update or a failed send repairs the state.
+		channel_webhooks = await channel.webhooks()
+		channel_webhooks_dict = {h.id: h for h in channel_webhooks}
+		registered_hooks, legacy = await self._installations.find_channel(channel_id)
+
+		# The pool can only be as large as the webhook limit of a channel allows
+		registered_ids = set(h_id for hook in registered_hooks.values() for h_id in (hook['hook_id'], *hook.get('pool', ())))
+		others = sum(1 for h_id in channel_webhooks_dict.keys() if h_id not in registered_ids)
+		pool_extra = max(0, min(config['MAID_WEBHOOK_POOL_SIZE'] - 1, (MAX_WEBHOOKS_IN_CHANNEL - others) // max(1, len(self.maids)) - 1))
+
+		to_delete: list[discord.Webhook] = []
+		to_edit: list[tuple[str, discord.Webhook]] = []
+		# 1. Forget the hooks deleted in the channel, and
+		# 2. check if some registered maids are removed from our DB and update to new information if any
+		for maid_name, hook in registered_hooks.items():
+			webhook = channel_webhooks_dict.get(hook['hook_id'])
+			pool = [channel_webhooks_dict[h_id] for h_id in hook.get('pool', ()) if h_id in channel_webhooks_dict]
+			if maid_name not in self.maids:
+				# This maid may be fired by us
+				to_delete.extend(pool)
+				if webhook is not None:
+					to_delete.append(webhook)
+				continue
+
+			if webhook is None:
+				# The primary one is gone, so promote one in the pool if any
+				if len(pool) == 0:
+					continue
+				webhook = pool.pop(0)
+
+			maid = self.maids[maid_name]
+			installed_hooks_dict[maid_name] = webhook
+			to_delete.extend(pool[pool_extra:])
+			pools_dict[maid_name] = pool = pool[:pool_extra]
+			digests[maid_name] = hook.get('digest')
+			# The avatar cannot be compared with the webhook, so we compare the digest we wrote last time.
+			# The name is still checked in case someone renamed the webhook by hand.
+			for w in (webhook, *pool):
+				if hook.get('digest') != maid.digest or w.name != maid.display_name:
+					to_edit.append((maid_name, w))
+
+		# Recorded as updated unless some edit fails
+		for maid_name, _ in to_edit:
+			digests[maid_name] = self.maids[maid_name].digest
+
+		async def delete(webhook: discord.Webhook):
+			async with self._sync_semaphore:
+				await webhook.delete()
+
+		async def edit(maid_name: str, webhook: discord.Webhook):
+			# Update maids information
+			maid = self.maids[maid_name]
+			try:
+				async with self._sync_semaphore:
+					await webhook.edit(reason = 'Fetch maid information', name = maid.display_name, avatar = maid.avatar)
+			except:
+				digests[maid_name] = None
+				raise
+
+		# 3. Add new cute maids!
+		async def create(maid_name: str):
+			maid = self.maids[maid_name]
+			async with self._sync_semaphore:
 				webhook = await channel.create_webhook(reason = 'Add new maid', name = maid.display_name, avatar = maid.avatar)
-				col.insert_one({'channel_id': channel_id, 'name': maid_name, 'hook_id': webhook.id})
-				installed_hooks_dict[maid_name] = webhook
+			installed_hooks_dict[maid_name] = webhook
+			pools_dict.setdefault(maid_name, [])
+			digests[maid_name] = maid.digest
+
+		results = await asyncio.gather(
+			*(delete(webhook) for webhook in to_delete),
+			*(edit(maid_name, webhook) for maid_name, webhook in to_edit),
+			*(create(maid_name) for maid_name in self.maids.keys() if maid_name not in installed_hooks_dict),
+			return_exceptions = True
+		)
 
-			# Reorder the installed_hooks to match the maids order
-			installed_hooks = MappingProxyType({maid_name: installed_hooks_dict[maid_name] for maid_name in self.maids.keys()})
-			self.state.set_installed_hooks(channel_id, installed_hooks)
+		# 4. Fill the pools; a pool is only for speed, so failures are fine
+		async def create_pooled(maid_name: str):
+			maid = self.maids[maid_name]
+			try:
+				async with self._sync_semaphore:
+					webhook = await channel.create_webhook(reason = 'Add pooled maid', name = maid.display_name, avatar = maid.avatar)
+			except discord.HTTPException:
+				return
+			pools_dict[maid_name].append(webhook)
+
+		await asyncio.gather(*(
+			create_pooled(maid_name)
+			for maid_name in installed_hooks_dict.keys()
+			for _ in range(pool_extra - len(pools_dict[maid_name]))
+		))
+
+		hooks: dict[str, dict[str, Any]] = {}
+		for maid_name, webhook in installed_hooks_dict.items():
+			hook: dict[str, Any] = {'hook_id': webhook.id, 'digest': digests[maid_name]}
+			if len(pools_dict[maid_name]) > 0:
+				hook['pool'] = [w.id for w in pools_dict[maid_name]]
+			hooks[maid_name] = hook
+
+		# Save what has been done even if some calls failed, so that the created webhooks are not lost
+		if legacy or hooks != registered_hooks:
+			await self._installations.save(channel_id, channel.guild.id, hooks, legacy)
+		for result in results:
+			if isinstance(result, BaseException):
+				raise result
+
+		# Reorder the installed_hooks to match the maids order
+		return (
+			MappingProxyType({maid_name: installed_hooks_dict[maid_name] for maid_name in self.maids.keys()}),
+			MappingProxyType({maid_name: tuple(pools_dict[maid_name]) for maid_name in self.maids.keys()})
+		)
 
-		return installed_hooks
+	def pick_webhook(self, channel_id: int, maid_name: str, webhook: discord.Webhook) -> discord.Webhook:
+		'''
+		Pick the least loaded webhook in the pool of the maid, where the load is the number of
+		messages sent in the last MAID_WEBHOOK_POOL_WINDOW seconds (we cannot see the rate limit headers
+		through the library, so we count by ourselves). Ties go to the installed one.
+		`webhook` is the installed one, and is returned as is if the pool is not enabled.
+		'''
+		pools = self._pools.get(channel_id)
+		if pools is None or len(pools.get(maid_name, ())) == 0:
+			return webhook
+
+		now = monotonic()
+		window = config['MAID_WEBHOOK_POOL_WINDOW']
+
+		def load(w: discord.Webhook) -> int:
+			sends = self._webhook_sends.get(w.id)
+			if sends is None:
+				return 0
+			while len(sends) > 0 and now - sends[0] > window:
+				sends.popleft()
+			return len(sends)
+
+		chosen = min((webhook, *pools[maid_name]), key = load)
+		sends = self._webhook_sends.get(chosen.id)
+		if sends is None:
+			sends = deque()
+			self._webhook_sends.set(chosen.id, sends)
+		sends.append(now)
+		return chosen
 
 	async def fetch_maids(self, channel: GuildChannel):
 		'''
@@ -125,7 +481,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel)
 
-		await self.fetch_maids(get_guild_channel(ctx.channel))
+		await self.fetch_maids(await resolve_guild_channel(ctx.channel))
 		await ctx.send_response(
 			content = self._trans(ctx, 'succ-init'),
 			ephemeral = True
@@ -146,12 +502,52 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel)
 
-		await self._fetch_maids(get_guild_channel(ctx.channel), True)
+		await self._fetch_maids(await resolve_guild_channel(ctx.channel), True)
 		await ctx.send_response(
 			content = self._trans(ctx, 'succ-update'),
 			ephemeral = True
 		)
 
+	@system.command(
+		description = 'Show the API requests made per command',
+		default_member_permissions = admin_only
+	)
+	async def requests(self, ctx: discord.ApplicationContext):
+		'''
+		`/{cmd_name}` shows the commands making the most API requests in this process,
+		with the number of calls and the requests per call.
+		This command is for OPs only.
+		The response of the command is ephemeral.
+		'''
+		lines = [
+			f'`{name}`: {invocations} × {requests / invocations:.2f}' if invocations > 0 else f'`{name}`: {requests}'
+			for name, invocations, requests in request_stats.top(10)
+		]
+		await ctx.send_response(
+			content = '\n'.join(lines) if len(lines) > 0 else self._trans(ctx, 'no-requests'),
+			ephemeral = True
+		)
+
+	@system.command(
+		description = 'Show the hit ratio and the load latency of the caches',
+		default_member_permissions = admin_only
+	)
+	async def caches(self, ctx: discord.ApplicationContext):
+		'''
+		`/{cmd_name}` shows the caches over the database in this process,
+		with their hits, misses, hit ratio and load latency.
+		This command is for OPs only.
+		The response of the command is ephemeral.
+		'''
+		lines = [
+			f"`{name}`: {stats['hits'] + stats['negative_hits']}/{stats['misses']} ({stats['hit_ratio']:.1%}), {stats['avg_load_ms']:.1f}/{stats['max_load_ms']:.1f} ms"
+			for name, stats in cache_stats()
+		]
+		await ctx.send_response(
+			content = '\n'.join(lines) if len(lines) > 0 else self._trans(ctx, 'no-caches'),
+			ephemeral = True
+		)
+
 	async def _uninstall(self, ctx: discord.ApplicationContext, button, interaction: discord.Interaction):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel) and ctx.channel_id is not None
@@ -159,17 +555,24 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		await interaction.response.defer()
 		await interaction.edit_original_response(content = self._trans(ctx, 'uninstalling'), view = None)
 
-		await self._fetch_maids(get_guild_channel(ctx.channel), True)
-
-		channel_id = ctx.channel_id
-		webhooks = self.state.get_installed_hooks(channel_id)
+		channel = await resolve_guild_channel(ctx.channel)
+		channel_id = channel.id
+		# Hold the lock so that no concurrent fetch sees the half-uninstalled channel
+		async with self.state.installed_hooks.lock(channel_id), self.state.lease('installed_hooks', channel_id):
+			# Delete the registered webhooks still in the channel, without syncing the missing maids first
+			registered_hooks, _ = await self._installations.find_channel(channel_id)
+			registered_hooks_id = set(h_id for hook in registered_hooks.values() for h_id in (hook['hook_id'], *hook.get('pool', ())))
+			webhooks = [webhook for webhook in await channel.webhooks() if webhook.id in registered_hooks_id]
+
+			async def delete(webhook: discord.Webhook):
+				async with self._sync_semaphore:
+					await webhook.delete()
 
-		if webhooks is not None:
-			for webhook in webhooks.values():
-				await webhook.delete()
+			await asyncio.gather(*(delete(webhook) for webhook in webhooks))
 
-		self.db[config['MAID_INSTALLED_COLLECTION']].delete_many({'channel_id': channel_id})
-		self.state.remove_installed_hooks(channel_id)
+			await self._installations.delete(channel_id)
+			await self._evict_hooks(channel_id)
+			self._synced_at.remove(channel_id)
 
 		await interaction.edit_original_response(
 			content = self._trans(ctx, 'succ-uninst')
@@ -214,15 +617,19 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		Some commands are designed to respond as a character chosen randomly, \
 		and these setting commands are here to manipulate the weight of appearances (in this channel) \
 		of {bot} and the maids.
-		Note that by default, the weight is 1 to all characters.
+		Note that by default, the weight is 1 to all characters, \
+		and the server OPs can change the default weights of the server.
 		Also, DM channels does not have maids (webhooks) and those commands \
 		using maids only responds as {bot} herself.
 		Can be only called in a server channel.
 		'''
 	)
 
-	def fetch_weight(self, channel: discord.abc.GuildChannel):
-		return Weight(self.bot, channel)
+	async def fetch_weight(self, channel: discord.abc.GuildChannel) -> Weight:
+		return await self._weights.get(channel)
+
+	async def fetch_guild_weight(self, guild: discord.Guild) -> GuildWeight:
+		return await self._weights.get_guild(guild)
 
 	@maid_setting.command(
 		name = 'get',
@@ -248,7 +655,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if maid_name != '' and maid_name not in self.maids:
 			raise MaidNotFound(maid_name)
 
-		w = self.fetch_weight(get_guild_channel(ctx.channel))
+		w = await self.fetch_weight(await resolve_guild_channel(ctx.channel))
 		embed = discord.Embed(title = self._trans(ctx, 'weight'), color = discord.Color.blue())
 		if maid_name == '':
 			# All character
@@ -276,7 +683,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel)
 
-		w = self.fetch_weight(get_guild_channel(ctx.channel))
+		w = await self.fetch_weight(await resolve_guild_channel(ctx.channel))
 		embed = discord.Embed(title = self._trans(ctx, 'weight'), color = discord.Color.blue())
 		embed.add_field(
 			name = self._trans(ctx, 'myself', format = {'bot': get_bot_name_in_ctx(ctx)}),
@@ -312,7 +719,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if maid_name not in self.maids:
 			raise MaidNotFound(maid_name)
 
-		w = self.fetch_weight(get_guild_channel(ctx.channel))
+		w = await self.fetch_weight(await resolve_guild_channel(ctx.channel))
 		w.set_maid_weight(maid_name, weight)
 
 		embed = discord.Embed(title = self._trans(ctx, 'weight-set'), color = discord.Color.green())
@@ -340,7 +747,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel)
 
-		w = self.fetch_weight(get_guild_channel(ctx.channel))
+		w = await self.fetch_weight(await resolve_guild_channel(ctx.channel))
 		w.set_bot_weight(weight)
 
 		embed = discord.Embed(title = self._trans(ctx, 'weight-set'), color = discord.Color.green())
@@ -350,6 +757,76 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 
 		await ctx.send_response(embed = embed)
 
+	@maid_setting.command(
+		name = 'set-default',
+		description = 'Set the default weight of appearances of the maids in this server.',
+		default_member_permissions = admin_only,
+		options = [
+			discord.Option(str,
+				name = 'maid',
+				description = 'Choose maid',
+				autocomplete = autocomplete_get_maid_names),
+			discord.Option(int,
+				name = 'weight',
+				description = 'Input the weight of appearances (a non-negative integer)',
+				min_value = 0)
+		]
+	)
+	async def weight_set_default(self, ctx: discord.ApplicationContext, maid_name: str, weight: int):
+		'''
+		`/{cmd_name} <maid name> <weight>` sets the default weight of appearances of a maid in this server.
+		Channels that have not set the weight of the maid follow the default.
+		This command is for OPs only.
+		Can be only called in a server channel.
+		'''
+		if TYPE_CHECKING:
+			assert isinstance(ctx.channel, GuildChannel) and ctx.guild is not None
+
+		maid_name = trim(maid_name)
+		if maid_name not in self.maids:
+			raise MaidNotFound(maid_name)
+
+		w = await self.fetch_guild_weight(ctx.guild)
+		w.set_maid_weight(maid_name, weight)
+
+		embed = discord.Embed(title = self._trans(ctx, 'weight-set'), color = discord.Color.green())
+		embed.add_field(name = self._trans(ctx, 'succ-weight-set'),
+			value = self._trans(ctx, 'succ-weight-set-default-value', format = {'name': maid_name, 'weight': weight})
+		)
+
+		await ctx.send_response(embed = embed)
+
+	@maid_setting.command(
+		name = 'set-default-bot',
+		description = 'Set the default weight of appearances of the bot in this server.',
+		default_member_permissions = admin_only,
+		options = [
+			discord.Option(int,
+				name = 'weight',
+				description = 'Input the weight of appearances (a non-negative integer)',
+				min_value = 0)
+		]
+	)
+	async def weight_set_default_bot(self, ctx: discord.ApplicationContext, weight: int):
+		'''
+		`/{cmd_name} <weight>` sets the default weight of appearances of {bot} in this server.
+		Channels that have not set the weight of {bot} follow the default.
+		This command is for OPs only.
+		Can be only called in a server channel.
+		'''
+		if TYPE_CHECKING:
+			assert isinstance(ctx.channel, GuildChannel) and ctx.guild is not None
+
+		w = await self.fetch_guild_weight(ctx.guild)
+		w.set_bot_weight(weight)
+
+		embed = discord.Embed(title = self._trans(ctx, 'weight-set'), color = discord.Color.green())
+		embed.add_field(name = self._trans(ctx, 'succ-weight-set'),
+			value = self._trans(ctx, 'succ-weight-set-default-bot-value', format = {'bot': get_bot_name_in_ctx(ctx), 'weight': weight})
+		)
+
+		await ctx.send_response(embed = embed)
+
 	@discord.slash_command(
 		description = 'Introduce the maids',
 		guild_only = True,
@@ -371,7 +848,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel)
 
-		await self.fetch_maids(get_guild_channel(ctx.channel))
+		await self.fetch_maids(await resolve_guild_channel(ctx.channel))
 
 		maid_name = trim(maid_name)
 
@@ -518,11 +995,12 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 
 	class _SpeakModal(discord.ui.Modal):
 		# Add outer to enable localization of the cog. Maybe it is awful.
-		def __init__(self, outer: BasicCommands, locale: Optional[str], webhook: Optional[discord.Webhook] = None, *args, **kwargs):
+		def __init__(self, outer: BasicCommands, locale: Optional[str], webhook: Optional[discord.Webhook] = None, refresh = None, *args, **kwargs):
 			super().__init__(title = outer._trans(locale, 'speak-modal-title'), *args, **kwargs)
 			self._trans = outer._trans
 			self.locale = locale
 			self.webhook = webhook
+			self.refresh = refresh
 
 			self.add_item(discord.ui.InputText(label = self._trans(locale, 'speak-modal-label'), style = discord.InputTextStyle.long))
 
@@ -540,8 +1018,7 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 				)
 				return
 
-			await interaction.response.defer()
-			await send_as(interaction, self.webhook, text)
+			await deliver(interaction, self.webhook, text, refresh = self.refresh, ack = self._trans(self.locale, 'delivered'))
 
 	@discord.slash_command(
 		description = 'Send a message as the bot or a maid',
@@ -573,21 +1050,24 @@ class BasicCommands(BaseCog, name = 'Base', elementary = True):
 		if TYPE_CHECKING:
 			assert isinstance(ctx.channel, GuildChannel) and ctx.channel_id is not None
 
-		await self.fetch_maids(get_guild_channel(ctx.channel))
+		channel = await resolve_guild_channel(ctx.channel)
+		await self.fetch_maids(channel)
 
 		maid_name = trim(maid_name)
 		if maid_name != '' and maid_name not in self.maids:
 			raise MaidNotFound(maid_name)
 
-		installed_hooks = self.state.get_installed_hooks(ctx.channel_id)
+		# The maids are installed in the parent channel if this is a thread
+		installed_hooks = self.state.get_installed_hooks(channel.id)
 		assert installed_hooks is not None # We have called fetch_maids so this should be true
 		webhook = installed_hooks.get(maid_name, None)
 
+		refresh = self.maid_refresher(channel, maid_name, webhook)
 		if len(text) == 0:
-			await ctx.send_modal(self._SpeakModal(self, ctx.locale, webhook))
+			await ctx.send_modal(self._SpeakModal(self, ctx.locale, webhook, refresh))
 		else:
-			await remove_thinking(ctx)
-			await send_as(ctx, webhook, text)
+			# Not responded by the bot directly, or everyone sees who used the command
+			await deliver(ctx, webhook, text, refresh = refresh, ack = self._trans(ctx, 'delivered'))
 
 __all__ = ['BasicCommands']
 
@@ -8,7 +8,7 @@ from importlib.resources import files
 from reader import load
 from typing import Any, ClassVar, Optional, TYPE_CHECKING
 from .basebot import Bot
-from .exception import DependentCogNotLoaded, MaidNotFound
+from .exception import DependentCogNotLoaded, MaidNotFound, ParentChannelNotFound
 from .helper import get_help, update_help
 from .typing import Localeable, QuasiContext
 from .utils import *
@@ -124,7 +124,7 @@ class BaseCog(discord.Cog, metaclass = BaseCogMeta, elementary = True):
 
 		super().__init__()
 		self.bot = bot
-		self.db = bot.db
+		self.storage = bot.storage
 		self.maids = bot.maids
 		self.state = bot.state
 
@@ -135,6 +135,12 @@ class BaseCog(discord.Cog, metaclass = BaseCogMeta, elementary = True):
 				value = self._trans(ctx, 'no-maid-value', format = {'maid_name': exception.falsy_maid_name}),
 				ephemeral = True
 			)
+		elif isinstance(exception, ParentChannelNotFound):
+			await send_error_embed(ctx,
+				name = self._trans(ctx, 'no-parent'),
+				value = self._trans(ctx, 'no-parent-value'),
+				ephemeral = True
+			)
 		else:
 			# Propagate
 			raise exception
@@ -0,0 +1,178 @@
+'''
+This module defines CachedDocuments, a read-through cache over a DocumentRepository.
+The values built from the documents are kept in a namespace of State, which bounds them by
+its capacity, ttl and idle limits. Writes go either through WriteBehind (write-behind) or
+straight to the repository (write-through). A load checks the writes not done yet before the db,
+so an evicted value never comes back stale.
+If the builder returns None for a missing document and `negative_ttl` is positive,
+the key is remembered as missing for that long and the db is not asked again.
+Every cache counts its hits, misses and load latency; see `cache_stats()`.
+'''
+from __future__ import annotations
+from collections.abc import Callable, Hashable
+from time import monotonic
+from typing import Any, Generic, Optional, TypeVar, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from .basebot import Bot
+	from .state import Namespace
+	from .storage import Document, DocumentRepository
+	from .writebehind import WriteBehind
+
+K = TypeVar('K', bound = Hashable)
+V = TypeVar('V')
+
+Builder = Callable[[K, Optional['Document']], Optional[V]]
+
+class CacheStats:
+	def __init__(self):
+		self.hits = 0
+		self.negative_hits = 0
+		self.misses = 0
+		self.load_time = 0.0
+		self.max_load_time = 0.0
+
+	def record_load(self, elapsed: float):
+		self.misses += 1
+		self.load_time += elapsed
+		self.max_load_time = max(self.max_load_time, elapsed)
+
+	def to_dict(self) -> dict[str, Any]:
+		requests = self.hits + self.negative_hits + self.misses
+		return {
+			'hits': self.hits,
+			'negative_hits': self.negative_hits,
+			'misses': self.misses,
+			'hit_ratio': (self.hits + self.negative_hits) / requests if requests > 0 else 0.0,
+			'avg_load_ms': self.load_time / self.misses * 1000 if self.misses > 0 else 0.0,
+			'max_load_ms': self.max_load_time * 1000,
+		}
+
+# Every cache created in the process, by the name of the namespace
+_caches: dict[str, CachedDocuments] = {}
+
+class CachedDocuments(Generic[K, V]):
+	def __init__(self,
+		bot: Bot,
+		repo: DocumentRepository,
+		values: Namespace[K, V],
+		build: Builder[K, V],
+		*,
+		write_behind: bool = True,
+		interval: float = 5.0,
+		batch_size: int = 100,
+		negative_ttl: float = 0):
+
+		self.repo = repo
+		self.values = values
+		self._build = build
+		self._writer: Optional[WriteBehind] = bot.get_write_behind(repo, interval = interval, batch_size = batch_size) if write_behind else None
+		# Bounded like the values, so many missing keys cannot grow it forever
+		self._missing: Optional[Namespace[K, bool]] = None
+		if negative_ttl > 0:
+			self._missing = bot.state.namespace(f'{values.name}_missing', capacity = values.capacity, ttl = negative_ttl)
+		self.stats = CacheStats()
+		_caches[values.name] = self
+
+	def __contains__(self, key: K) -> bool:
+		return key in self.values
+
+	def __len__(self) -> int:
+		return len(self.values)
+
+	def peek(self, key: K) -> Optional[V]:
+		# The cached value only, never loaded
+		return self.values.get(key)
+
+	def _lookup(self, key: K) -> tuple[bool, Optional[V]]:
+		# (whether the cache answers, the value)
+		value = self.values.get(key)
+		if value is not None:
+			self.stats.hits += 1
+			return (True, value)
+		if self._missing is not None and self._missing.get(key):
+			self.stats.negative_hits += 1
+			return (True, None)
+		return (False, None)
+
+	def _pending(self, key: K) -> tuple[bool, Optional[Document]]:
+		if self._writer is None:
+			return (False, None)
+		return self._writer.pending(key)
+
+	def _store(self, key: K, document: Optional[Document], build: Optional[Builder[K, V]]) -> Optional[V]:
+		value = (build or self._build)(key, document)
+		if value is not None:
+			self.values.set(key, value)
+		elif self._missing is not None:
+			self._missing.set(key, True)
+		return value
+
+	async def get(self, key: K, build: Optional[Builder[K, V]] = None) -> Optional[V]:
+		'''
+		The value of the key, loaded and built on a miss.
+		`build` replaces the builder of the cache for this call, e.g. when it needs more than the document.
+		Concurrent misses of the same key share one load.
+		'''
+		answered, value = self._lookup(key)
+		if answered:
+			return value
+
+		async with self.values.lock(key):
+			# Someone may have loaded it meanwhile, whose copy may have been changed already
+			answered, value = self._lookup(key)
+			if answered:
+				return value
+
+			started = monotonic()
+			found, document = self._pending(key)
+			if not found:
+				document = await self.repo.find(key)
+			self.stats.record_load(monotonic() - started)
+			return self._store(key, document, build)
+
+	def get_sync(self, key: K, build: Optional[Builder[K, V]] = None) -> Optional[V]:
+		# For the code that cannot await (codecs and startup), which blocks on a miss
+		answered, value = self._lookup(key)
+		if answered:
+			return value
+
+		started = monotonic()
+		found, document = self._pending(key)
+		if not found:
+			document = self.repo.find_sync(key)
+		self.stats.record_load(monotonic() - started)
+		return self._store(key, document, build)
+
+	def set(self, key: K, value: V):
+		# Cache a value created without the db, e.g. a new one
+		self.values.set(key, value)
+		if self._missing is not None:
+			self._missing.remove(key)
+
+	def invalidate(self, key: K):
+		self.values.remove(key)
+		if self._missing is not None:
+			self._missing.remove(key)
+
+	def mark(self, key: K, document: Optional[Document]):
+		# Write-behind: written back later in a batch; write-through caches must use put()
+		if self._writer is None:
+			raise RuntimeError(f'{self.values.name} is a write-through cache')
+		if self._missing is not None:
+			self._missing.remove(key)
+		self._writer.mark(key, document)
+
+	async def put(self, key: K, document: Optional[Document]):
+		# Write the document in either mode; None deletes it
+		if self._writer is not None:
+			self.mark(key, document)
+			return
+		if self._missing is not None:
+			self._missing.remove(key)
+		await self.repo.write_many({key: document})
+
+def cache_stats() -> list[tuple[str, dict[str, Any]]]:
+	return [(name, cache.stats.to_dict()) for name, cache in _caches.items()]
+
+__all__ = ['CacheStats', 'CachedDocuments', 'cache_stats']
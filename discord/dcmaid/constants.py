@@ -1,4 +1,5 @@
 '''
 This file defines constants that is controlled by Discord API instead of the bot developpers.
 '''
-MAX_FIELDS_IN_EMBED: int = 25
\ No newline at end of file
+MAX_FIELDS_IN_EMBED: int = 25
+MAX_WEBHOOKS_IN_CHANNEL: int = 15
\ No newline at end of file
@@ -0,0 +1,97 @@
+'''
+This module defines a local store of webhook credentials (id and token) of the installed maids.
+We don't store webhook tokens in our db, so without the store, every process start has to
+list the webhooks of a channel before any maid there can speak.
+The file is encrypted with Fernet, so the key (from the environment) is needed to read it.
+'''
+from __future__ import annotations
+import asyncio
+import json
+import os
+from asyncio import get_running_loop
+from collections.abc import Mapping
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	import discord
+
+# maid name: [webhook id, webhook token, maid digest, [[pooled webhook id, token], ...]]
+Credentials = dict[str, list]
+
+class CredentialStore:
+	def __init__(self, path: str, key: str, delay: float = 1.0):
+		# cryptography is only needed when the store is enabled
+		from cryptography.fernet import Fernet
+
+		if not key:
+			raise ValueError('A key is needed to enable the credential store')
+		self.path = path
+		self.delay = delay
+		self._fernet = Fernet(key.encode())
+		self._d: dict[int, Credentials] = {}
+		self._save_task: Optional[asyncio.Task] = None
+
+	def load(self):
+		from cryptography.fernet import InvalidToken
+
+		try:
+			with open(self.path, 'rb') as f:
+				data = json.loads(self._fernet.decrypt(f.read()))
+		except (OSError, InvalidToken, ValueError):
+			# No store, a broken one or another key, so start cold
+			return
+		self._d = {int(channel_id): credentials for channel_id, credentials in data.items()}
+
+	def get(self, channel_id: int) -> Optional[Credentials]:
+		return self._d.get(channel_id)
+
+	def set(self, channel_id: int, hooks: Mapping[str, discord.Webhook], digests: Mapping[str, str], pools: Optional[Mapping[str, tuple[discord.Webhook, ...]]] = None):
+		credentials = {
+			maid_name: [webhook.id, webhook.token, digests[maid_name], [[w.id, w.token] for w in (pools or {}).get(maid_name, ())]]
+			for maid_name, webhook in hooks.items()
+		}
+		if self._d.get(channel_id) != credentials:
+			self._d[channel_id] = credentials
+			self._schedule_save()
+
+	def remove(self, channel_id: int):
+		if self._d.pop(channel_id, None) is not None:
+			self._schedule_save()
+
+	def _schedule_save(self):
+		# The changes in a short while are saved together
+		try:
+			loop = get_running_loop()
+		except RuntimeError:
+			self.save()
+			return
+
+		if self._save_task is None or self._save_task.done():
+			self._save_task = loop.create_task(self._delayed_save())
+
+	async def _delayed_save(self):
+		await asyncio.sleep(self.delay)
+		data = self._dumps()
+		await get_running_loop().run_in_executor(None, self._write, data)
+
+	def _dumps(self) -> bytes:
+		return self._fernet.encrypt(json.dumps(self._d, separators = (',', ':')).encode())
+
+	def _write(self, data: bytes):
+		tmp = f'{self.path}.tmp'
+		fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with open(fd, 'wb') as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.path)
+
+	def save(self):
+		self._write(self._dumps())
+
+	async def close(self):
+		if self._save_task is not None and not self._save_task.done():
+			self._save_task.cancel()
+		await get_running_loop().run_in_executor(None, self.save)
+
+__all__ = ['CredentialStore']
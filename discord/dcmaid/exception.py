@@ -10,4 +10,9 @@ class DependentCogNotLoaded(Exception):
 class MaidNotFound(discord.ApplicationCommandError):
 	def __init__(self, falsy_maid_name):
 		super().__init__()
-		self.falsy_maid_name = falsy_maid_name
\ No newline at end of file
+		self.falsy_maid_name = falsy_maid_name
+
+class ParentChannelNotFound(discord.ApplicationCommandError):
+	def __init__(self, channel_id: int):
+		super().__init__(f'The parent channel {channel_id} is not available.')
+		self.channel_id = channel_id
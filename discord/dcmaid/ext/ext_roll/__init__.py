@@ -1,12 +1,13 @@
 from __future__ import annotations
 import discord
 from case_insensitive_dict import CaseInsensitiveDict
-from collections.abc import Mapping, MutableMapping
+from collections.abc import Awaitable, Callable, Mapping, MutableMapping
 from rollgames import BaseRollGame, BaseRollGameMeta
 from types import MappingProxyType
 from typing import Optional, TYPE_CHECKING
 from ...typing import QuasiContext
-from ...utils import get_author, send_as, int_to_emoji
+from ...response import deliver
+from ...utils import get_author, int_to_emoji
 
 _registered_games: MutableMapping[str, DiscordRollGameMeta] = CaseInsensitiveDict()
 
@@ -37,6 +38,9 @@ class DiscordRollGameMeta(BaseRollGameMeta):
 		return cls
 
 class DiscordRollGame(BaseRollGame, metaclass = DiscordRollGameMeta):
+	# Set by the cog; called to get a new webhook when the current one is gone
+	refresh_webhook: Optional[Callable[[], Awaitable[Optional[discord.Webhook]]]] = None
+
 	def __init__(self, ctx: discord.Message | QuasiContext, webhook, arguments: Optional[str], initial_text = None, send_options = {}):
 		self.ctx = ctx
 		self.webhook = webhook
@@ -66,7 +70,18 @@ class DiscordRollGame(BaseRollGame, metaclass = DiscordRollGameMeta):
 		elif self.for_text_cmd:
 			if self.player is not None:
 				content = f'<@{self.player.id}>\n{content}'
-		await send_as(self.ctx, self.webhook, content, **self.send_options)
+		await deliver(self.ctx, self.webhook, content,
+			refresh = self._refresh if self.refresh_webhook is not None else None,
+			# Replies to text commands may be merged when the channel is busy
+			coalesce = self.for_text_cmd,
+			**self.send_options
+		)
+
+	async def _refresh(self):
+		assert self.refresh_webhook is not None
+		# Later messages of the game use the new one as well
+		self.webhook = await self.refresh_webhook()
+		return self.webhook
 
 class DiscordDigitRollGame(DiscordRollGame):
 	async def _process(self, i: int):
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import asyncio
 import discord
 from discord.ext.pages import Paginator
 from importlib import import_module
@@ -15,8 +16,9 @@ from ..basebot import Bot
 from ..basecog import BaseCog
 from ..constants import MAX_FIELDS_IN_EMBED
 from ..helper import set_help
-from ..mixin import MaidMixin, RandomMixin
+from ..mixin import MaidMixin, RandomMixin, needs, NEED_RANDOM, NEED_WEBHOOKS, NEED_WEIGHTS
 from ..perm import admin_only
+from ..response import acknowledge
 from ..typing import QuasiContext
 from ..utils import *
 
@@ -32,7 +34,16 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 		self._help_pages: dict[Optional[str], Paginator] = {}
 
 	async def cog_before_invoke(self, ctx):
-		await self._cog_before_invoke(ctx)
+		# Only what the command declares with needs() is prepared
+		results = await asyncio.gather(self._cog_before_invoke(ctx), self._cog_before_invoke_random(ctx), return_exceptions = True)
+		for result in results:
+			if isinstance(result, BaseException):
+				# The command will not run, and neither will cog_after_invoke
+				await self._release_random_generator(ctx)
+				raise result
+
+	async def cog_after_invoke(self, ctx):
+		await self._cog_after_invoke_random(ctx)
 
 	@staticmethod
 	def _list_message(l: Iterable[Any]):
@@ -64,6 +75,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 				default = None)
 		]
 	)
+	@needs(NEED_RANDOM)
 	async def seed(self, ctx: discord.ApplicationContext, seed: Optional[str]):
 		'''
 		`/seed <?seed>` sets the seed number of the random generator for the guild channel.
@@ -89,10 +101,9 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 	)
 
 	async def _dist(self, ctx: QuasiContext, results: Iterable[Any], tran_key: str, /, **kwargs):
-		await remove_thinking(ctx)
 		message = self._build_box_message(ctx, tran_key, results, **kwargs)
-		maid = self._random_maid(ctx)
-		await self._send_followup(ctx, maid, message)
+		maid = await self._random_maid(ctx)
+		await self._deliver(ctx, maid, message)
 
 	@distribution.command(
 		description = 'Uniform destribution',
@@ -108,6 +119,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 			_exec_time_option
 		]
 	)
+	@needs(NEED_WEBHOOKS, NEED_WEIGHTS, NEED_RANDOM)
 	async def uniform(self, ctx: discord.ApplicationContext, a: float, b: float, n: int):
 		'''
 		`/{cmd_name} <?lower> <?upper> <?number>` generates `n` random numbers
@@ -115,7 +127,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 
 		By default, `lower = 0`, `upper = 1`, `number = 1`.
 		'''
-		results = (self._get_random_generator(ctx).uniform(a, b) for _ in range(n))
+		results = self._get_random_generator(ctx).uniforms(a, b, n)
 		await self._dist(ctx, results, 'dist-uniform', lower = a, upper = b, n = n)
 
 	@distribution.command(
@@ -132,6 +144,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 			_exec_time_option
 		]
 	)
+	@needs(NEED_WEBHOOKS, NEED_WEIGHTS, NEED_RANDOM)
 	async def randint(self, ctx: discord.ApplicationContext, a: int, b: int, n: int):
 		'''
 		`/{cmd_name} <?lower> <?upper> <?number>` generates `n` random integers
@@ -139,7 +152,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 
 		By default, `lower = 0`, `upper = 1`, `number = 1`.
 		'''
-		results = (self._get_random_generator(ctx).randint(a, b) for _ in range(n))
+		results = self._get_random_generator(ctx).randints(a, b, n)
 		await self._dist(ctx, results, 'dist-randint', lower = a, upper = b, n = n)
 
 	@distribution.command(
@@ -160,6 +173,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 			_exec_time_option
 		]
 	)
+	@needs(NEED_WEBHOOKS, NEED_WEIGHTS, NEED_RANDOM)
 	async def triangular(self, ctx: discord.ApplicationContext, a: float, m: float, b: float, n: int):
 		'''
 		`/{cmd_name} <?lower> <?upper> <?number>` generates `n` random numbers
@@ -167,7 +181,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 
 		By default, `lower = 0`, `mode = 0.5`, `upper = 1`, `number = 1`.
 		'''
-		results = (self._get_random_generator(ctx).triangular(a, b, m) for _ in range(n))
+		results = self._get_random_generator(ctx).triangulars(a, b, m, n)
 		await self._dist(ctx, results, 'dist-triangular', lower = a, mode = m, upper = b, n = n)
 
 	async def beta(self, ctx: discord.ApplicationContext, a: float, b: float, n: int):
@@ -312,7 +326,12 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 			args = value.split('\n')
 			arguments = StringArgumentParser.rebuild(args)
 
-			await self.outer._play(interaction, self.game_cls, arguments)
+			# The command has published the generator already, so the game does it again as on_message
+			await self.outer._prepare_random_generator(interaction)
+			try:
+				await self.outer._play(interaction, self.game_cls, arguments)
+			finally:
+				await self.outer._publish_random_generator(interaction)
 
 	@game_group.command(
 		description = 'Play the game',
@@ -326,6 +345,7 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 				default = None)
 		]
 	)
+	@needs(NEED_WEBHOOKS, NEED_WEIGHTS, NEED_RANDOM)
 	async def play(self, ctx: discord.ApplicationContext, game_name: str, arguments: Optional[str]):
 		'''
 		`/{cmd_name} <game name> <args>` play a game with given arguments.
@@ -348,8 +368,8 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 
 	async def _play(self, ctx: discord.Message | QuasiContext, game_cls: ext_roll.DiscordRollGameMeta, arguments: Optional[str]):
 		game_data = game_cls.game_data
-		maid = self._random_maid(ctx)
-		webhook = await self._get_webhook_by_name(ctx, maid)
+		maid = await self._random_maid(ctx)
+		webhook = self._pick_webhook(ctx, maid, await self._get_webhook_by_name(ctx, maid))
 		if isinstance(ctx, discord.Message):
 			# Text command
 			try:
@@ -378,8 +398,9 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 			except ATE as e:
 				raise ArgumentTypeError(e.order, e.t, e.got)
 
-			await remove_thinking(ctx)
-
+		game.refresh_webhook = self._get_webhook_refresher(ctx, maid, webhook)
+		# Acknowledged before the game runs, since a slow game may miss the deadline of the interaction
+		await acknowledge(ctx, self._trans(ctx, 'delivered'))
 		await game.run()
 
 	def load_game_ext(self, ext: str):
@@ -411,7 +432,13 @@ class RollCommands(BaseCog, MaidMixin, RandomMixin, name = 'Roll'):
 				return
 
 			game_cls = ext_roll.all_mapping_table[game_name]
-			await self._play(message, game_cls, StringArgumentParser.rebuild(args[1:]))
+			if isinstance(message.channel, discord.abc.GuildChannel | discord.Thread):
+				self.bot.record_activity(message.channel)
+			await self._prepare_random_generator(message)
+			try:
+				await self._play(message, game_cls, StringArgumentParser.rebuild(args[1:]))
+			finally:
+				await self._publish_random_generator(message)
 
 class ArgumentLengthError(ALE, discord.ApplicationCommandError):
 	pass
@@ -16,7 +16,7 @@ from itertools import count
 from typing import Literal, Optional, TypeAlias, TYPE_CHECKING
 
 if TYPE_CHECKING:
-	from pymongo.collection import Collection
+	from ..storage import VariableRepository
 	from typing import assert_type
 
 config = generate_config(
@@ -87,11 +87,8 @@ class BookKeeping(dict[calcs.Var, tuple[calcs.Constant, calcs.Constant]]):
 		return self._order
 
 class VariableSystem:
-	def __init__(self, col: Optional[Collection] = None):
-		self.col = col
-
-		if col is not None:
-			col.create_index([('scope_type', 1), ('scope_id', 1), ('name', 1)])
+	def __init__(self, repo: Optional[VariableRepository] = None):
+		self.repo = repo
 
 		self._managed_scopes: dict[int, Scope] = {} # id: Scope
 		self._stored_value: dict[int, tuple[RWLock, dict[str, calcs.Constant]]] = {} # scope_id: (lock, {name: constant})
@@ -115,17 +112,10 @@ class VariableSystem:
 			if not n.startswith('_'):
 				exec(f'{n}=sympy.{n}')
 
-		if self.col is None:
+		if self.repo is None:
 			return
 
-		info = self.col.aggregate([{
-			'$group': {
-				'_id': {'scope_type': '$scope_type', 'scope_id': '$scope_id'},
-				'vars': {'$push': {'name': '$name', 'type': '$type', 'value': '$value'}}
-			}
-		}])
-		for scope_info in info:
-			scope_type, scope_id = scope_info['_id']['scope_type'], scope_info['_id']['scope_id']
+		for scope_type, scope_id, variables in await self.repo.scopes():
 			try:
 				if scope_type == 'user':
 					obj = await discord.utils.get_or_fetch(bot, 'user', scope_id)
@@ -144,7 +134,7 @@ class VariableSystem:
 				d: dict[str, calcs.Constant] = self._stored_value[scope_id][1]
 				r = self._update_record[scope_id]
 
-				for var in scope_info['vars']:
+				for var in variables:
 					name, type, value = var['name'], var['type'], var['value']
 					if type == 'number':
 						try:
@@ -172,7 +162,7 @@ class VariableSystem:
 						pass
 			except (discord.NotFound, discord.Forbidden):
 				# Only drop when the object is unavailable to the bot or disappeared in Discord
-				self.col.delete_many({'scope_type': scope_type, 'scope_id': scope_id})
+				await self.repo.delete_scope(scope_type, scope_id)
 			except:
 				continue
 
@@ -196,7 +186,7 @@ class VariableSystem:
 
 		lock, d = self._stored_value[scope.id]
 
-		with lock.writer:
+		async with lock.writer:
 			if name in self._stored_value[scope.id][1]:
 				# raise ValueError(f'Variable {name} has been declared before!')
 				return False
@@ -204,8 +194,8 @@ class VariableSystem:
 			d[name] = default
 			self._update_record[scope.id][name] = 0
 
-			if self.col is not None:
-				self.col.insert_one(self.scope_to_document(scope) | {'name': name} | self.constant_to_document(default))
+			if self.repo is not None:
+				await self.repo.insert(**self.scope_to_document(scope), name = name, **self.constant_to_document(default))
 
 			return True
 
@@ -243,7 +233,7 @@ class VariableSystem:
 			scopes.append(self.add_scope(ChannelScope(channel)))
 		elif is_not_DM(channel):
 			# channel scope
-			scopes.append(self.add_scope(ChannelScope(get_guild_channel(channel))))
+			scopes.append(self.add_scope(ChannelScope(get_guild_channel_id(channel))))
 			# guild scope
 			scopes.append(self.add_scope(GuildScope(channel.guild)))
 
@@ -306,8 +296,8 @@ class VariableSystem:
 					if isinstance(bookkeeping, BookKeeping):
 						r[name] = bookkeeping.order
 
-					if self.col is not None:
-						self.col.update_one({'scope_id': scope_id, 'name': name}, self.constant_to_document(t))
+					if self.repo is not None:
+						await self.repo.update(scope_id, name, **self.constant_to_document(t))
 
 		return result
 
@@ -346,8 +336,8 @@ class VariableSystem:
 					d.pop(name)
 					r.pop(name)
 
-					if self.col is not None:
-						self.col.delete_one({'scope_id': scope_id, 'name': name})
+					if self.repo is not None:
+						await self.repo.delete(scope_id, name)
 
 		return result
 
@@ -398,7 +388,7 @@ class ToChannelOperator(_ChangeScopeOperator):
 			if TYPE_CHECKING:
 				assert isinstance(ctx.channel, GuildChannel)
 
-			var.scope = ChannelScope(get_guild_channel(ctx.channel))
+			var.scope = ChannelScope(get_guild_channel_id(ctx.channel))
 
 class ToGuildOperator(_ChangeScopeOperator):
 	def _cast_scope(self, var, bot, ctx):
@@ -441,21 +431,21 @@ class VarCommands(BaseCog, name = 'Var'):
 	def __init__(self, bot: Bot):
 		super().__init__(bot)
 		self._parser: calcs.Parser = calcs.give_basic_parser() # ad-hoc
-		self._var_col = bot.db[config['EXT_VAR_DB_COLLECTION']] if config['EXT_VAR_DB_BASED'] else None
-		self._varsystem: VariableSystem = VariableSystem(self._var_col)
+		self._var_repo = bot.storage.variables(config['EXT_VAR_DB_COLLECTION']) if config['EXT_VAR_DB_BASED'] else None
+		self._varsystem: VariableSystem = VariableSystem(self._var_repo)
 
 	@discord.Cog.listener()
 	async def on_ready(self):
 		await self._varsystem.restore_info(self.bot)
 
 	@staticmethod
-	def _check_permission(ctx: discord.Message | QuasiContext, obj, scope: ScopeLiteral):
+	async def _check_permission(ctx: discord.Message | QuasiContext, obj, scope: ScopeLiteral):
 		user = get_author(ctx)
 
 		# Premission check
 		if scope == 'channel' and is_not_DM(obj):
 			assert isinstance(user, discord.Member)
-			p = get_guild_channel(obj).permissions_for(user)
+			p = (await resolve_guild_channel(obj)).permissions_for(user)
 			if not p.manage_channels:
 				if isinstance(obj, discord.Thread):
 					if user.id != obj.owner_id:
@@ -494,7 +484,7 @@ class VarCommands(BaseCog, name = 'Var'):
 		return scope
 
 	@staticmethod
-	def _scope_option_process(ctx: discord.ApplicationContext, scope_option: ScopeOptionLiteral):
+	async def _scope_option_process(ctx: discord.ApplicationContext, scope_option: ScopeOptionLiteral):
 		channel = ctx.channel
 		assert channel is not None
 
@@ -507,7 +497,7 @@ class VarCommands(BaseCog, name = 'Var'):
 				raise NotInGuildError()
 
 			if is_not_DM(channel):
-				return 'channel', get_guild_channel(channel)
+				return 'channel', await resolve_guild_channel(channel)
 			else:
 				return 'channel', channel
 		else:
@@ -547,7 +537,7 @@ class VarCommands(BaseCog, name = 'Var'):
 		`/{cmd_name} <name> <?value> <?scope>` declares a variable with a value in the scope.
 		By default, value is 0 and scope is individual.
 		'''
-		scope, obj = self._scope_option_process(ctx, scope_option)
+		scope, obj = await self._scope_option_process(ctx, scope_option)
 
 		n = await self._declare(ctx, obj, name, value, scope)
 
@@ -555,7 +545,7 @@ class VarCommands(BaseCog, name = 'Var'):
 		await ctx.followup.send(self._trans(ctx, f'declare-success-{self._scope_to_readable(obj, scope)}', format = {'name': name, 'n': s}), ephemeral = (scope != 'user'))
 
 	async def _declare(self, ctx: discord.Message | QuasiContext, obj, name: str, value: str, scope: ScopeLiteral) -> calcs.Constant:
-		self._check_permission(ctx, obj, scope)
+		await self._check_permission(ctx, obj, scope)
 
 		if self._varsystem.exist_var(name, obj):
 			raise RedeclareError(self._scope_to_readable(obj, scope), name)
@@ -595,7 +585,7 @@ class VarCommands(BaseCog, name = 'Var'):
 		`/{cmd_name} <name> <value> <?scope> <?declare>` updates a variable with a value in the scope.
 		By default, scope is individual and auto-declaration is disabled.
 		'''
-		scope, obj = self._scope_option_process(ctx, scope_option)
+		scope, obj = await self._scope_option_process(ctx, scope_option)
 
 		n = await self._assign(ctx, obj, name, value, scope, declare)
 
@@ -621,7 +611,7 @@ class VarCommands(BaseCog, name = 'Var'):
 			# You get here if RedeclareError and e.n is None, and the permission checks are done.
 		else:
 			# If declare, the checks are done already. We only check if not declare.
-			self._check_permission(ctx, obj, scope)
+			await self._check_permission(ctx, obj, scope)
 
 			if not self._varsystem.exist_var(name, obj):
 				raise VarUndefinedError(self._scope_to_readable(obj, scope), name)
@@ -654,13 +644,13 @@ class VarCommands(BaseCog, name = 'Var'):
 		`/{cmd_name} <name> <?scope>` removes a variable in the scope.
 		By default, scope is individual.
 		'''
-		scope, obj = self._scope_option_process(ctx, scope_option)
+		scope, obj = await self._scope_option_process(ctx, scope_option)
 
 		await self._remove(ctx, obj, name, scope)
 		await ctx.send_response(self._trans(ctx, f'remove-success-{self._scope_to_readable(obj, scope)}', format = {'name': name}), ephemeral = (scope != 'user'))
 
 	async def _remove(self, ctx: discord.Message | QuasiContext, obj, name: str, scope: ScopeLiteral):
-		self._check_permission(ctx, obj, scope)
+		await self._check_permission(ctx, obj, scope)
 
 		var = self._varsystem.to_var(name, obj)
 		success = self._varsystem.delete_var(var)
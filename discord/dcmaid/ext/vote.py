@@ -19,7 +19,7 @@ from simple_parsers.string_argument_parser import StringArgumentParser
 from typing import Any, Generic, Optional, overload, Self, TypeVar, TYPE_CHECKING
 
 if TYPE_CHECKING:
-	from pymongo.collection import Collection
+	from ..storage import PollRepository, Vote
 
 config = generate_config(
 	EXT_VOTE_CUSTOM_PREFIX = {'default': 'HMX-vote-cog'},
@@ -319,12 +319,8 @@ class Event:
 	modification: tuple[int, int] # (From, To)
 	processed_order: int
 
-	def to_dict_pair(self) -> tuple[dict, dict]:
-		return {
-			'uuid': self.poll.uuid
-		},{
-			f'vote_casted.{self.member.id}.{self.option}': self.modification[1]
-		}
+	def to_vote(self) -> Vote:
+		return (self.poll.uuid, self.member.id, self.option, self.modification[1])
 
 T = TypeVar('T', bound = BasePoll)
 
@@ -332,22 +328,19 @@ class BaseHoldSystem(Generic[T]):
 	'''
 	Use db column to restore or not...
 	'''
-	def __init__(self, name: str, type: type[T], col: Optional[Collection] = None):
+	def __init__(self, name: str, type: type[T], repo: Optional[PollRepository] = None):
 		self._on_process: dict[uuid_m.UUID, tuple[T, Task, Coroutine]] = {}
 		self.name = name
 		self.type = type
-		self.col = col
-		self._restore_poll_info = []
+		self.repo = repo
 
-		if col is not None:
-			col.create_index([('uuid', 1)])
-			# Restore poll info from database, but this class does not construct
-			# poll objects since the system has no knowledge about the Bot
-			self._restore_poll_info = col.find()
-
-	def restore_poll_info(self):
-		# This method should be called by cogs right after the hold system is created
-		return iter(self._restore_poll_info)
+	async def restore_poll_info(self) -> list[dict[str, Any]]:
+		# Restore poll info from database, but this class does not construct
+		# poll objects since the system has no knowledge about the Bot.
+		# This method should be called by cogs when the bot is ready
+		if self.repo is None:
+			return []
+		return await self.repo.all()
 
 	def _contain(self, poll_or_u: BasePoll | uuid_m.UUID):
 		if isinstance(poll_or_u, BasePoll):
@@ -375,8 +368,8 @@ class BaseHoldSystem(Generic[T]):
 			task = loop.create_task(self.wait_for_timeout(poll))
 			self._on_process[poll.uuid] = (poll, task, Coroutine)
 
-			if self.col is not None and not restore:
-				self.col.insert_one(poll.to_dict())
+			if self.repo is not None and not restore:
+				await self.repo.insert(poll.to_dict())
 
 	async def cancel(self, poll_or_u: T | uuid_m.UUID) -> bool:
 		if isinstance(poll_or_u, BasePoll):
@@ -398,8 +391,8 @@ class BaseHoldSystem(Generic[T]):
 			task.cancel()
 			Coroutine.close()
 
-			if self.col is not None:
-				self.col.delete_one({'uuid': poll.uuid})
+			if self.repo is not None:
+				await self.repo.delete(poll.uuid)
 
 			return True # Canceled by this method
 
@@ -415,17 +408,16 @@ class BaseHoldSystem(Generic[T]):
 			_, _, Coroutine = self._on_process.pop(poll.uuid)
 			poll.processed_order += 1 # To prevent late information update after due
 
-			if self.col is not None:
-				self.col.delete_one({'uuid': poll.uuid})
+			if self.repo is not None:
+				await self.repo.delete(poll.uuid)
 
 			# Coroutine is called after the processed order increased
 			await Coroutine
 
-	def _update_db(self, events: list[Event]):
-		if self.col is not None:
-			for event in events:
-				filter, update = event.to_dict_pair()
-				self.col.update_one(filter, update)
+	async def _update_db(self, events: list[Event]):
+		# The events of a call are written in one round trip
+		if self.repo is not None:
+			await self.repo.set_votes([event.to_vote() for event in events])
 
 	async def add_votes(self, poll: T, member: discord.Member, options: list[str] | Counter[str]) -> Optional[list[Event]]:
 		if not self._contain(poll):
@@ -504,8 +496,8 @@ class BaseHoldSystem(Generic[T]):
 		raise NotImplementedError
 
 class PollHoldSystem(BaseHoldSystem[Poll]):
-	def __init__(self, col = None):
-		super().__init__('poll', Poll, col)
+	def __init__(self, repo = None):
+		super().__init__('poll', Poll, repo)
 
 	def _process_options(self, options: Optional[list[str] | Counter[str]]) -> Optional[Counter[str]]:
 		if options is None:
@@ -542,7 +534,7 @@ class PollHoldSystem(BaseHoldSystem[Poll]):
 				# Update processed_order only if necessary to prevent suppressed update
 				poll.processed_order = processed_order
 
-				self._update_db(events)
+				await self._update_db(events)
 
 		return events
 
@@ -577,7 +569,7 @@ class PollHoldSystem(BaseHoldSystem[Poll]):
 				# Update processed_order only if necessary to prevent suppressed update
 				poll.processed_order = processed_order
 
-				self._update_db(events)
+				await self._update_db(events)
 
 		return events
 
@@ -614,7 +606,7 @@ class PollHoldSystem(BaseHoldSystem[Poll]):
 				# Update processed_order only if necessary to prevent suppressed update
 				poll.processed_order = processed_order
 
-				self._update_db(events)
+				await self._update_db(events)
 
 		return events
 
@@ -1018,17 +1010,17 @@ class VoteCommands(BaseCog, name = 'Vote'):
 	'''
 	def __init__(self, bot: Bot):
 		super().__init__(bot)
-		self._poll_col = bot.db[config['EXT_VOTE_POLL_DB_COLLECTION']] if config['EXT_VOTE_POLL_DB_BASED'] else None
-		self.poll_system = PollHoldSystem(self._poll_col)
-		# self._bet_col = bot.db[config['EXT_VOTE_BET_DB_COLLECTION']] if config['EXT_VOTE_BET_DB_BASED'] else None
-		# self.bet_system = BetHoldSystem(self._bet_col)
+		self._poll_repo = bot.storage.polls(config['EXT_VOTE_POLL_DB_COLLECTION']) if config['EXT_VOTE_POLL_DB_BASED'] else None
+		self.poll_system = PollHoldSystem(self._poll_repo)
+		# self._bet_repo = bot.storage.polls(config['EXT_VOTE_BET_DB_COLLECTION']) if config['EXT_VOTE_BET_DB_BASED'] else None
+		# self.bet_system = BetHoldSystem(self._bet_repo)
 
 	@discord.Cog.listener()
 	async def on_ready(self):
-		if self._poll_col is None:
+		if self._poll_repo is None:
 			return
 
-		for poll_info in self.poll_system.restore_poll_info():
+		for poll_info in await self.poll_system.restore_poll_info():
 			if poll_info['msg'] is None:
 				# Not-registered poll, how is it in db???
 				continue
@@ -1037,7 +1029,7 @@ class VoteCommands(BaseCog, name = 'Vote'):
 				poll = await Poll.from_dict(self.bot, poll_info)
 			except (discord.NotFound, discord.Forbidden):
 				# Drop the poll from the database if the channel/author/message disappeared, or the bot is forbidden
-				self._poll_col.delete_one({'uuid': poll_info['uuid']})
+				await self._poll_repo.delete(poll_info['uuid'])
 				continue
 			except:
 				# Other http exceptions...
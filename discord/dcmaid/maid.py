@@ -1,4 +1,6 @@
 from dataclasses import dataclass
+from functools import cached_property
+from hashlib import sha256
 from typing import Optional
 
 @dataclass
@@ -7,4 +9,11 @@ class Maid:
 	display_name: str
 	avatar: Optional[bytes]
 
+	@cached_property
+	def digest(self) -> str:
+		# Changes whenever what the webhook shows changes
+		h = sha256(self.display_name.encode())
+		h.update(b'\0' if self.avatar is None else b'\1' + self.avatar)
+		return h.hexdigest()
+
 __all__ = ['Maid']
@@ -1,10 +1,13 @@
+import asyncio
 import discord
-import random
 from collections.abc import Mapping
+from contextlib import AsyncExitStack
 from typing import Optional, TYPE_CHECKING
 from .basebot import Bot
 from .basecmd import BasicCommands
-from .state import State
+from .response import deliver
+from .rng import create_generator, RandomGenerator
+from .state import Lease, State
 from .typing import Channelable, GuildChannel, QuasiContext
 from .utils import *
 from .weight import Weight
@@ -12,11 +15,45 @@ from .weight import Weight
 if TYPE_CHECKING:
 	from typing import cast
 
+# What a command can declare with needs()
+NEED_WEBHOOKS = 'webhooks'
+NEED_WEIGHTS = 'weights'
+NEED_RANDOM = 'random'
+
+_needs_attr = '__command_needs__'
+
+def needs(*resources: str):
+	'''
+	Declare the resources (NEED_*) a command uses, so that the mixins prepare only those before it.
+	Put it either above or below the command decorator.
+	A command declaring nothing gets nothing prepared; the helpers still fetch what they need on use.
+	'''
+	def decorator(cmd):
+		setattr(cmd, _needs_attr, frozenset(resources))
+		return cmd
+
+	return decorator
+
+def get_needs(cmd) -> frozenset[str]:
+	if cmd is None:
+		return frozenset()
+	if hasattr(cmd, _needs_attr):
+		return getattr(cmd, _needs_attr)
+	return getattr(getattr(cmd, 'callback', None), _needs_attr, frozenset())
+
+def _retrieve_exception(task: asyncio.Task):
+	# The webhooks may be never awaited if the bot speaks, so don't warn about it
+	if not task.cancelled():
+		task.exception()
+
 class MaidMixin:
 	bot: Bot
 
 	# You need to override cog_before_invoke manually when inherit the mixin
 	async def _cog_before_invoke(self, ctx: discord.ApplicationContext):
+		resources = get_needs(ctx.command)
+		if NEED_WEBHOOKS not in resources and NEED_WEIGHTS not in resources:
+			return
 		if is_DM(ctx.channel):
 			return
 
@@ -25,27 +62,32 @@ class MaidMixin:
 
 		base_cog = self.bot.get_cog('Base')
 		assert isinstance(base_cog, BasicCommands)
-		maid_webhook = await base_cog.fetch_maids(get_guild_channel(ctx.channel))
-		maid_weights = base_cog.fetch_weight(get_guild_channel(ctx.channel))
-		setattr(ctx, 'maid_webhook', maid_webhook)
-		setattr(ctx, 'maid_weights', maid_weights)
+		channel = await resolve_guild_channel(ctx.channel)
+		if NEED_WEBHOOKS in resources:
+			# Not awaited here; the sync (if any) runs along with the command until a maid speaks
+			task = asyncio.create_task(base_cog.fetch_maids(channel))
+			task.add_done_callback(_retrieve_exception)
+			setattr(ctx, 'maid_webhook_task', task)
+		if NEED_WEIGHTS in resources:
+			setattr(ctx, 'maid_weights', await base_cog.fetch_weight(channel))
 
 	async def _get_webhook_by_name(self, ctx: Channelable, maid_name: Optional[str]):
-		if ctx.channel is not None and is_not_DM(ctx.channel):
+		# No need to fetch anything if the bot speaks
+		if maid_name is not None and ctx.channel is not None and is_not_DM(ctx.channel):
 			if hasattr(ctx, 'maid_webhook'):
 				if TYPE_CHECKING:
 					maid_webhook = cast(Mapping[str, discord.Webhook], getattr(ctx, 'maid_webhook'))
 				else:
 					maid_webhook = ctx.maid_webhook
+			elif hasattr(ctx, 'maid_webhook_task'):
+				maid_webhook = await getattr(ctx, 'maid_webhook_task')
+				setattr(ctx, 'maid_webhook', maid_webhook)
 			else:
 				base_cog = self.bot.get_cog('Base')
 				assert isinstance(base_cog, BasicCommands)
-				maid_webhook = await base_cog.fetch_maids(get_guild_channel(ctx.channel))
+				maid_webhook = await base_cog.fetch_maids(await resolve_guild_channel(ctx.channel))
 
-			if maid_name is None:
-				webhook = None
-			else:
-				webhook = maid_webhook.get(maid_name, None)
+			webhook = maid_webhook.get(maid_name, None)
 		else:
 			webhook = None
 
@@ -54,13 +96,42 @@ class MaidMixin:
 	# Since webhooks cannot really reply or followup messages as a bot,
 	# here we simulate those with plain messages whoever the sender is.
 	async def _send_followup(self, ctx: QuasiContext, maid: Optional[str], *args, **kwargs):
-		webhook = await self._get_webhook_by_name(ctx, maid)
-		await send_as(ctx, webhook, *args, **kwargs)
+		webhook = self._pick_webhook(ctx, maid, await self._get_webhook_by_name(ctx, maid))
+		await send_as(ctx, webhook, *args, refresh = self._get_webhook_refresher(ctx, maid, webhook), **kwargs)
+
+	# Like _send_followup, but also acknowledges the interaction in the fewest requests.
+	# Use this instead of remove_thinking() + _send_followup().
+	async def _deliver(self, ctx: QuasiContext, maid: Optional[str], *args, **kwargs):
+		webhook = self._pick_webhook(ctx, maid, await self._get_webhook_by_name(ctx, maid))
+		kwargs.setdefault('ack', self._trans(ctx, 'delivered'))
+		await deliver(ctx, webhook, *args, refresh = self._get_webhook_refresher(ctx, maid, webhook), **kwargs)
+
+	def _pick_webhook(self, ctx: Channelable, maid_name: Optional[str], webhook: Optional[discord.Webhook]) -> Optional[discord.Webhook]:
+		# Spread the messages of busy channels over the webhook pool of the maid
+		if maid_name is None or webhook is None or ctx.channel is None or is_DM(ctx.channel):
+			return webhook
 
-	def _random_maid(self, ctx: Channelable):
+		base_cog = self.bot.get_cog('Base')
+		assert isinstance(base_cog, BasicCommands)
+		return base_cog.pick_webhook(get_guild_channel_id(ctx.channel), maid_name, webhook)
+
+	def _get_webhook_refresher(self, ctx: Channelable, maid_name: Optional[str], webhook: Optional[discord.Webhook]):
+		# The `refresh` argument of send_as(), which syncs the maids again if the webhook is gone
+		if maid_name is None or webhook is None or ctx.channel is None or is_DM(ctx.channel):
+			return None
+
+		base_cog = self.bot.get_cog('Base')
+		assert isinstance(base_cog, BasicCommands)
+		# The parent of a thread is resolved only if the refresher is called
+		return base_cog.maid_refresher(ctx.channel, maid_name, webhook)
+
+	async def _random_maid(self, ctx: Channelable) -> Optional[str]:
 		# If RandomMixin is not installed, Weight will use the built-in random generator.
+		return (await self._random_maids(ctx, 1))[0]
+
+	async def _random_maids(self, ctx: Channelable, n: int) -> list[Optional[str]]:
+		# Draw n speakers in one call. None stands for the bot.
 		if ctx.channel is not None and is_not_DM(ctx.channel):
-			maid = None
 			maid_weights = None
 
 			if TYPE_CHECKING:
@@ -75,41 +146,31 @@ class MaidMixin:
 			else:
 				base_cog = self.bot.get_cog('Base')
 				assert isinstance(base_cog, BasicCommands)
-				maid_weights = base_cog.fetch_weight(get_guild_channel(ctx.channel))
+				maid_weights = await base_cog.fetch_weight(await resolve_guild_channel(ctx.channel))
 
 			if isinstance(self, RandomMixin):
-				maid = maid_weights.random_get(self._get_random_generator(ctx))
+				return maid_weights.random_get_many(n, self._get_random_generator(ctx))
 			else:
-				maid = maid_weights.random_get()
-
-			return maid
+				return maid_weights.random_get_many(n)
 		else:
-			return None
+			return [None] * n
 
 class RandomMixin:
+	bot: Bot
 	state: State
-	__state_random_key__ = 'random_generator_{}'
 
-	def _get_random_generator(self, ctx: Channelable) -> random.Random:
+	def _get_random_generator(self, ctx: Channelable) -> RandomGenerator:
 		channel = ctx.channel
 
 		if channel is not None and is_not_DM(channel):
-			channel = get_guild_channel(channel)
-			if TYPE_CHECKING:
-				generator = cast(random.Random, self.state.get(self.__state_random_key__.format(channel.id)))
-			else:
-				generator = self.state.get(self.__state_random_key__.format(channel.id))
-
-			if generator is None:
-				generator = random.Random()
-				self.state.set(self.__state_random_key__.format(channel.id), generator)
+			generator = self.bot.generators.get(get_guild_channel_id(channel))
 		else:
 			if not hasattr(self, '_common_random'):
-				generator = random.Random()
+				generator = create_generator()
 				setattr(self, '_common_random', generator) # Used in DM
 			else:
 				if TYPE_CHECKING:
-					generator = cast(random.Random, getattr(self, '_common_random'))
+					generator = cast(RandomGenerator, getattr(self, '_common_random'))
 				else:
 					generator = self._common_random
 
@@ -117,6 +178,60 @@ class RandomMixin:
 
 	def _set_seed(self, ctx: Channelable, seed: Optional[str]):
 		if ctx.channel is not None and is_not_DM(ctx.channel):
-			channel = get_guild_channel(ctx.channel)
-			generator = random.Random(seed)
-			self.state.set(self.__state_random_key__.format(channel.id), generator)
+			self.bot.generators.seed(get_guild_channel_id(ctx.channel), seed)
+
+	# With a shared State backend, the generator of a channel is read from the backend
+	# before a command and written back after it, so every process continues the same sequence.
+	# The lease of the channel is held in between, so two processes never draw from the same state.
+	# Call them in cog_before_invoke and cog_after_invoke (the latter is called even if the command fails),
+	# or call _release_random_generator if the command never runs after prepared.
+	# They also load the generator from the db and save it back (if RNG_PERSIST is on).
+	def _random_leases(self) -> dict[int, tuple[AsyncExitStack, Lease]]:
+		# id(ctx): the lease held by the invocation
+		if not hasattr(self, '_random_lease_stacks'):
+			setattr(self, '_random_lease_stacks', {})
+		return getattr(self, '_random_lease_stacks')
+
+	async def _prepare_random_generator(self, ctx: Channelable):
+		if ctx.channel is not None and is_not_DM(ctx.channel):
+			channel_id = get_guild_channel_id(ctx.channel)
+			stack = AsyncExitStack()
+			lease = await stack.enter_async_context(self.state.lease('random_generator', channel_id))
+			try:
+				await self.state.random_generator.fetch(channel_id)
+				# Restore the saved one if this process does not have it
+				await self.bot.generators.load(channel_id)
+			except:
+				await stack.aclose()
+				raise
+			self._random_leases()[id(ctx)] = (stack, lease)
+
+	async def _publish_random_generator(self, ctx: Channelable):
+		if ctx.channel is not None and is_not_DM(ctx.channel):
+			try:
+				channel_id = get_guild_channel_id(ctx.channel)
+				generator = self.state.random_generator.get(channel_id)
+				held = self._random_leases().get(id(ctx))
+				if held is not None and held[1].lost:
+					# Another process may be drawing from the generator now
+					return
+				if generator is not None:
+					self.bot.generators.save(channel_id)
+					await self.state.random_generator.publish(channel_id, generator)
+			finally:
+				await self._release_random_generator(ctx)
+
+	async def _release_random_generator(self, ctx: Channelable):
+		held = self._random_leases().pop(id(ctx), None)
+		if held is not None:
+			await held[0].aclose()
+
+	# The versions of the above for cog_before_invoke and cog_after_invoke,
+	# which only work for the commands declared with needs(NEED_RANDOM)
+	async def _cog_before_invoke_random(self, ctx: discord.ApplicationContext):
+		if NEED_RANDOM in get_needs(ctx.command):
+			await self._prepare_random_generator(ctx)
+
+	async def _cog_after_invoke_random(self, ctx: discord.ApplicationContext):
+		if NEED_RANDOM in get_needs(ctx.command):
+			await self._publish_random_generator(ctx)
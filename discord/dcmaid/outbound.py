@@ -0,0 +1,178 @@
+'''
+This module defines the outbound message scheduler used by send_as() when OUTBOUND_SCHEDULER is on.
+Messages are queued per route (a webhook or a channel) and paced by a token bucket of the route,
+so that a burst is smoothed out by us instead of by 429s. In each route, the messages with higher
+priority (interaction followups) go before the others (text command replies).
+
+With OUTBOUND_COALESCE_WINDOW > 0, short plain-text messages of the same speaker to the same channel within the window
+are merged into one message, e.g. the replies to the roll commands of several players.
+The library does not expose the rate limit headers to us, so the buckets use the documented limits,
+which can be tuned with the env variables.
+'''
+from __future__ import annotations
+import asyncio
+from asyncio import get_running_loop
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass, field
+from itertools import count
+from time import monotonic
+from typing import Any, Optional
+from .utils import generate_config
+
+config = generate_config(
+	OUTBOUND_SCHEDULER = {'default': False, 'cast': bool},
+	OUTBOUND_WEBHOOK_RATE = {'default': 2.5, 'cast': float},
+	OUTBOUND_WEBHOOK_BURST = {'default': 5, 'cast': int},
+	OUTBOUND_CHANNEL_RATE = {'default': 1.0, 'cast': float},
+	OUTBOUND_CHANNEL_BURST = {'default': 5, 'cast': int},
+	OUTBOUND_COALESCE_WINDOW = {'default': 0, 'cast': float},
+	OUTBOUND_COALESCE_MAX_LENGTH = {'default': 2000, 'cast': int},
+)
+
+PRIORITY_INTERACTION = 0
+PRIORITY_TEXT = 1
+
+class TokenBucket:
+	def __init__(self, rate: float, burst: int):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = monotonic()
+
+	def take(self) -> float:
+		# Take a token and return 0, or return how long to wait for one
+		now = monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return 0
+		return (1 - self.tokens) / self.rate
+
+@dataclass(order = True)
+class _Job:
+	priority: int
+	seq: int
+	send: Callable[..., Awaitable[Any]] = field(compare = False)
+	args: tuple = field(compare = False)
+	kwargs: dict[str, Any] = field(compare = False)
+	# Jobs with the same non-None key can be merged
+	coalesce_key: Optional[Hashable] = field(compare = False)
+	future: asyncio.Future = field(compare = False)
+
+class _Route:
+	def __init__(self, bucket: TokenBucket):
+		self.bucket = bucket
+		self.queue: asyncio.PriorityQueue[_Job] = asyncio.PriorityQueue()
+		self.worker: Optional[asyncio.Task] = None
+
+class OutboundScheduler:
+	def __init__(self):
+		self.enabled: bool = config['OUTBOUND_SCHEDULER']
+		self._routes: dict[Hashable, _Route] = {}
+		self._seq = count()
+		# The number of requests saved by coalescing
+		self.coalesced = 0
+
+	def _new_bucket(self, route: Hashable) -> TokenBucket:
+		if isinstance(route, tuple) and route[0] == 'webhook':
+			return TokenBucket(config['OUTBOUND_WEBHOOK_RATE'], config['OUTBOUND_WEBHOOK_BURST'])
+		return TokenBucket(config['OUTBOUND_CHANNEL_RATE'], config['OUTBOUND_CHANNEL_BURST'])
+
+	async def submit(self,
+		route: Hashable,
+		priority: int,
+		send: Callable[..., Awaitable[Any]],
+		*args,
+		coalesce_key: Optional[Hashable] = None,
+		**kwargs
+	):
+		'''
+		Queue `send(*args, **kwargs)` into the route and wait until it is sent.
+		The job may be merged with others only if `coalesce_key` is given and the only argument is the content.
+		'''
+		if coalesce_key is not None and not (len(args) == 1 and isinstance(args[0], str) and len(kwargs) == 0):
+			coalesce_key = None
+
+		route_obj = self._routes.get(route)
+		if route_obj is None:
+			route_obj = self._routes[route] = _Route(self._new_bucket(route))
+
+		future = get_running_loop().create_future()
+		route_obj.queue.put_nowait(_Job(priority, next(self._seq), send, args, kwargs, coalesce_key, future))
+		if route_obj.worker is None or route_obj.worker.done():
+			route_obj.worker = asyncio.create_task(self._work(route, route_obj))
+		return await future
+
+	async def _work(self, route: Hashable, route_obj: _Route):
+		queue = route_obj.queue
+		jobs: list[_Job] = []
+		try:
+			while not queue.empty():
+				while (delay := route_obj.bucket.take()) > 0:
+					await asyncio.sleep(delay)
+
+				jobs = [queue.get_nowait()]
+				if jobs[0].coalesce_key is not None and config['OUTBOUND_COALESCE_WINDOW'] > 0:
+					await asyncio.sleep(config['OUTBOUND_COALESCE_WINDOW'])
+					jobs.extend(self._take_coalescible(queue, jobs[0]))
+
+				first = jobs[0]
+				args = first.args if len(jobs) == 1 else ('\n'.join(job.args[0] for job in jobs), )
+				self.coalesced += len(jobs) - 1
+				try:
+					await first.send(*args, **first.kwargs)
+				except Exception as e:
+					for job in jobs:
+						if not job.future.done():
+							job.future.set_exception(e)
+				else:
+					for job in jobs:
+						if not job.future.done():
+							job.future.set_result(None)
+				jobs = []
+		finally:
+			# Cancelled (e.g. on shutdown) or broken by a BaseException; nobody will send them anymore
+			while not queue.empty():
+				jobs.append(queue.get_nowait())
+			for job in jobs:
+				if not job.future.done():
+					job.future.set_exception(RuntimeError(f'The outbound worker of {route} stopped'))
+
+			# Idle routes are dropped; the next message creates a new one with a full bucket,
+			# which is fine since the bucket would have been refilled anyway
+			if self._routes.get(route) is route_obj:
+				del self._routes[route]
+
+	@staticmethod
+	def _take_coalescible(queue: asyncio.PriorityQueue[_Job], first: _Job) -> list[_Job]:
+		# Take the queued jobs mergeable into the first one, keeping the others in order.
+		# Only the jobs of the same priority are merged, so no message jumps over an earlier one.
+		taken: list[_Job] = []
+		kept: list[_Job] = []
+		length = len(first.args[0])
+		blocked = False
+		while not queue.empty():
+			job = queue.get_nowait()
+			if not blocked and job.priority == first.priority:
+				if job.coalesce_key == first.coalesce_key and length + 1 + len(job.args[0]) <= config['OUTBOUND_COALESCE_MAX_LENGTH']:
+					taken.append(job)
+					length += 1 + len(job.args[0])
+					continue
+				blocked = True
+			kept.append(job)
+		for job in kept:
+			queue.put_nowait(job)
+		return taken
+
+	def stats(self) -> dict[str, int]:
+		return {
+			'routes': len(self._routes),
+			'queued': sum(route.queue.qsize() for route in self._routes.values()),
+			'coalesced': self.coalesced,
+		}
+
+# Shared by every send_as() in the process
+scheduler = OutboundScheduler()
+
+__all__ = ['PRIORITY_INTERACTION', 'PRIORITY_TEXT', 'TokenBucket', 'OutboundScheduler', 'scheduler']
@@ -0,0 +1,99 @@
+'''
+This module delivers the content of a command in as few requests as possible.
+An interaction must be acknowledged, but the content is usually sent by a webhook (a maid),
+and the response of the interaction would show who used the command. The strategy here is:
+
+- Text commands: just send (1 request).
+- `direct` and the bot speaks: respond with the content (1 request), which shows the invoker.
+- Otherwise: respond with a short ephemeral acknowledgement, which only the invoker sees,
+  while the content is sent (2 requests in 1 round trip).
+- If the interaction is already responded (e.g. deferred), the response is deleted instead (2 requests).
+
+The requests made are counted per command; see `request_stats`.
+'''
+from __future__ import annotations
+import asyncio
+import discord
+from collections import Counter
+from typing import Optional
+from .typing import QuasiContext
+from .utils import send_as
+
+# The acknowledgement when the caller gives none
+DEFAULT_ACK = '\N{WHITE HEAVY CHECK MARK}'
+
+class RequestStats:
+	def __init__(self):
+		self.invocations: Counter[str] = Counter()
+		self.requests: Counter[str] = Counter()
+
+	def record(self, name: str, requests: int, invocation: bool = True):
+		if invocation:
+			self.invocations[name] += 1
+		self.requests[name] += requests
+
+	def top(self, n: int) -> list[tuple[str, int, int]]:
+		# (command name, invocations, requests) of the commands making the most requests
+		return [(name, self.invocations[name], requests) for name, requests in self.requests.most_common(n)]
+
+request_stats = RequestStats()
+
+def _command_name(ctx: QuasiContext | discord.Message) -> str:
+	if isinstance(ctx, discord.Message):
+		return 'text'
+	if isinstance(ctx, discord.ApplicationContext):
+		return ctx.command.qualified_name
+	return 'interaction'
+
+async def _respond(ctx: QuasiContext, ack: str) -> int:
+	# Acknowledge the interaction without showing it to others; returns the number of requests made
+	if not ctx.response.is_done():
+		await ctx.response.send_message(ack, ephemeral = True)
+		return 1
+	try:
+		if isinstance(ctx, discord.ApplicationContext):
+			await ctx.delete()
+		else:
+			await ctx.delete_original_response()
+	except discord.HTTPException:
+		# Nothing to delete
+		pass
+	return 1
+
+async def acknowledge(ctx: QuasiContext | discord.Message, ack: str = DEFAULT_ACK):
+	# Acknowledge the interaction if deliver() has not; `ack` is only seen by the invoker
+	if isinstance(ctx, discord.Message) or getattr(ctx, '_acknowledged', False):
+		return
+	setattr(ctx, '_acknowledged', True)
+	# The first response of the invocation, as in deliver()
+	request_stats.record(_command_name(ctx), await _respond(ctx, ack))
+
+async def deliver(ctx: QuasiContext | discord.Message, webhook: Optional[discord.Webhook], *args, direct: bool = False, ack: str = DEFAULT_ACK, **kwargs):
+	'''
+	Send the content as the webhook (or the bot if None) and acknowledge the interaction.
+	By default, who called the command is hidden: the interaction is answered by `ack`, which only
+	the invoker sees, and the content is sent separately.
+	Set `direct` to True to let the bot respond to the interaction with the content in one request,
+	which shows the invoker and the command above the message.
+	The other arguments are passed to send_as().
+	'''
+	name = _command_name(ctx)
+	first = not getattr(ctx, '_acknowledged', False)
+
+	if isinstance(ctx, discord.Message) or not first:
+		await send_as(ctx, webhook, *args, **kwargs)
+		request_stats.record(name, 1, invocation = isinstance(ctx, discord.Message))
+		return
+
+	setattr(ctx, '_acknowledged', True)
+	if direct and webhook is None and not ctx.response.is_done():
+		kwargs.pop('refresh', None)
+		kwargs.pop('coalesce', None)
+		await ctx.response.send_message(*args, **kwargs)
+		request_stats.record(name, 1)
+		return
+
+	responded, _ = await asyncio.gather(_respond(ctx, ack), send_as(ctx, webhook, *args, **kwargs))
+	request_stats.record(name, responded + 1)
+
+__all__ = ['DEFAULT_ACK', 'RequestStats', 'request_stats', 'acknowledge', 'deliver']
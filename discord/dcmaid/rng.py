@@ -0,0 +1,294 @@
+'''
+This module defines the random generators of the channels.
+RNG_ENGINE chooses the engine of the new generators:
+
+- "mt": random.Random (Mersenne Twister), about 2.5 KB of state each.
+- "pcg64": PCG64 (the same algorithm as numpy's), 32 bytes of state each.
+
+Both engines have the methods of random.Random plus the bulk methods (randoms, randints, ...).
+PCG64 draws many numbers with one getrandbits() call instead of one Python call per number.
+MTRandom draws them one by one as random.Random does, so a seeded MT channel keeps
+the same sequences as the older versions.
+The generators are kept in State.random_generator. With RNG_PERSIST, the generators of the
+channels that have been seeded are written back to the db in batches and loaded again on use,
+so /seed survives restarts; the other channels just start a new sequence after restart.
+'''
+from __future__ import annotations
+import hashlib
+import os
+import random
+import struct
+from typing import Any, Optional, TYPE_CHECKING
+from .cache import CachedDocuments
+from .utils import generate_config
+
+if TYPE_CHECKING:
+	from .basebot import Bot
+	from .state import Namespace
+
+config = generate_config(
+	RNG_ENGINE = {'default': 'mt'},
+	RNG_PERSIST = {'default': True, 'cast': bool},
+	RNG_COLLECTION = {'default': 'random_generators'},
+	RNG_FLUSH_INTERVAL = {'default': 30.0, 'cast': float},
+	RNG_FLUSH_BATCH = {'default': 100, 'cast': int},
+	RNG_NEGATIVE_TTL = {'default': 300, 'cast': float},
+)
+
+_MASK64 = (1 << 64) - 1
+_MASK128 = (1 << 128) - 1
+_RECIP_BPF = 2 ** -53
+
+class BulkMixin:
+	# Needs getrandbits() only
+	__slots__ = ()
+
+	def _words(self, n: int) -> tuple[int, ...]:
+		# n random 64-bit integers
+		if n <= 0:
+			return ()
+		return struct.unpack(f'<{n}Q', self.getrandbits(64 * n).to_bytes(8 * n, 'little'))  # type: ignore[attr-defined]
+
+	def randoms(self, n: int) -> list[float]:
+		# n floats in [0, 1), like random()
+		return [(w >> 11) * _RECIP_BPF for w in self._words(n)]
+
+	def randints(self, a: int, b: int, n: int) -> list[int]:
+		# n integers in [a, b], like randint()
+		width = b - a + 1
+		if width <= 0:
+			raise ValueError(f'empty range for randints({a}, {b}, {n})')
+		k = width.bit_length()
+		if k > 64:
+			return [a + self._randbelow(width) for _ in range(n)]  # type: ignore[attr-defined]
+
+		# Rejection sampling as _randbelow() does, but a batch at a time
+		shift = 64 - k
+		result: list[int] = []
+		while len(result) < n:
+			result.extend(a + r for w in self._words(n - len(result)) if (r := w >> shift) < width)
+		return result
+
+	def uniforms(self, a: float, b: float, n: int) -> list[float]:
+		return [a + (b - a) * r for r in self.randoms(n)]
+
+	def triangulars(self, low: float = 0.0, high: float = 1.0, mode: Optional[float] = None, n: int = 1) -> list[float]:
+		# The same formula as triangular()
+		try:
+			c = 0.5 if mode is None else (mode - low) / (high - low)
+		except ZeroDivisionError:
+			return [low] * n
+
+		result = []
+		for u in self.randoms(n):
+			if u > c:
+				result.append(high + (low - high) * ((1.0 - u) * (1.0 - c)) ** 0.5)
+			else:
+				result.append(low + (high - low) * (u * c) ** 0.5)
+		return result
+
+class MTRandom(BulkMixin, random.Random):
+	# Whether the generator is saved into the db (seeded, or loaded from the db)
+	persist: bool = False
+
+	# The per-call methods, which consume the state as the older versions did
+	def randoms(self, n: int) -> list[float]:
+		return [self.random() for _ in range(n)]
+
+	def randints(self, a: int, b: int, n: int) -> list[int]:
+		return [self.randint(a, b) for _ in range(n)]
+
+	def uniforms(self, a: float, b: float, n: int) -> list[float]:
+		return [self.uniform(a, b) for _ in range(n)]
+
+	def triangulars(self, low: float = 0.0, high: float = 1.0, mode: Optional[float] = None, n: int = 1) -> list[float]:
+		return [self.triangular(low, high, mode) for _ in range(n)]
+
+class PCG64(BulkMixin):
+	'''
+	PCG XSL RR 128/64 with the methods of random.Random.
+	It does not subclass random.Random, which carries the Mersenne Twister state anyway.
+	'''
+	__slots__ = ('_state', '_inc', 'gauss_next', 'persist')
+	_MULT = 0x2360ED051FC65DA44385DF649FCCF645
+
+	def __init__(self, seed: Any = None):
+		self.persist = False
+		self.seed(seed)
+
+	def seed(self, a: Any = None):
+		if a is None:
+			data = os.urandom(32)
+		else:
+			if isinstance(a, int):
+				a = a.to_bytes((a.bit_length() + 8) // 8, 'big', signed = True)
+			elif isinstance(a, str):
+				a = a.encode()
+			elif not isinstance(a, bytes | bytearray):
+				raise TypeError('The seed must be one of: None, int, str, bytes, and bytearray.')
+			data = hashlib.sha512(a).digest()
+
+		# The seeding of the reference implementation
+		self._inc = ((int.from_bytes(data[16:32], 'big') << 1) | 1) & _MASK128
+		self._state = (self._inc + int.from_bytes(data[:16], 'big')) & _MASK128
+		self._state = (self._state * self._MULT + self._inc) & _MASK128
+		self.gauss_next: Optional[float] = None
+
+	def getstate(self) -> tuple[str, int, int, Optional[float]]:
+		return ('pcg64', self._state, self._inc, self.gauss_next)
+
+	def setstate(self, state: tuple[str, int, int, Optional[float]]):
+		_, self._state, self._inc, self.gauss_next = state
+
+	def getrandbits(self, k: int) -> int:
+		if k < 0:
+			raise ValueError('number of bits must be non-negative')
+		words = (k + 63) // 64
+		mult, inc = self._MULT, self._inc
+		state = self._state
+		result = 0
+		for i in range(words):
+			state = (state * mult + inc) & _MASK128
+			x = ((state >> 64) ^ state) & _MASK64
+			rot = state >> 122
+			result |= (((x >> rot) | (x << (64 - rot))) & _MASK64) << (64 * i)
+		self._state = state
+		# Keep the high bits, as random.Random does
+		return result >> (64 * words - k)
+
+	# The rest only calls random() and getrandbits()
+	_randbelow = random.Random._randbelow_with_getrandbits
+	randrange = random.Random.randrange
+	randint = random.Random.randint
+	randbytes = random.Random.randbytes
+	choice = random.Random.choice
+	choices = random.Random.choices
+	sample = random.Random.sample
+	shuffle = random.Random.shuffle
+	uniform = random.Random.uniform
+	triangular = random.Random.triangular
+	gauss = random.Random.gauss
+	normalvariate = random.Random.normalvariate
+	lognormvariate = random.Random.lognormvariate
+	expovariate = random.Random.expovariate
+	vonmisesvariate = random.Random.vonmisesvariate
+	gammavariate = random.Random.gammavariate
+	betavariate = random.Random.betavariate
+	paretovariate = random.Random.paretovariate
+	weibullvariate = random.Random.weibullvariate
+
+	# Defined after the above, or `random` in the class body would be this method
+	def random(self) -> float:
+		return (self.getrandbits(64) >> 11) * _RECIP_BPF
+
+RandomGenerator = MTRandom | PCG64
+
+_engines: dict[str, type[MTRandom] | type[PCG64]] = {
+	'mt': MTRandom,
+	'pcg64': PCG64,
+}
+
+def create_generator(seed: Any = None, engine: Optional[str] = None) -> RandomGenerator:
+	if engine is None:
+		engine = config['RNG_ENGINE']
+	if engine not in _engines:
+		raise ValueError(f'Unknown random engine: {engine}')
+	return _engines[engine](seed)
+
+def dump_generator(generator: RandomGenerator) -> list:
+	state = generator.getstate()
+	if state[0] == 'pcg64':
+		# The 128-bit integers in hex, which JSON (and BSON) can hold
+		_, s, inc, gauss_next = state
+		return ['pcg64', f'{s:x}', f'{inc:x}', gauss_next, generator.persist]
+	version, internal, gauss_next = state
+	return [version, list(internal), gauss_next, generator.persist]
+
+def load_generator(key, raw: list) -> RandomGenerator:
+	# The dumps without the persist flag were all saved into the db, so they keep being saved
+	if raw[0] == 'pcg64':
+		_, s, inc, gauss_next, *rest = raw
+		pcg = PCG64.__new__(PCG64)
+		pcg.setstate(('pcg64', int(s, 16), int(inc, 16), gauss_next))
+		pcg.persist = rest[0] if len(rest) > 0 else True
+		return pcg
+	# The Mersenne Twister, also the format of the old snapshots
+	generator = MTRandom()
+	version, internal, gauss_next, *rest = raw
+	generator.setstate((version, tuple(internal), gauss_next))
+	generator.persist = rest[0] if len(rest) > 0 else True
+	return generator
+
+class GeneratorStore:
+	'''
+	The generators of the channels.
+	A generator is created on first use, or loaded from the db if RNG_PERSIST is on.
+	Call load() before get() to restore the saved one, and save() after using a generator;
+	the saves are written back in batches.
+	Only the seeded generators (and those loaded from the db) are saved, so most channels,
+	which never /seed, have no document; their misses are remembered for RNG_NEGATIVE_TTL.
+	'''
+	def __init__(self, bot: Bot):
+		self._d: Namespace[int, RandomGenerator] = bot.state.random_generator
+		self._cache: Optional[CachedDocuments[int, RandomGenerator]] = None
+		if config['RNG_PERSIST']:
+			self._cache = CachedDocuments(
+				bot,
+				bot.storage.documents(config['RNG_COLLECTION'], ('channel', ), unique = True),
+				self._d,
+				self._build,
+				interval = config['RNG_FLUSH_INTERVAL'],
+				batch_size = config['RNG_FLUSH_BATCH'],
+				negative_ttl = config['RNG_NEGATIVE_TTL']
+			)
+
+	@staticmethod
+	def _build(channel_id: int, data: Optional[dict]) -> Optional[RandomGenerator]:
+		if data is None:
+			return None
+		generator = load_generator(channel_id, data['state'])
+		generator.persist = True
+		return generator
+
+	def _set(self, channel_id: int, generator: RandomGenerator):
+		if self._cache is None:
+			self._d.set(channel_id, generator)
+		else:
+			self._cache.set(channel_id, generator)
+
+	def get(self, channel_id: int) -> RandomGenerator:
+		generator = self._d.get(channel_id)
+		if generator is None:
+			generator = create_generator()
+			self._set(channel_id, generator)
+		return generator
+
+	async def load(self, channel_id: int):
+		if self._cache is not None:
+			await self._cache.get(channel_id)
+
+	def seed(self, channel_id: int, seed: Any = None) -> RandomGenerator:
+		generator = create_generator(seed)
+		# Even a random reseed, or the older seeded state would come back from the db after restart
+		generator.persist = True
+		self._set(channel_id, generator)
+		self.save(channel_id)
+		return generator
+
+	def save(self, channel_id: int):
+		if self._cache is None:
+			return
+		generator = self._d.get(channel_id)
+		if generator is not None and generator.persist:
+			self._cache.mark(channel_id, {'state': dump_generator(generator)})
+
+__all__ = [
+	'BulkMixin',
+	'MTRandom',
+	'PCG64',
+	'RandomGenerator',
+	'create_generator',
+	'dump_generator',
+	'load_generator',
+	'GeneratorStore',
+]
@@ -1,37 +1,529 @@
+from __future__ import annotations
+import asyncio
 import discord
-from collections.abc import Mapping
-from threading import Lock
-from typing import cast, Optional
+import json
+import os
+from asyncio import get_running_loop
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable, Hashable, Iterator, Mapping
+from contextlib import asynccontextmanager, suppress
+from itertools import count
+from time import monotonic
+from typing import Any, Generic, Optional, TypeVar
+from uuid import uuid4
+from .rng import dump_generator, load_generator, RandomGenerator
+from .statebackend import create_backend, StateBackend
+from .utils import generate_config
 
-class State:
-	def __init__(self) -> None:
-		# To ensure that each update is handled by mutex lock,
-		# the "object" part is recommended to be immutable.
-		self._real_dict: dict[str, tuple[Lock, object]] = {}
-	def get(self, key: str, default: object = None):
-		try:
-			t = self._real_dict[key]
-		except KeyError:
+config = generate_config(
+	STATE_DEFAULT_CAPACITY = {'default': 10000, 'cast': int},
+	STATE_INSTALLED_HOOKS_CAPACITY = {'default': 10000, 'cast': int},
+	STATE_INSTALLED_HOOKS_TTL = {'default': 0, 'cast': float},
+	STATE_RANDOM_GENERATOR_CAPACITY = {'default': 10000, 'cast': int},
+	STATE_RANDOM_GENERATOR_IDLE = {'default': 0, 'cast': float},
+	STATE_BACKEND = {'default': 'memory'},
+	STATE_LEASE_TTL = {'default': 30, 'cast': float},
+	STATE_LEASE_POLL = {'default': 0.2, 'cast': float},
+	STATE_LEASE_WAIT = {'default': 60, 'cast': float},
+	STATE_PURGE_INTERVAL = {'default': 600, 'cast': float},
+)
+
+K = TypeVar('K', bound = Hashable)
+V = TypeVar('V')
+
+class _Entry(Generic[V]):
+	__slots__ = ('value', 'set_at', 'used_at')
+
+	def __init__(self, value: V, now: float):
+		self.value = value
+		self.set_at = now
+		self.used_at = now
+
+def _idle(lock: asyncio.Lock) -> bool:
+	# Right after release() the woken waiter does not hold the lock yet, but is still in _waiters;
+	# dropping the lock then would give a new caller another lock of the same key
+	return not lock.locked() and not getattr(lock, '_waiters', None)
+
+class Namespace(Generic[K, V]):
+	'''
+	A bounded mapping in State.
+	When more than `capacity` entries are held, the least recently used one is evicted.
+	Entries set more than `ttl` seconds ago, or not used for `idle` seconds, are expired.
+	Zero disables the corresponding limit.
+	The namespace is only used in the event loop thread, so the locks here are asyncio locks
+	that guard a key across awaits (e.g. a fetch-then-set sequence).
+
+	With a codec, the namespace can be saved into a snapshot. Entries restored from a snapshot
+	are kept raw and only decoded when their keys are used; the decoder may return None
+	to reject an outdated entry.
+
+	With a codec and a shared backend, fetch() and publish() also read and write the backend,
+	so the processes sharing the backend see the same values. get() and set() stay local.
+	'''
+	def __init__(self, name: str, capacity: int = 0, ttl: float = 0, idle: float = 0, backend: Optional[StateBackend] = None):
+		self.name = name
+		self.backend = backend
+		# The backend string each local value is decoded from, to skip decoding the same one again
+		self._shared_raw: dict[K, str] = {}
+		self.capacity = capacity
+		self.ttl = ttl
+		self.idle = idle
+		self._d: OrderedDict[K, _Entry[V]] = OrderedDict()
+		self._locks: dict[K, asyncio.Lock] = {}
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.restored = 0
+		self._raw: dict[K, Any] = {}
+		self._dump: Optional[Callable[[V], Any]] = None
+		self._load: Optional[Callable[[K, Any], Optional[V]]] = None
+		# Whether the entries are saved into snapshots when there is a codec
+		self.snapshot = True
+
+	def _expired(self, entry: _Entry[V], now: float) -> bool:
+		return (self.ttl > 0 and now - entry.set_at > self.ttl) or (self.idle > 0 and now - entry.used_at > self.idle)
+
+	def _peek(self, key: K, now: float) -> Optional[_Entry[V]]:
+		entry = self._d.get(key)
+		if entry is None:
+			if key in self._raw and self._load is not None:
+				return self._rehydrate(key)
+			return None
+		if self._expired(entry, now):
+			self._drop(key)
+			self.evictions += 1
+			return None
+		return entry
+
+	def get(self, key: K, default: Any = None) -> V | Any:
+		now = monotonic()
+		entry = self._peek(key, now)
+		if entry is None:
+			self.misses += 1
 			return default
+
+		self.hits += 1
+		entry.used_at = now
+		self._d.move_to_end(key)
+		return entry.value
+
+	def set(self, key: K, value: V):
+		now = monotonic()
+		entry = self._d.get(key)
+		if entry is None:
+			self._d[key] = _Entry(value, now)
 		else:
-			return t[1]
+			entry.value = value
+			entry.set_at = entry.used_at = now
+			self._d.move_to_end(key)
+		self._evict(now)
+
+	def remove(self, key: K):
+		self._raw.pop(key, None)
+		if key in self._d:
+			self._drop(key)
+
+	@property
+	def shared(self) -> bool:
+		return self.backend is not None and self.backend.shared and self._load is not None
+
+	async def fetch(self, key: K, default: Any = None) -> V | Any:
+		'''
+		Get the value, reading the shared backend first if any.
+		If the backend does not have the key, the local value (e.g. restored from the snapshot) is used,
+		unless the local value came from the backend, which means another process has removed it.
+		'''
+		if not self.shared:
+			return self.get(key, default)
+
+		assert self.backend is not None and self._load is not None
+		raw = await get_running_loop().run_in_executor(None, self.backend.get, self.name, json.dumps(key))
+		if raw is None:
+			if key in self._shared_raw:
+				del self._shared_raw[key]
+				self.remove(key)
+			return self.get(key, default)
+
+		if self._shared_raw.get(key) == raw and key in self:
+			return self.get(key, default)
+
+		try:
+			value = self._load(key, json.loads(raw))
+		except Exception:
+			value = None
+		if value is None:
+			return self.get(key, default)
+
+		self.set(key, value)
+		self._shared_raw[key] = raw
+		return value
+
+	async def publish(self, key: K, value: V):
+		# Set the value and write it to the shared backend if any
+		self.set(key, value)
+		if not self.shared:
+			return
+
+		assert self.backend is not None and self._dump is not None
+		dumped = self._dump(value)
+		if dumped is None:
+			return
+		raw = json.dumps(dumped, separators = (',', ':'))
+		await get_running_loop().run_in_executor(None, self.backend.set, self.name, json.dumps(key), raw, self.ttl)
+		self._shared_raw[key] = raw
+
+	async def withdraw(self, key: K):
+		# Remove the value here and in the shared backend
+		self.remove(key)
+		if not self.shared:
+			return
+
+		assert self.backend is not None
+		self._shared_raw.pop(key, None)
+		await get_running_loop().run_in_executor(None, self.backend.delete, self.name, json.dumps(key))
+
+	def set_time(self, key: K) -> Optional[float]:
+		# The monotonic time when the value was set
+		entry = self._peek(key, monotonic())
+		return None if entry is None else entry.set_at
+
+	def __contains__(self, key: K) -> bool:
+		return self._peek(key, monotonic()) is not None
+
+	def __len__(self) -> int:
+		return len(self._d)
+
+	def __iter__(self) -> Iterator[K]:
+		return iter(list(self._d))
+
+	def restored_keys(self) -> list[K]:
+		# The keys restored from the snapshot but not decoded yet
+		return [key for key in self._raw if key not in self._d]
+
+	def items(self) -> list[tuple[K, V]]:
+		now = monotonic()
+		return [(key, entry.value) for key, entry in self._d.items() if not self._expired(entry, now)]
+
+	def lock(self, key: K) -> asyncio.Lock:
+		lock = self._locks.get(key)
+		if lock is None:
+			lock = self._locks[key] = asyncio.Lock()
+			if self.capacity > 0 and len(self._locks) > self.capacity:
+				self._drop_idle_locks()
+		return lock
+
+	async def compare_and_set(self, key: K, expected: Optional[V], value: V) -> bool:
+		'''
+		Set the value only if the current value is `expected` (compared by identity).
+		None expects the key to be absent.
+		'''
+		async with self.lock(key):
+			entry = self._peek(key, monotonic())
+			current = None if entry is None else entry.value
+			if current is not expected:
+				return False
+			self.set(key, value)
+			return True
+
+	def stats(self) -> dict[str, int]:
+		return {
+			'size': len(self._d),
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'restored': self.restored,
+		}
+
+	def set_codec(self, dump: Callable[[V], Any], load: Callable[[K, Any], Optional[V]]):
+		# dump() returns a JSON-serializable object, or None to skip the entry
+		self._dump = dump
+		self._load = load
+
+	def _rehydrate(self, key: K) -> Optional[_Entry[V]]:
+		assert self._load is not None
+		raw = self._raw.pop(key)
+		try:
+			value = self._load(key, raw)
+		except Exception:
+			value = None
+		if value is None:
+			return None
+
+		self.restored += 1
+		self.set(key, value)
+		return self._d[key]
+
+	def dump_entries(self) -> list[list[Any]]:
+		# [key, dumped value] pairs, so that int keys survive JSON
+		result = []
+		if self._dump is not None:
+			now = monotonic()
+			for key, entry in self._d.items():
+				if self._expired(entry, now):
+					continue
+				dumped = self._dump(entry.value)
+				if dumped is not None:
+					result.append([key, dumped])
+		# Restored entries never used in this run are passed to the next run as they are
+		result.extend([key, raw] for key, raw in self._raw.items() if key not in self._d)
+		return result
+
+	def restore_entries(self, entries: list[list[Any]]):
+		for key, raw in entries:
+			if key not in self._d:
+				self._raw[key] = raw
+		if self.capacity > 0:
+			while len(self._raw) > self.capacity:
+				del self._raw[next(iter(self._raw))]
+
+	def _drop(self, key: K):
+		del self._d[key]
+		self._shared_raw.pop(key, None)
+		lock = self._locks.get(key)
+		if lock is not None and _idle(lock):
+			del self._locks[key]
+
+	def _drop_idle_locks(self):
+		for key in [key for key, lock in self._locks.items() if _idle(lock) and key not in self._d]:
+			del self._locks[key]
+
+	def _evict(self, now: float):
+		d = self._d
+		if self.capacity > 0:
+			while len(d) > self.capacity:
+				self._drop(next(iter(d)))
+				self.evictions += 1
+
+		if self.idle > 0:
+			# The front is the least recently used one
+			while len(d) > 0:
+				key = next(iter(d))
+				if now - d[key].used_at <= self.idle:
+					break
+				self._drop(key)
+				self.evictions += 1
+
+class LeaseLost(Exception):
+	pass
+
+class Lease:
+	# Set when the lease could not be extended, after which the holder must not write anything
+	__slots__ = ('lost', )
+
+	def __init__(self):
+		self.lost = False
+
+class State:
+	'''
+	The in-memory state of the process, split into typed namespaces.
+	The string-keyed get/set methods are kept for extensions and go into the "misc" namespace.
+
+	The namespaces with codecs can be saved into a local snapshot file and restored after restart.
+	A snapshot is "clean" only if it is saved on graceful shutdown after everything is flushed.
+
+	The backend (STATE_BACKEND) decides whether the shared namespaces are seen by other processes.
+	Leases are held across processes to let only one process do something (e.g. creating webhooks).
+	'''
+	def __init__(self, backend: Optional[StateBackend] = None) -> None:
+		self.backend = backend if backend is not None else create_backend(config['STATE_BACKEND'])
+		# Identify this process in leases
+		self._owner = uuid4().hex
+		self._lease_counter = count()
+		self._namespaces: dict[str, Namespace] = {}
+		# Restored entries of the namespaces not created yet
+		self._pending_entries: dict[str, list[list[Any]]] = {}
+		self.snapshot_clean = False
+		self.installed_hooks: Namespace[int, Mapping[str, discord.Webhook]] = self.namespace(
+			'installed_hooks',
+			capacity = config['STATE_INSTALLED_HOOKS_CAPACITY'],
+			ttl = config['STATE_INSTALLED_HOOKS_TTL'],
+			shared = True
+		)
+		self.random_generator: Namespace[int, RandomGenerator] = self.namespace(
+			'random_generator',
+			capacity = config['STATE_RANDOM_GENERATOR_CAPACITY'],
+			idle = config['STATE_RANDOM_GENERATOR_IDLE'],
+			shared = True
+		)
+		self._misc: Namespace[str, object] = self.namespace('misc')
+		self.register_codec('random_generator', dump_generator, load_generator)
+
+	def namespace(self, name: str, capacity: Optional[int] = None, ttl: float = 0, idle: float = 0, shared: bool = False) -> Namespace:
+		# The arguments are only used at the first call.
+		# A shared namespace also needs a codec to be really shared.
+		if name not in self._namespaces:
+			if capacity is None:
+				capacity = config['STATE_DEFAULT_CAPACITY']
+			ns = self._namespaces[name] = Namespace(name, capacity, ttl, idle, self.backend if shared else None)
+			ns.restore_entries(self._pending_entries.pop(name, []))
+		return self._namespaces[name]
+
+	def register_codec(self, name: str, dump: Callable[[Any], Any], load: Callable[[Any, Any], Any], clean_only: bool = False, snapshot: bool = True):
+		'''
+		Make the namespace saved into snapshots (and shared if it is a shared namespace).
+		If `clean_only`, the entries are dropped when the snapshot is not clean,
+		which is for the values that are also persisted elsewhere and may be outdated after a crash.
+		If not `snapshot`, the codec is only used to share the entries.
+		'''
+		ns = self.namespace(name)
+		ns.set_codec(dump, load)
+		ns.snapshot = snapshot
+		if (clean_only and not self.snapshot_clean) or not snapshot:
+			ns._raw.clear()
+
+	@asynccontextmanager
+	async def lease(self, name: str, key: Hashable, ttl: Optional[float] = None, wait: Optional[float] = None) -> AsyncIterator[Lease]:
+		'''
+		Hold a lease of (name, key) across the processes sharing the backend.
+		A lease expires after `ttl` seconds, so a crashed holder cannot block the others forever,
+		and it is extended every third of `ttl` while held. If an extension fails, the lease is marked lost
+		and the task holding it is cancelled; the body of `async with` then gets LeaseLost.
+		Waiting for the lease raises TimeoutError after `wait` seconds.
+		Without a shared backend, this does nothing; use the namespace locks in the process.
+		'''
+		lease = Lease()
+		if not self.backend.shared:
+			yield lease
+			return
+
+		if ttl is None:
+			ttl = config['STATE_LEASE_TTL']
+		if wait is None:
+			wait = config['STATE_LEASE_WAIT']
+		loop = get_running_loop()
+		lease_key = json.dumps([name, key])
+		token = f'{self._owner}:{next(self._lease_counter)}'
+		deadline = monotonic() + wait
+		while True:
+			acquired_at = monotonic()
+			if await loop.run_in_executor(None, self.backend.compare_and_set, '__lease__', lease_key, None, token, ttl):
+				break
+			if monotonic() >= deadline:
+				raise TimeoutError(f'Timed out waiting for the lease of {lease_key}')
+			await asyncio.sleep(config['STATE_LEASE_POLL'])
+
+		holder = asyncio.current_task()
+		assert holder is not None
+		heartbeat = loop.create_task(self._extend_lease(lease, lease_key, token, ttl, acquired_at, holder))
+		try:
+			yield lease
+		except asyncio.CancelledError:
+			# Turn our own cancellation into LeaseLost; others are passed on
+			if lease.lost and holder.uncancel() == 0:
+				raise LeaseLost(f'Lost the lease of {lease_key}') from None
+			raise
+		finally:
+			heartbeat.cancel()
+			with suppress(asyncio.CancelledError):
+				await heartbeat
+			if not lease.lost:
+				# Release only if it is still ours
+				await loop.run_in_executor(None, self.backend.compare_and_set, '__lease__', lease_key, token, None)
+
+	async def _extend_lease(self, lease: Lease, lease_key: str, token: str, ttl: float, acquired_at: float, holder: asyncio.Task):
+		loop = get_running_loop()
+		interval = ttl / 3
+		# Surely ours until then
+		expire_at = acquired_at + ttl
+		while True:
+			await asyncio.sleep(interval)
+			started = monotonic()
+			try:
+				extended = await loop.run_in_executor(None, self.backend.compare_and_set, '__lease__', lease_key, token, token, ttl)
+			except Exception as e:
+				print(f'Failed to extend the lease of {lease_key}: {e!r}')
+				# Try again while it cannot have expired
+				if monotonic() + interval < expire_at:
+					continue
+				extended = False
+			if not extended:
+				lease.lost = True
+				holder.cancel()
+				return
+			expire_at = started + ttl
+
+	async def purge(self):
+		# Expired entries and leases pile up in a shared backend otherwise
+		await get_running_loop().run_in_executor(None, self.backend.purge)
+
+	def close(self):
+		self.backend.close()
+
+	def snapshot(self, clean: bool = False) -> dict[str, Any]:
+		namespaces: dict[str, Any] = {name: entries for name, entries in self._pending_entries.items()}
+		for name, ns in self._namespaces.items():
+			if not ns.snapshot:
+				continue
+			entries = ns.dump_entries()
+			if len(entries) > 0:
+				namespaces[name] = entries
+		return {'clean': clean, 'namespaces': namespaces}
+
+	@staticmethod
+	def _write_snapshot(path: str, data: dict[str, Any]):
+		# Write to a temporary file then rename, so a crash never leaves a broken snapshot.
+		# The snapshot contains webhook tokens, so only the owner can read it.
+		tmp = f'{path}.tmp'
+		fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with open(fd, 'w') as f:
+			json.dump(data, f, separators = (',', ':'))
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
+
+	def save(self, path: str, clean: bool = False):
+		self._write_snapshot(path, self.snapshot(clean))
+
+	async def checkpoint(self, path: str):
+		# The snapshot is taken in the event loop, and the file is written in an executor
+		data = self.snapshot()
+		await get_running_loop().run_in_executor(None, self._write_snapshot, path, data)
+
+	def restore(self, path: str):
+		try:
+			with open(path) as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			# No snapshot or a broken one, just start cold
+			return
+
+		self.snapshot_clean = bool(data.get('clean', False))
+		if self.snapshot_clean:
+			# The clean flag is only for this start; a crash before the next checkpoint
+			# must not restore the clean-only entries over newer data in the db
+			try:
+				self._write_snapshot(path, data | {'clean': False})
+			except OSError:
+				with suppress(OSError):
+					os.remove(path)
+		for name, entries in data.get('namespaces', {}).items():
+			if name in self._namespaces:
+				self._namespaces[name].restore_entries(entries)
+			else:
+				self._pending_entries[name] = entries
+
+	def stats(self) -> dict[str, dict[str, int]]:
+		return {name: ns.stats() for name, ns in self._namespaces.items()}
+
+	def get(self, key: str, default: object = None):
+		return self._misc.get(key, default)
+
 	def set(self, key: str, obj: object):
-		if key not in self._real_dict:
-			self._real_dict[key] = (Lock(), obj)
-		else:
-			lock = self._real_dict[key][0]
-			with lock:
-				self._real_dict[key] = (lock, obj)
+		self._misc.set(key, obj)
+
 	def __contains__(self, key: str):
-		return key in self._real_dict
+		return key in self._misc
+
 	def remove(self, key: str):
-		if key in self._real_dict:
-			lock = self._real_dict[key][0]
-			with lock:
-				del self._real_dict[key]
+		self._misc.remove(key)
+
 	def get_installed_hooks(self, channel_id: int) -> Optional[Mapping[str, discord.Webhook]]:
-		return cast(Optional[Mapping[str, discord.Webhook]], self.get(f'installed_hooks_{channel_id}'))
+		return self.installed_hooks.get(channel_id)
+
 	def set_installed_hooks(self, channel_id: int, immutable_map: Mapping[str, discord.Webhook]):
-		self.set(f'installed_hooks_{channel_id}', immutable_map)
+		self.installed_hooks.set(channel_id, immutable_map)
+
 	def remove_installed_hooks(self, channel_id):
-		self.remove(f'installed_hooks_{channel_id}')
\ No newline at end of file
+		self.installed_hooks.remove(channel_id)
+
+__all__ = ['Namespace', 'LeaseLost', 'Lease', 'State']
@@ -0,0 +1,198 @@
+'''
+This module defines the backends behind State.
+A backend stores JSON strings by (namespace, key) and supports atomic get/set/CAS with expiry.
+The memory backend lives in the process; the SQLite backend is shared by every process
+opening the same file, so several bot processes (shards, or a blue/green overlap) can run together.
+'''
+from __future__ import annotations
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from time import time
+from typing import Optional
+
+class StateBackend(ABC):
+	# Whether other processes can see the data
+	shared: bool = False
+
+	@abstractmethod
+	def get(self, namespace: str, key: str) -> Optional[str]:
+		...
+
+	@abstractmethod
+	def set(self, namespace: str, key: str, value: str, ttl: float = 0):
+		# Zero ttl means no expiry
+		...
+
+	@abstractmethod
+	def compare_and_set(self, namespace: str, key: str, expected: Optional[str], value: Optional[str], ttl: float = 0) -> bool:
+		'''
+		Set the value only if the current value equals `expected`.
+		None `expected` expects the key to be absent (or expired), and None `value` deletes the key.
+		'''
+		...
+
+	@abstractmethod
+	def delete(self, namespace: str, key: str):
+		...
+
+	def purge(self):
+		# Drop the expired entries, which are never read but take space
+		pass
+
+	def close(self):
+		pass
+
+class MemoryBackend(StateBackend):
+	def __init__(self):
+		# (namespace, key): (value, expire_at), and zero expire_at means no expiry
+		self._d: dict[tuple[str, str], tuple[str, float]] = {}
+		self._lock = threading.Lock()
+
+	def _get(self, k: tuple[str, str]) -> Optional[str]:
+		item = self._d.get(k)
+		if item is None:
+			return None
+		value, expire_at = item
+		if expire_at and expire_at <= time():
+			del self._d[k]
+			return None
+		return value
+
+	def _set(self, k: tuple[str, str], value: Optional[str], ttl: float):
+		if value is None:
+			self._d.pop(k, None)
+		else:
+			self._d[k] = (value, time() + ttl if ttl > 0 else 0)
+
+	def get(self, namespace: str, key: str) -> Optional[str]:
+		with self._lock:
+			return self._get((namespace, key))
+
+	def set(self, namespace: str, key: str, value: str, ttl: float = 0):
+		with self._lock:
+			self._set((namespace, key), value, ttl)
+
+	def compare_and_set(self, namespace: str, key: str, expected: Optional[str], value: Optional[str], ttl: float = 0) -> bool:
+		k = (namespace, key)
+		with self._lock:
+			if self._get(k) != expected:
+				return False
+			self._set(k, value, ttl)
+			return True
+
+	def delete(self, namespace: str, key: str):
+		with self._lock:
+			self._d.pop((namespace, key), None)
+
+	def purge(self):
+		now = time()
+		with self._lock:
+			for k in [k for k, (_, expire_at) in self._d.items() if expire_at and expire_at <= now]:
+				del self._d[k]
+
+class SQLiteBackend(StateBackend):
+	'''
+	A backend on a local SQLite file, shared by the processes on the same host (or the same volume).
+	The calls block, so call them in an executor from the event loop.
+	'''
+	shared = True
+
+	def __init__(self, path: str, timeout: float = 10.0):
+		self.path = path
+		self.timeout = timeout
+		# sqlite3 connections cannot be shared between threads
+		self._local = threading.local()
+		self._connections: list[sqlite3.Connection] = []
+		self._connections_lock = threading.Lock()
+
+		# The shared webhooks have their tokens, so only the owner can read the file (as the snapshot).
+		# SQLite creates the WAL files with the same permissions.
+		os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+		os.chmod(path, 0o600)
+
+		conn = self._conn()
+		conn.execute('PRAGMA journal_mode = WAL')
+		conn.execute(
+			'CREATE TABLE IF NOT EXISTS state ('
+			'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expire_at REAL NOT NULL, '
+			'PRIMARY KEY (namespace, key)) WITHOUT ROWID'
+		)
+
+	def _conn(self) -> sqlite3.Connection:
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			# Autocommit; the transactions are started explicitly
+			conn = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None, check_same_thread = False)
+			conn.execute('PRAGMA synchronous = NORMAL')
+			self._local.conn = conn
+			with self._connections_lock:
+				self._connections.append(conn)
+		return conn
+
+	@staticmethod
+	def _expire_at(ttl: float) -> float:
+		return time() + ttl if ttl > 0 else 0
+
+	def _get(self, conn: sqlite3.Connection, namespace: str, key: str) -> Optional[str]:
+		row = conn.execute(
+			'SELECT value FROM state WHERE namespace = ? AND key = ? AND (expire_at = 0 OR expire_at > ?)',
+			(namespace, key, time())
+		).fetchone()
+		return None if row is None else row[0]
+
+	def get(self, namespace: str, key: str) -> Optional[str]:
+		return self._get(self._conn(), namespace, key)
+
+	def set(self, namespace: str, key: str, value: str, ttl: float = 0):
+		self._conn().execute(
+			'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)',
+			(namespace, key, value, self._expire_at(ttl))
+		)
+
+	def compare_and_set(self, namespace: str, key: str, expected: Optional[str], value: Optional[str], ttl: float = 0) -> bool:
+		conn = self._conn()
+		# Take the write lock before reading, so nobody can change the row in between
+		conn.execute('BEGIN IMMEDIATE')
+		try:
+			if self._get(conn, namespace, key) != expected:
+				conn.execute('ROLLBACK')
+				return False
+			if value is None:
+				conn.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+			else:
+				conn.execute(
+					'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)',
+					(namespace, key, value, self._expire_at(ttl))
+				)
+			conn.execute('COMMIT')
+			return True
+		except:
+			conn.execute('ROLLBACK')
+			raise
+
+	def delete(self, namespace: str, key: str):
+		self._conn().execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+
+	def purge(self):
+		self._conn().execute('DELETE FROM state WHERE expire_at != 0 AND expire_at <= ?', (time(),))
+
+	def close(self):
+		with self._connections_lock:
+			for conn in self._connections:
+				conn.close()
+			self._connections.clear()
+		self._local = threading.local()
+
+def create_backend(spec: str) -> StateBackend:
+	'''
+	"memory" for the in-process backend, or "sqlite:<path>" for the SQLite backend.
+	'''
+	if spec == '' or spec == 'memory':
+		return MemoryBackend()
+	if spec.startswith('sqlite:'):
+		return SQLiteBackend(spec[len('sqlite:'):])
+	raise ValueError(f'Unknown state backend: {spec}')
+
+__all__ = ['StateBackend', 'MemoryBackend', 'SQLiteBackend', 'create_backend']
@@ -0,0 +1,94 @@
+'''
+This package defines where the bot keeps its data: the maids, the installations, the weights,
+the random generators, the variables and the polls. STORAGE_BACKEND chooses one of:
+
+- "mongo": MongoDB, the same collections as before.
+- "sqlite": a local SQLite file at STORAGE_SQLITE_PATH.
+- "memory": nothing persisted, e.g. for tests and benchmarks.
+
+Without Mongo, the maids are read from STORAGE_MAID_LIST_PATH, a YAML (or JSON) list of
+{name, display_name, avatar}; SQLite copies them into its table once if the table is empty.
+With STORAGE_VERIFY_SCHEMA, the queries which would scan a whole collection are printed when ready.
+With STORAGE_JOURNAL_PATH, the mutations are journaled in that directory and replicated to the backend
+in the background, so the commands do not wait for the backend; see journal.py.
+'''
+from __future__ import annotations
+import yaml
+from typing import Optional, TYPE_CHECKING
+from ..utils import generate_config
+from .base import *
+
+if TYPE_CHECKING:
+	from pymongo.database import Database
+
+config = generate_config(
+	STORAGE_BACKEND = {'default': 'mongo'},
+	STORAGE_SQLITE_PATH = {'default': 'maidbot.db'},
+	STORAGE_MAID_LIST_PATH = {'default': ''},
+	STORAGE_VERIFY_SCHEMA = {'default': False, 'cast': bool},
+	STORAGE_JOURNAL_PATH = {'default': ''},
+	STORAGE_JOURNAL_SEGMENT_SIZE = {'default': 16 * 1024 * 1024, 'cast': int},
+	STORAGE_JOURNAL_SYNC_INTERVAL = {'default': 0.005, 'cast': float},
+	STORAGE_JOURNAL_REPLICATE_INTERVAL = {'default': 1.0, 'cast': float},
+	STORAGE_JOURNAL_REPLICATE_BATCH = {'default': 500, 'cast': int},
+	STORAGE_JOURNAL_MAX_ATTEMPTS = {'default': 5, 'cast': int},
+)
+
+def _read_maid_list(path: str) -> list[Document]:
+	if not path:
+		return []
+	with open(path, encoding = 'utf-8') as f:
+		return yaml.safe_load(f) or []
+
+def _create_backend(db: Optional[Database], backend: str) -> Storage:
+	if backend == 'mongo':
+		if db is None:
+			raise ValueError('The mongo storage needs a database')
+		from .mongo import MongoStorage
+		return MongoStorage(db)
+	if backend == 'sqlite':
+		from .sqlite import SQLiteStorage
+		return SQLiteStorage(config['STORAGE_SQLITE_PATH'], _read_maid_list(config['STORAGE_MAID_LIST_PATH']))
+	if backend == 'memory':
+		from .memory import MemoryStorage
+		return MemoryStorage(_read_maid_list(config['STORAGE_MAID_LIST_PATH']))
+	raise ValueError(f'Unknown storage backend: {backend}')
+
+def create_storage(db: Optional[Database] = None, backend: Optional[str] = None, journal_path: Optional[str] = None) -> Storage:
+	# `db` is only needed (and only connected) for Mongo
+	if backend is None:
+		backend = config['STORAGE_BACKEND']
+	if journal_path is None:
+		journal_path = config['STORAGE_JOURNAL_PATH']
+
+	storage = _create_backend(db, backend)
+	if not journal_path:
+		return storage
+
+	from .journal import Journal, JournaledStorage
+	journal = Journal(
+		journal_path,
+		segment_size = config['STORAGE_JOURNAL_SEGMENT_SIZE'],
+		sync_interval = config['STORAGE_JOURNAL_SYNC_INTERVAL']
+	)
+	return JournaledStorage(
+		storage,
+		journal,
+		interval = config['STORAGE_JOURNAL_REPLICATE_INTERVAL'],
+		batch_size = config['STORAGE_JOURNAL_REPLICATE_BATCH'],
+		max_attempts = config['STORAGE_JOURNAL_MAX_ATTEMPTS']
+	)
+
+__all__ = [
+	'Document',
+	'Hooks',
+	'Vote',
+	'Repository',
+	'MaidRepository',
+	'InstallationRepository',
+	'DocumentRepository',
+	'VariableRepository',
+	'PollRepository',
+	'Storage',
+	'create_storage',
+]
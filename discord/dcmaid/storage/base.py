@@ -0,0 +1,256 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Hashable, Mapping
+from typing import Any, Optional, TypeVar
+from ..asyncdb import run_in_executor
+
+Document = dict[str, Any]
+# maid name: {'hook_id': int, 'digest': str, 'pool': [int]}
+Hooks = dict[str, dict[str, Any]]
+
+T = TypeVar('T')
+R = TypeVar('R', bound = 'Repository')
+
+class Repository:
+	'''
+	The methods ending with "_sync" are the primitives implemented by the backends.
+	They block, so they are only called directly before the loop starts (or by codecs);
+	the coroutines wrapping them are for the rest.
+	'''
+	# Whether the primitives wait for the network, so they run in the thread pool.
+	# Local backends run them in the loop directly, which is cheaper than a thread hop.
+	blocking: bool = False
+
+	def __init__(self, name: str):
+		self.name = name
+
+	async def _run(self, f: Callable[..., T], *args, **kwargs) -> T:
+		if self.blocking:
+			return await run_in_executor(f, *args, **kwargs)
+		return f(*args, **kwargs)
+
+class MaidRepository(Repository, ABC):
+	@abstractmethod
+	def all_sync(self) -> list[Document]:
+		# {'name': str, 'display_name': str, 'avatar': str} in order
+		...
+
+class InstallationRepository(Repository, ABC):
+	'''
+	One installation per channel: the guild id and the hooks of the maids.
+	The legacy flag means the backend still holds the old schema of the channel,
+	and the next save() cleans it up.
+	'''
+	@abstractmethod
+	def find_channel_sync(self, channel_id: int) -> tuple[Hooks, bool]:
+		...
+
+	@abstractmethod
+	def find_guild_sync(self, guild_id: int) -> dict[int, tuple[Hooks, bool]]:
+		...
+
+	@abstractmethod
+	def save_sync(self, channel_id: int, guild_id: int, hooks: Mapping[str, dict[str, Any]], legacy: bool):
+		...
+
+	@abstractmethod
+	def delete_sync(self, channel_id: int):
+		...
+
+	def migrate_sync(self):
+		# Only Mongo has the old schema
+		pass
+
+	async def find_channel(self, channel_id: int) -> tuple[Hooks, bool]:
+		return await self._run(self.find_channel_sync, channel_id)
+
+	async def find_guild(self, guild_id: int) -> dict[int, tuple[Hooks, bool]]:
+		return await self._run(self.find_guild_sync, guild_id)
+
+	async def save(self, channel_id: int, guild_id: int, hooks: Mapping[str, dict[str, Any]], legacy: bool):
+		await self._run(self.save_sync, channel_id, guild_id, hooks, legacy)
+
+	async def delete(self, channel_id: int):
+		await self._run(self.delete_sync, channel_id)
+
+class DocumentRepository(Repository, ABC):
+	'''
+	Documents keyed by some fields, written back by WriteBehind.
+	The key of a document is the value of the field, or the tuple of the values if there are more.
+	The key fields are put into the documents by the repository, so the writers can omit them.
+	'''
+	def __init__(self, name: str, key_fields: tuple[str, ...]):
+		super().__init__(name)
+		self.key_fields = key_fields
+
+	def filter(self, key: Hashable) -> Document:
+		if len(self.key_fields) == 1:
+			return {self.key_fields[0]: key}
+		assert isinstance(key, tuple)
+		return dict(zip(self.key_fields, key))
+
+	@abstractmethod
+	def find_sync(self, key: Hashable) -> Optional[Document]:
+		...
+
+	@abstractmethod
+	def all_sync(self, limit: int = 0, has: tuple[str, ...] = ()) -> list[Document]:
+		# At most `limit` documents (zero for all) having all the fields of `has`
+		...
+
+	@abstractmethod
+	def write_many_sync(self, batch: Mapping[Hashable, Optional[Document]]):
+		# None deletes the document
+		...
+
+	async def find(self, key: Hashable) -> Optional[Document]:
+		return await self._run(self.find_sync, key)
+
+	async def write_many(self, batch: Mapping[Hashable, Optional[Document]]):
+		await self._run(self.write_many_sync, batch)
+
+class VariableRepository(Repository, ABC):
+	@abstractmethod
+	def scopes_sync(self) -> list[tuple[str, int, list[Document]]]:
+		# (scope type, scope id, [{'name': str, 'type': str, 'value': str}])
+		...
+
+	@abstractmethod
+	def insert_sync(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		...
+
+	@abstractmethod
+	def update_sync(self, scope_id: int, name: str, type: str, value: str):
+		...
+
+	@abstractmethod
+	def delete_sync(self, scope_id: int, name: str):
+		...
+
+	@abstractmethod
+	def delete_scope_sync(self, scope_type: str, scope_id: int):
+		...
+
+	async def scopes(self) -> list[tuple[str, int, list[Document]]]:
+		return await self._run(self.scopes_sync)
+
+	async def insert(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		await self._run(self.insert_sync, scope_type, scope_id, name, type, value)
+
+	async def update(self, scope_id: int, name: str, type: str, value: str):
+		await self._run(self.update_sync, scope_id, name, type, value)
+
+	async def delete(self, scope_id: int, name: str):
+		await self._run(self.delete_sync, scope_id, name)
+
+	async def delete_scope(self, scope_type: str, scope_id: int):
+		await self._run(self.delete_scope_sync, scope_type, scope_id)
+
+# (poll uuid, member id, option, the new count)
+Vote = tuple[Any, int, str, int]
+
+class PollRepository(Repository, ABC):
+	@abstractmethod
+	def all_sync(self) -> list[Document]:
+		...
+
+	@abstractmethod
+	def insert_sync(self, document: Document):
+		...
+
+	@abstractmethod
+	def delete_sync(self, uuid: Any):
+		...
+
+	@abstractmethod
+	def set_votes_sync(self, votes: list[Vote]):
+		...
+
+	async def all(self) -> list[Document]:
+		return await self._run(self.all_sync)
+
+	async def insert(self, document: Document):
+		await self._run(self.insert_sync, document)
+
+	async def delete(self, uuid: Any):
+		await self._run(self.delete_sync, uuid)
+
+	async def set_votes(self, votes: list[Vote]):
+		if len(votes) > 0:
+			await self._run(self.set_votes_sync, votes)
+
+class Storage(ABC):
+	'''
+	The repositories by names (collections in Mongo, tables in SQLite).
+	The same name always gives the same repository.
+	'''
+	def __init__(self):
+		self._repositories: dict[str, Repository] = {}
+
+	def _get(self, name: str, kind: type[R], factory: Callable[[], R]) -> R:
+		repo = self._repositories.get(name)
+		if repo is None:
+			repo = self._repositories[name] = factory()
+		if not isinstance(repo, kind):
+			raise TypeError(f'{name} is already used by a {type(repo).__name__}')
+		return repo
+
+	def maids(self, name: str) -> MaidRepository:
+		return self._get(name, MaidRepository, lambda: self._maids(name))
+
+	def installations(self, name: str) -> InstallationRepository:
+		return self._get(name, InstallationRepository, lambda: self._installations(name))
+
+	def documents(self, name: str, key_fields: tuple[str, ...], unique: bool = False) -> DocumentRepository:
+		# `unique` asks Mongo to enforce the key; the other backends are keyed by it anyway
+		return self._get(name, DocumentRepository, lambda: self._documents(name, key_fields, unique))
+
+	def variables(self, name: str) -> VariableRepository:
+		return self._get(name, VariableRepository, lambda: self._variables(name))
+
+	def polls(self, name: str) -> PollRepository:
+		return self._get(name, PollRepository, lambda: self._polls(name))
+
+	@abstractmethod
+	def _maids(self, name: str) -> MaidRepository:
+		...
+
+	@abstractmethod
+	def _installations(self, name: str) -> InstallationRepository:
+		...
+
+	@abstractmethod
+	def _documents(self, name: str, key_fields: tuple[str, ...], unique: bool) -> DocumentRepository:
+		...
+
+	@abstractmethod
+	def _variables(self, name: str) -> VariableRepository:
+		...
+
+	@abstractmethod
+	def _polls(self, name: str) -> PollRepository:
+		...
+
+	def verify_sync(self) -> list[str]:
+		# The queries that would scan a whole collection or table; see schema.py
+		return []
+
+	async def flush(self):
+		# Write back what the storage holds for later, before close()
+		pass
+
+	def close(self):
+		pass
+
+__all__ = [
+	'Document',
+	'Hooks',
+	'Vote',
+	'Repository',
+	'MaidRepository',
+	'InstallationRepository',
+	'DocumentRepository',
+	'VariableRepository',
+	'PollRepository',
+	'Storage',
+]
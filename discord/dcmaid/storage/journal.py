@@ -0,0 +1,637 @@
+'''
+A local write-ahead journal in front of another storage.
+The mutations of the documents, the variables and the polls are appended to a memory-mapped
+segment file and acknowledged once the segment is synced to disk; the syncs of the mutations
+arriving within STORAGE_JOURNAL_SYNC_INTERVAL are done at once in the executor (group commit).
+A background task replicates the journaled mutations to the storage behind in batches,
+and the segments replicated as a whole are deleted. While the storage behind fails, the task backs off.
+A mutation failing STORAGE_JOURNAL_MAX_ATTEMPTS times while the next one succeeds is moved to
+the dead-letters file of the directory, so one bad mutation cannot hold back the others forever.
+If the bot crashes, the mutations not replicated yet are journaled again when the journal is opened
+at the next start, and the old segments are deleted right away, so they are replicated in order before
+anything new. Replaying twice does no harm since every mutation is replayed idempotently.
+A write whose sync fails raises, but its mutation is still replicated; see JournaledStorage.write().
+The maids and the installations are not journaled.
+'''
+from __future__ import annotations
+import asyncio
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+from asyncio import get_running_loop
+from collections import deque
+from collections.abc import Hashable, Mapping
+from itertools import islice
+from typing import Any, Optional, TYPE_CHECKING
+from ..asyncdb import run_in_executor
+from .base import *
+
+if TYPE_CHECKING:
+	from asyncio import AbstractEventLoop, Future, Task, TimerHandle
+
+MAGIC = b'MAIDJNL1'
+# magic, the last replicated sequence number
+_HEADER = struct.Struct('<8sQ')
+# length and crc32 of the payload
+_RECORD = struct.Struct('<II')
+_SUFFIX = '.journal'
+_DEAD_LETTERS = 'dead-letters'
+# The longest wait between the rounds of replication while the storage behind fails
+_MAX_BACKOFF = 60.0
+
+# (repository kind, repository name, parameters of the repository, operation, arguments)
+Record = tuple[str, str, tuple, str, tuple]
+
+def _sync_directory(path: str):
+	# The creations and removals of the files in it are only durable after this
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+class _Segment:
+	def __init__(self, path: str, size: int = 0):
+		# A positive size creates the segment
+		with open(path, 'w+b' if size > 0 else 'r+b') as f:
+			if size > 0:
+				f.truncate(size)
+			self.mm = mmap.mmap(f.fileno(), 0)
+		self.path = path
+		self.size = len(self.mm)
+		self.offset = _HEADER.size
+		self.synced = 0
+		self.last_seq = 0
+		self._header_dirty = False
+		if size > 0:
+			_HEADER.pack_into(self.mm, 0, MAGIC, 0)
+
+	def read(self) -> list[tuple[int, Record]]:
+		# The records not replicated yet, up to the first torn one
+		magic, replicated = _HEADER.unpack_from(self.mm, 0)
+		if magic != MAGIC:
+			raise ValueError(f'{self.path} is not a journal segment')
+
+		records = []
+		while self.offset + _RECORD.size <= self.size:
+			length, crc = _RECORD.unpack_from(self.mm, self.offset)
+			start = self.offset + _RECORD.size
+			if length == 0 or start + length > self.size:
+				break
+			payload = self.mm[start:start + length]
+			if zlib.crc32(payload) != crc:
+				# Torn by a crash; nothing after it was acknowledged
+				break
+			seq, record = pickle.loads(payload)
+			self.offset = start + length
+			self.last_seq = seq
+			if seq > replicated:
+				records.append((seq, record))
+		self.synced = self.offset
+		return records
+
+	def append(self, seq: int, payload: bytes) -> bool:
+		end = self.offset + _RECORD.size + len(payload)
+		if end > self.size:
+			return False
+		self.mm[self.offset + _RECORD.size:end] = payload
+		_RECORD.pack_into(self.mm, self.offset, len(payload), zlib.crc32(payload))
+		self.offset = end
+		self.last_seq = seq
+		return True
+
+	def sync(self):
+		# The loop may append meanwhile, which the next sync covers
+		offset = self.offset
+		if self.synced < offset:
+			# msync needs a page-aligned offset
+			start = self.synced - self.synced % mmap.PAGESIZE
+			self.mm.flush(start, offset - start)
+			self.synced = offset
+		if self._header_dirty:
+			self._header_dirty = False
+			self.mm.flush(0, _HEADER.size)
+
+	def checkpoint(self, seq: int):
+		# Synced lazily; a lost checkpoint only replays more
+		_HEADER.pack_into(self.mm, 0, MAGIC, seq)
+		self._header_dirty = True
+
+	def close(self):
+		if not self.mm.closed:
+			self.mm.close()
+
+	def remove(self):
+		self.close()
+		os.remove(self.path)
+
+class Journal:
+	'''
+	The segments of a directory, named by their indexes.
+	The records left by the last run are read into `recovered` when opened, and their segments
+	are kept until release_recovered(), which must follow once they are journaled again or replicated;
+	the new records go to new segments.
+	'''
+	def __init__(self, directory: str, segment_size: int = 16 * 1024 * 1024, sync_interval: float = 0.005):
+		os.makedirs(directory, exist_ok = True)
+		self.directory = directory
+		self.segment_size = segment_size
+		self.sync_interval = sync_interval
+		self.recovered: list[tuple[int, Record]] = []
+		self._recovered_paths: list[str] = []
+		self._seq = 0
+		self._index = 0
+
+		for name in sorted(os.listdir(directory)):
+			if not name.endswith(_SUFFIX):
+				continue
+			path = os.path.join(directory, name)
+			self._index = max(self._index, int(name[:-len(_SUFFIX)]))
+			if os.path.getsize(path) < _HEADER.size:
+				# Crashed when creating it
+				os.remove(path)
+				continue
+			segment = _Segment(path)
+			try:
+				self.recovered.extend(segment.read())
+			finally:
+				segment.close()
+			self._seq = max(self._seq, segment.last_seq)
+			self._recovered_paths.append(path)
+
+		if len(self.recovered) == 0:
+			self.release_recovered()
+
+		self._segments: deque[_Segment] = deque()
+		# Whether a segment is created or removed since the last sync
+		self._directory_dirty = False
+		self._rotate(0)
+		# Replicated segments, removed by the next sync since it may be flushing them
+		self._retired: list[_Segment] = []
+		# One sync at a time, in the executor or not
+		self._lock = threading.Lock()
+		self._waiters: list[Future] = []
+		self._timer: Optional[TimerHandle] = None
+		self._sync_task: Optional[Task] = None
+
+	def _rotate(self, length: int):
+		# The new segment holds the record of the length at least
+		self._index += 1
+		path = os.path.join(self.directory, f'{self._index:08d}{_SUFFIX}')
+		self._segments.append(_Segment(path, max(self.segment_size, _HEADER.size + _RECORD.size + length)))
+		# Synced with the records, so a record is never acknowledged in a segment that may vanish
+		self._directory_dirty = True
+
+	def append(self, record: Record) -> int:
+		# Not durable until sync() or commit()
+		self._seq += 1
+		payload = pickle.dumps((self._seq, record), pickle.HIGHEST_PROTOCOL)
+		if not self._segments[-1].append(self._seq, payload):
+			self._rotate(len(payload))
+			self._segments[-1].append(self._seq, payload)
+		return self._seq
+
+	def sync(self):
+		# Blocks on the disk; the loop runs it in the executor
+		with self._lock:
+			for segment in list(self._segments):
+				segment.sync()
+			while len(self._retired) > 0:
+				self._retired.pop().remove()
+				self._directory_dirty = True
+			if self._directory_dirty:
+				self._directory_dirty = False
+				_sync_directory(self.directory)
+
+	async def commit(self):
+		# Wait for the sync covering everything appended so far, shared by the callers meanwhile
+		loop = get_running_loop()
+		waiter = loop.create_future()
+		self._waiters.append(waiter)
+		self._schedule(loop)
+		await waiter
+
+	def _schedule(self, loop: AbstractEventLoop):
+		# Whatever arrives during a sync waits for the next one
+		if self._timer is None and self._sync_task is None:
+			self._timer = loop.call_later(self.sync_interval, self._start_sync)
+
+	def _start_sync(self):
+		self._timer = None
+		self._sync_task = get_running_loop().create_task(self._sync_waiters())
+
+	async def _sync_waiters(self):
+		waiters, self._waiters = self._waiters, []
+		try:
+			await run_in_executor(self.sync)
+		except Exception as e:
+			for waiter in waiters:
+				if not waiter.done():
+					waiter.set_exception(e)
+		else:
+			for waiter in waiters:
+				if not waiter.done():
+					waiter.set_result(None)
+		finally:
+			self._sync_task = None
+			if len(self._waiters) > 0:
+				self._schedule(get_running_loop())
+
+	def checkpoint(self, seq: int):
+		# Everything up to seq is replicated; the header and the removals are synced lazily
+		while len(self._segments) > 1 and self._segments[0].last_seq <= seq:
+			self._retired.append(self._segments.popleft())
+		self._segments[0].checkpoint(seq)
+
+		try:
+			loop = get_running_loop()
+		except RuntimeError:
+			self.sync()
+			return
+		self._schedule(loop)
+
+	def dead_letter(self, seq: int, record: Record, error: str):
+		# Framed like the segments; durable before the record leaves the journal
+		payload = pickle.dumps((seq, record, error), pickle.HIGHEST_PROTOCOL)
+		path = os.path.join(self.directory, _DEAD_LETTERS)
+		created = not os.path.exists(path)
+		with open(path, 'ab') as f:
+			f.write(_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+			f.flush()
+			os.fsync(f.fileno())
+		if created:
+			_sync_directory(self.directory)
+
+	def release_recovered(self):
+		# The records of the last run are all replayed
+		for path in self._recovered_paths:
+			os.remove(path)
+		if len(self._recovered_paths) > 0:
+			# Or they may come back after a crash and be replayed over newer data
+			_sync_directory(self.directory)
+		self._recovered_paths = []
+		self.recovered = []
+
+	def close(self):
+		if self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
+		self.sync()
+		waiters, self._waiters = self._waiters, []
+		for waiter in waiters:
+			if not waiter.done():
+				waiter.set_result(None)
+		with self._lock:
+			for segment in self._segments:
+				segment.close()
+
+class _JournaledRepository:
+	# The method of Storage creating the repository
+	kind = ''
+
+	def __init__(self, storage: JournaledStorage, inner: Any, *args):
+		super().__init__(inner.name, *args)  # type: ignore[call-arg]
+		self.storage = storage
+		self.inner = inner
+		# The arguments of the method besides the name
+		self.params: tuple = ()
+
+	def _record(self, op: str, args: tuple) -> Record:
+		return (self.kind, self.name, self.params, op, args)
+
+	def _apply(self, op: str, args: tuple):
+		# Replicate a record; overridden where the plain call is not idempotent
+		getattr(self.inner, f'{op}_sync')(*args)
+
+	def _journaled(self, seq: int, op: str, args: tuple):
+		pass
+
+	def _replicated(self, seq: int, op: str, args: tuple):
+		pass
+
+class JournaledDocumentRepository(_JournaledRepository, DocumentRepository):
+	kind = 'documents'
+
+	def __init__(self, storage: JournaledStorage, inner: DocumentRepository, unique: bool):
+		super().__init__(storage, inner, inner.key_fields)
+		self.params = (inner.key_fields, unique)
+		# key: (seq, document) journaled but not replicated, which is newer than the storage behind
+		self._unreplicated: dict[Hashable, tuple[int, Optional[Document]]] = {}
+
+	def _apply(self, op: str, args: tuple):
+		# The batch is journaled as pairs, so consecutive batches can be concatenated
+		pairs, = args
+		self.inner.write_many_sync(dict(pairs))
+
+	def _journaled(self, seq: int, op: str, args: tuple):
+		for key, document in args[0]:
+			self._unreplicated[key] = (seq, document)
+
+	def _replicated(self, seq: int, op: str, args: tuple):
+		for key, _ in args[0]:
+			if key in self._unreplicated and self._unreplicated[key][0] == seq:
+				del self._unreplicated[key]
+
+	def find_sync(self, key: Hashable) -> Optional[Document]:
+		if key in self._unreplicated:
+			return self._unreplicated[key][1]
+		return self.inner.find_sync(key)
+
+	async def find(self, key: Hashable) -> Optional[Document]:
+		if key in self._unreplicated:
+			return self._unreplicated[key][1]
+		return await self.inner.find(key)
+
+	def all_sync(self, limit: int = 0, has: tuple[str, ...] = ()) -> list[Document]:
+		self.storage.settle_sync()
+		return self.inner.all_sync(limit, has)
+
+	def write_many_sync(self, batch: Mapping[Hashable, Optional[Document]]):
+		self.storage.write_sync(self, 'write_many', (list(batch.items()), ))
+
+	async def write_many(self, batch: Mapping[Hashable, Optional[Document]]):
+		await self.storage.write(self, 'write_many', (list(batch.items()), ))
+
+class JournaledVariableRepository(_JournaledRepository, VariableRepository):
+	kind = 'variables'
+
+	def _apply(self, op: str, args: tuple):
+		if op == 'insert':
+			# Replayed after the insertion reached the storage, which must not duplicate it
+			scope_type, scope_id, name, type, value = args
+			self.inner.delete_sync(scope_id, name)
+		super()._apply(op, args)
+
+	def scopes_sync(self) -> list[tuple[str, int, list[Document]]]:
+		self.storage.settle_sync()
+		return self.inner.scopes_sync()
+
+	def insert_sync(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		self.storage.write_sync(self, 'insert', (scope_type, scope_id, name, type, value))
+
+	def update_sync(self, scope_id: int, name: str, type: str, value: str):
+		self.storage.write_sync(self, 'update', (scope_id, name, type, value))
+
+	def delete_sync(self, scope_id: int, name: str):
+		self.storage.write_sync(self, 'delete', (scope_id, name))
+
+	def delete_scope_sync(self, scope_type: str, scope_id: int):
+		self.storage.write_sync(self, 'delete_scope', (scope_type, scope_id))
+
+	async def scopes(self) -> list[tuple[str, int, list[Document]]]:
+		await self.storage.settle()
+		return await self.inner.scopes()
+
+	async def insert(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		await self.storage.write(self, 'insert', (scope_type, scope_id, name, type, value))
+
+	async def update(self, scope_id: int, name: str, type: str, value: str):
+		await self.storage.write(self, 'update', (scope_id, name, type, value))
+
+	async def delete(self, scope_id: int, name: str):
+		await self.storage.write(self, 'delete', (scope_id, name))
+
+	async def delete_scope(self, scope_type: str, scope_id: int):
+		await self.storage.write(self, 'delete_scope', (scope_type, scope_id))
+
+class JournaledPollRepository(_JournaledRepository, PollRepository):
+	kind = 'polls'
+
+	def _apply(self, op: str, args: tuple):
+		if op == 'insert':
+			self.inner.delete_sync(args[0]['uuid'])
+		super()._apply(op, args)
+
+	def all_sync(self) -> list[Document]:
+		self.storage.settle_sync()
+		return self.inner.all_sync()
+
+	def insert_sync(self, document: Document):
+		self.storage.write_sync(self, 'insert', (document, ))
+
+	def delete_sync(self, uuid: Any):
+		self.storage.write_sync(self, 'delete', (uuid, ))
+
+	def set_votes_sync(self, votes: list[Vote]):
+		self.storage.write_sync(self, 'set_votes', (votes, ))
+
+	async def all(self) -> list[Document]:
+		await self.storage.settle()
+		return await self.inner.all()
+
+	async def insert(self, document: Document):
+		await self.storage.write(self, 'insert', (document, ))
+
+	async def delete(self, uuid: Any):
+		await self.storage.write(self, 'delete', (uuid, ))
+
+	async def set_votes(self, votes: list[Vote]):
+		if len(votes) > 0:
+			await self.storage.write(self, 'set_votes', (votes, ))
+
+# Consecutive records of these operations on the same repository are replicated in one call
+_CONCATENATED = frozenset(('write_many', 'set_votes'))
+
+class JournaledStorage(Storage):
+	def __init__(self, inner: Storage, journal: Journal, interval: float = 1.0, batch_size: int = 500, max_attempts: int = 5):
+		super().__init__()
+		self.inner = inner
+		self.journal = journal
+		self.interval = interval
+		self.batch_size = batch_size
+		self.max_attempts = max_attempts
+		# (seq, repository, operation, arguments) journaled but not replicated, in order
+		self._queue: deque[tuple[int, _JournaledRepository, str, tuple]] = deque()
+		self._replicate_lock = asyncio.Lock()
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+		self._closed = False
+		# The rounds failed in a row
+		self._failures = 0
+		# (seq, attempts) of the record at the head failing alone
+		self._attempts = (0, 0)
+		self._recover()
+
+	def _recover(self):
+		# The records of the last run go before everything new, and their old segments must not
+		# outlive this, or they would be replayed over newer data at a later start
+		if len(self.journal.recovered) == 0:
+			return
+		for _, (kind, name, params, op, args) in self.journal.recovered:
+			self._append(getattr(self, kind)(name, *params), op, args)
+		self.journal.sync()
+		self.journal.release_recovered()
+
+	def _maids(self, name: str) -> MaidRepository:
+		return self.inner.maids(name)
+
+	def _installations(self, name: str) -> InstallationRepository:
+		return self.inner.installations(name)
+
+	def _documents(self, name: str, key_fields: tuple[str, ...], unique: bool) -> DocumentRepository:
+		return JournaledDocumentRepository(self, self.inner.documents(name, key_fields, unique), unique)
+
+	def _variables(self, name: str) -> VariableRepository:
+		return JournaledVariableRepository(self, self.inner.variables(name))
+
+	def _polls(self, name: str) -> PollRepository:
+		return JournaledPollRepository(self, self.inner.polls(name))
+
+	def _append(self, repo: _JournaledRepository, op: str, args: tuple):
+		seq = self.journal.append(repo._record(op, args))
+		self._queue.append((seq, repo, op, args))
+		repo._journaled(seq, op, args)
+
+	def _kick(self):
+		try:
+			loop = get_running_loop()
+		except RuntimeError:
+			loop = None
+
+		if loop is None or self._closed:
+			# Nobody will replicate for us, so do it now
+			self.settle_sync()
+			return
+
+		if self._task is None or self._task.done():
+			self._task = loop.create_task(self._run())
+
+		if len(self._queue) >= self.batch_size and self._failures == 0:
+			self._wakeup.set()
+
+	def write_sync(self, repo: _JournaledRepository, op: str, args: tuple):
+		self._append(repo, op, args)
+		self.journal.sync()
+		self._kick()
+
+	async def write(self, repo: _JournaledRepository, op: str, args: tuple):
+		'''
+		Returns once durable in the journal, long before replicated.
+		If the sync fails, the error is raised but the record stays in the queue: it is in the segment
+		already and a later sync may still make it durable, so dropping it here could not undo it after a crash.
+		Like a timeout of a db, a failed write may or may not be applied; in this run it is replicated.
+		'''
+		self._append(repo, op, args)
+		await self.journal.commit()
+		self._kick()
+
+	@staticmethod
+	def _coalesce(batch: list[tuple[int, _JournaledRepository, str, tuple]]) -> list[tuple[_JournaledRepository, str, tuple]]:
+		calls: list[tuple[_JournaledRepository, str, tuple]] = []
+		for _, repo, op, args in batch:
+			if op in _CONCATENATED and len(calls) > 0 and calls[-1][0] is repo and calls[-1][1] == op:
+				calls[-1] = (repo, op, (calls[-1][2][0] + args[0], ))
+			else:
+				calls.append((repo, op, args))
+		return calls
+
+	@staticmethod
+	def _apply_calls(calls: list[tuple[_JournaledRepository, str, tuple]]):
+		for repo, op, args in calls:
+			repo._apply(op, args)
+
+	def _done(self, batch: list[tuple[int, _JournaledRepository, str, tuple]]):
+		for _ in batch:
+			self._queue.popleft()
+		for seq, repo, op, args in batch:
+			repo._replicated(seq, op, args)
+		self.journal.checkpoint(batch[-1][0])
+
+	async def _run(self):
+		while not self._closed:
+			delay = min(self.interval * 2 ** min(self._failures, 16), max(self.interval, _MAX_BACKOFF))
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), delay)
+			except TimeoutError:
+				pass
+			self._wakeup.clear()
+
+			try:
+				await self.settle()
+				self._failures = 0
+			except Exception as e:
+				# The records stay in the queue (and in the journal) and are retried in the next round
+				self._failures += 1
+				print(f'Failed to replicate the journal: {e!r}')
+
+	async def _replicate(self, batch: list[tuple[int, _JournaledRepository, str, tuple]]):
+		calls = self._coalesce(batch)
+		if any(repo.inner.blocking for repo, _, _ in calls):
+			await run_in_executor(self._apply_calls, calls)
+		else:
+			self._apply_calls(calls)
+
+	async def settle(self):
+		# Replicate everything journaled so far
+		async with self._replicate_lock:
+			while len(self._queue) > 0:
+				batch = list(islice(self._queue, self.batch_size))
+				try:
+					await self._replicate(batch)
+				except Exception:
+					# Find the failing record; the ones before it may be replicated twice, which is harmless
+					last = batch[-1][0]
+					while len(self._queue) > 0 and self._queue[0][0] <= last:
+						await self._replicate_head()
+					continue
+				self._done(batch)
+
+	async def _replicate_head(self):
+		head = self._queue[0]
+		try:
+			await self._replicate([head])
+		except Exception as e:
+			if not await self._dead_letter(head, e):
+				raise
+			return
+		self._done([head])
+
+	async def _dead_letter(self, head: tuple[int, _JournaledRepository, str, tuple], error: Exception) -> bool:
+		# Drop the head if it keeps failing while the storage behind takes the record after it
+		seq, repo, op, args = head
+		attempts = self._attempts[1] + 1 if self._attempts[0] == seq else 1
+		self._attempts = (seq, attempts)
+		if attempts < self.max_attempts or len(self._queue) < 2:
+			return False
+
+		following = self._queue[1]
+		# Raises if the storage behind is just down
+		await self._replicate([following])
+		await run_in_executor(self.journal.dead_letter, seq, repo._record(op, args), repr(error))
+		print(f'Dead-lettered the journal record {seq} of {repo.name} after {attempts} attempts: {error!r}')
+		self._queue.popleft()
+		repo._replicated(seq, op, args)
+		self._done([following])
+		return True
+
+	def settle_sync(self):
+		# Only before the loop starts or after it stops, when no batch is being replicated
+		if self._replicate_lock.locked():
+			raise RuntimeError('A batch is being replicated in the loop')
+		while len(self._queue) > 0:
+			batch = list(islice(self._queue, self.batch_size))
+			self._apply_calls(self._coalesce(batch))
+			self._done(batch)
+
+	async def flush(self):
+		self._closed = True
+		if self._task is not None and not self._task.done():
+			self._wakeup.set()
+			await self._task
+		try:
+			await self.settle()
+		except Exception as e:
+			# Replayed at the next start
+			print(f'Failed to replicate the journal before closing: {e!r}')
+
+	def verify_sync(self) -> list[str]:
+		return self.inner.verify_sync()
+
+	def close(self):
+		self.journal.close()
+		self.inner.close()
+
+__all__ = ['Journal', 'JournaledStorage']
@@ -0,0 +1,134 @@
+'''
+The repositories in the process, lost on exit.
+Documents are copied in and out, so nobody shares them with the store, as with a real db.
+'''
+from __future__ import annotations
+from collections.abc import Hashable, Mapping
+from copy import deepcopy
+from typing import Any, Optional
+from .base import *
+
+class MemoryMaidRepository(MaidRepository):
+	def __init__(self, name: str, maids: list[Document]):
+		super().__init__(name)
+		self._maids = maids
+
+	def all_sync(self) -> list[Document]:
+		return deepcopy(self._maids)
+
+class MemoryInstallationRepository(InstallationRepository):
+	def __init__(self, name: str):
+		super().__init__(name)
+		# channel id: (guild id, hooks)
+		self._d: dict[int, tuple[int, Hooks]] = {}
+
+	def find_channel_sync(self, channel_id: int) -> tuple[Hooks, bool]:
+		if channel_id not in self._d:
+			return ({}, False)
+		return (deepcopy(self._d[channel_id][1]), False)
+
+	def find_guild_sync(self, guild_id: int) -> dict[int, tuple[Hooks, bool]]:
+		return {
+			channel_id: (deepcopy(hooks), False)
+			for channel_id, (g, hooks) in self._d.items()
+			if g == guild_id
+		}
+
+	def save_sync(self, channel_id: int, guild_id: int, hooks: Mapping[str, dict[str, Any]], legacy: bool):
+		self._d[channel_id] = (guild_id, deepcopy(dict(hooks)))
+
+	def delete_sync(self, channel_id: int):
+		self._d.pop(channel_id, None)
+
+class MemoryDocumentRepository(DocumentRepository):
+	def __init__(self, name: str, key_fields: tuple[str, ...]):
+		super().__init__(name, key_fields)
+		self._d: dict[Hashable, Document] = {}
+
+	def find_sync(self, key: Hashable) -> Optional[Document]:
+		document = self._d.get(key)
+		return None if document is None else deepcopy(document)
+
+	def all_sync(self, limit: int = 0, has: tuple[str, ...] = ()) -> list[Document]:
+		result = []
+		for document in self._d.values():
+			if limit > 0 and len(result) >= limit:
+				break
+			if all(field in document for field in has):
+				result.append(deepcopy(document))
+		return result
+
+	def write_many_sync(self, batch: Mapping[Hashable, Optional[Document]]):
+		for key, document in batch.items():
+			if document is None:
+				self._d.pop(key, None)
+			else:
+				self._d[key] = deepcopy(document) | self.filter(key)
+
+class MemoryVariableRepository(VariableRepository):
+	def __init__(self, name: str):
+		super().__init__(name)
+		# scope id: (scope type, {name: (type, value)})
+		self._d: dict[int, tuple[str, dict[str, tuple[str, str]]]] = {}
+
+	def scopes_sync(self) -> list[tuple[str, int, list[Document]]]:
+		return [
+			(scope_type, scope_id, [{'name': name, 'type': type, 'value': value} for name, (type, value) in variables.items()])
+			for scope_id, (scope_type, variables) in self._d.items()
+		]
+
+	def insert_sync(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		self._d.setdefault(scope_id, (scope_type, {}))[1][name] = (type, value)
+
+	def update_sync(self, scope_id: int, name: str, type: str, value: str):
+		if scope_id in self._d and name in self._d[scope_id][1]:
+			self._d[scope_id][1][name] = (type, value)
+
+	def delete_sync(self, scope_id: int, name: str):
+		if scope_id in self._d:
+			self._d[scope_id][1].pop(name, None)
+
+	def delete_scope_sync(self, scope_type: str, scope_id: int):
+		if scope_id in self._d and self._d[scope_id][0] == scope_type:
+			del self._d[scope_id]
+
+class MemoryPollRepository(PollRepository):
+	def __init__(self, name: str):
+		super().__init__(name)
+		self._d: dict[Any, Document] = {}
+
+	def all_sync(self) -> list[Document]:
+		return deepcopy(list(self._d.values()))
+
+	def insert_sync(self, document: Document):
+		self._d[document['uuid']] = deepcopy(document)
+
+	def delete_sync(self, uuid: Any):
+		self._d.pop(uuid, None)
+
+	def set_votes_sync(self, votes: list[Vote]):
+		for uuid, member_id, option, count in votes:
+			if uuid in self._d:
+				self._d[uuid].setdefault('vote_casted', {}).setdefault(member_id, {})[option] = count
+
+class MemoryStorage(Storage):
+	def __init__(self, maids: Optional[list[Document]] = None):
+		super().__init__()
+		self._maid_list = maids or []
+
+	def _maids(self, name: str) -> MaidRepository:
+		return MemoryMaidRepository(name, self._maid_list)
+
+	def _installations(self, name: str) -> InstallationRepository:
+		return MemoryInstallationRepository(name)
+
+	def _documents(self, name: str, key_fields: tuple[str, ...], unique: bool) -> DocumentRepository:
+		return MemoryDocumentRepository(name, key_fields)
+
+	def _variables(self, name: str) -> VariableRepository:
+		return MemoryVariableRepository(name)
+
+	def _polls(self, name: str) -> PollRepository:
+		return MemoryPollRepository(name)
+
+__all__ = ['MemoryStorage']
@@ -0,0 +1,206 @@
+'''
+The repositories on MongoDB, which keep the collections and documents of the older versions.
+pymongo blocks, so every call runs in the thread pool of asyncdb.
+'''
+from __future__ import annotations
+from collections.abc import Hashable, Mapping
+from pymongo import ASCENDING, DeleteOne, ReplaceOne, UpdateOne
+from typing import Any, Optional, TYPE_CHECKING
+from ..asyncdb import shutdown_executor
+from . import schema
+from .base import *
+
+if TYPE_CHECKING:
+	from pymongo.collection import Collection
+	from pymongo.database import Database
+
+class _MongoRepository:
+	def __init__(self, col: Collection, col_schema: schema.Schema, *args):
+		super().__init__(col.name, *args)  # type: ignore[call-arg]
+		self.col = col
+		self.schema = col_schema
+		# Created before the loop starts, with the repository
+		schema.ensure(col, col_schema)
+
+class MongoMaidRepository(_MongoRepository, MaidRepository):
+	blocking = True
+
+	def __init__(self, col: Collection):
+		# Read once as a whole
+		super().__init__(col, schema.Schema())
+
+	def all_sync(self) -> list[Document]:
+		return list(self.col.find().sort('_id', ASCENDING))
+
+class MongoInstallationRepository(_MongoRepository, InstallationRepository):
+	'''
+	One document per channel:
+	{'channel_id': int, 'guild_id': int, 'hooks': {maid name: {'hook_id': int, 'digest': str, 'pool': [int]}}}
+	The old schema had one row per maid: {'channel_id': int, 'name': str, 'hook_id': int},
+	and the rows of a channel are merged into the document when the channel is saved.
+	'''
+	blocking = True
+
+	def __init__(self, col: Collection):
+		super().__init__(col, schema.INSTALLATIONS)
+
+	def _find(self, filter: dict[str, Any]) -> dict[int, tuple[Hooks, bool]]:
+		installations: dict[int, tuple[Hooks, bool]] = {}
+		for doc in self.col.find(filter):
+			hooks, legacy = installations.setdefault(doc['channel_id'], ({}, False))
+			if 'hooks' in doc:
+				hooks.update(doc['hooks'])
+				if 'guild_id' not in doc:
+					installations[doc['channel_id']] = (hooks, True)
+			else:
+				installations[doc['channel_id']] = (hooks, True)
+				hooks.setdefault(doc['name'], {'hook_id': doc['hook_id'], 'digest': doc.get('digest')})
+		return installations
+
+	def find_channel_sync(self, channel_id: int) -> tuple[Hooks, bool]:
+		return self._find({'channel_id': channel_id}).get(channel_id, ({}, False))
+
+	def find_guild_sync(self, guild_id: int) -> dict[int, tuple[Hooks, bool]]:
+		# The documents written before the guild id is recorded are found after they are saved once
+		return self._find({'guild_id': guild_id})
+
+	def save_sync(self, channel_id: int, guild_id: int, hooks: Mapping[str, dict[str, Any]], legacy: bool):
+		self.col.replace_one(
+			{'channel_id': channel_id, 'hooks': {'$exists': True}},
+			{'channel_id': channel_id, 'guild_id': guild_id, 'hooks': dict(hooks)},
+			upsert = True
+		)
+		if legacy:
+			self.col.delete_many({'channel_id': channel_id, 'hooks': {'$exists': False}})
+
+	def delete_sync(self, channel_id: int):
+		# The document and the legacy rows at once
+		self.col.delete_many({'channel_id': channel_id})
+
+	def migrate_sync(self):
+		# Merge every legacy row into the documents at once, instead of channel by channel when saved
+		channels: dict[int, Hooks] = {}
+		for row in self.col.find({'hooks': {'$exists': False}}):
+			channels.setdefault(row['channel_id'], {}).setdefault(row['name'], {'hook_id': row['hook_id'], 'digest': row.get('digest')})
+		if len(channels) == 0:
+			return
+
+		for doc in self.col.find({'channel_id': {'$in': list(channels.keys())}, 'hooks': {'$exists': True}}):
+			channels[doc['channel_id']].update(doc['hooks'])
+		self.col.bulk_write([
+			ReplaceOne(
+				{'channel_id': channel_id, 'hooks': {'$exists': True}},
+				{'channel_id': channel_id, 'hooks': hooks},
+				upsert = True
+			)
+			for channel_id, hooks in channels.items()
+		], ordered = False)
+		self.col.delete_many({'hooks': {'$exists': False}})
+
+class MongoDocumentRepository(_MongoRepository, DocumentRepository):
+	blocking = True
+
+	def __init__(self, col: Collection, key_fields: tuple[str, ...], unique: bool = False):
+		super().__init__(col, schema.documents(key_fields, unique), key_fields)
+
+	def find_sync(self, key: Hashable) -> Optional[Document]:
+		return self.col.find_one(self.filter(key))
+
+	def all_sync(self, limit: int = 0, has: tuple[str, ...] = ()) -> list[Document]:
+		return list(self.col.find({field: {'$exists': True} for field in has}, limit = limit))
+
+	def write_many_sync(self, batch: Mapping[Hashable, Optional[Document]]):
+		requests: list[ReplaceOne | DeleteOne] = []
+		for key, document in batch.items():
+			filter = self.filter(key)
+			if document is None:
+				requests.append(DeleteOne(filter))
+			else:
+				requests.append(ReplaceOne(filter, document | filter, upsert = True))
+
+		if len(requests) > 0:
+			self.col.bulk_write(requests, ordered = False)
+
+class MongoVariableRepository(_MongoRepository, VariableRepository):
+	blocking = True
+
+	def __init__(self, col: Collection):
+		super().__init__(col, schema.VARIABLES)
+
+	def scopes_sync(self) -> list[tuple[str, int, list[Document]]]:
+		return [
+			(info['_id']['scope_type'], info['_id']['scope_id'], info['vars'])
+			for info in self.col.aggregate([{
+				'$group': {
+					'_id': {'scope_type': '$scope_type', 'scope_id': '$scope_id'},
+					'vars': {'$push': {'name': '$name', 'type': '$type', 'value': '$value'}}
+				}
+			}])
+		]
+
+	def insert_sync(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		self.col.insert_one({'scope_id': scope_id, 'scope_type': scope_type, 'name': name, 'type': type, 'value': value})
+
+	def update_sync(self, scope_id: int, name: str, type: str, value: str):
+		self.col.update_one({'scope_id': scope_id, 'name': name}, {'$set': {'type': type, 'value': value}})
+
+	def delete_sync(self, scope_id: int, name: str):
+		self.col.delete_one({'scope_id': scope_id, 'name': name})
+
+	def delete_scope_sync(self, scope_type: str, scope_id: int):
+		self.col.delete_many({'scope_type': scope_type, 'scope_id': scope_id})
+
+class MongoPollRepository(_MongoRepository, PollRepository):
+	blocking = True
+
+	def __init__(self, col: Collection):
+		super().__init__(col, schema.POLLS)
+
+	def all_sync(self) -> list[Document]:
+		return list(self.col.find())
+
+	def insert_sync(self, document: Document):
+		self.col.insert_one(document)
+
+	def delete_sync(self, uuid: Any):
+		self.col.delete_one({'uuid': uuid})
+
+	def set_votes_sync(self, votes: list[Vote]):
+		# The votes of a call are written in one round trip
+		self.col.bulk_write([
+			UpdateOne({'uuid': uuid}, {'$set': {f'vote_casted.{member_id}.{option}': count}})
+			for uuid, member_id, option, count in votes
+		])
+
+class MongoStorage(Storage):
+	def __init__(self, db: Database):
+		super().__init__()
+		self.db = db
+
+	def _maids(self, name: str) -> MaidRepository:
+		return MongoMaidRepository(self.db[name])
+
+	def _installations(self, name: str) -> InstallationRepository:
+		return MongoInstallationRepository(self.db[name])
+
+	def _documents(self, name: str, key_fields: tuple[str, ...], unique: bool) -> DocumentRepository:
+		return MongoDocumentRepository(self.db[name], key_fields, unique)
+
+	def _variables(self, name: str) -> VariableRepository:
+		return MongoVariableRepository(self.db[name])
+
+	def _polls(self, name: str) -> PollRepository:
+		return MongoPollRepository(self.db[name])
+
+	def verify_sync(self) -> list[str]:
+		report = []
+		for repo in self._repositories.values():
+			assert isinstance(repo, _MongoRepository)
+			for query, stages in schema.verify(repo.col, repo.schema):
+				report.append(f'{repo.name}: {query.description} {query.filter} scans ({" > ".join(stages)})')
+		return report
+
+	def close(self):
+		shutdown_executor()
+
+__all__ = ['MongoStorage']
@@ -0,0 +1,124 @@
+'''
+This module declares the indexes of the Mongo collections and the queries they serve.
+The indexes are created (idempotently) when the repositories are created, so every collection
+has its indexes before the first query. verify() asks Mongo to explain the declared queries,
+and reports those which would scan the whole collection.
+Only the point queries of the commands are declared; the full reads at startup
+(the maid list, the preloads, the restore of the variables and the polls) scan by design.
+'''
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pymongo import ASCENDING
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from pymongo.collection import Collection
+
+@dataclass(frozen = True)
+class Index:
+	keys: tuple[str, ...]
+	unique: bool = False
+
+	@property
+	def name(self) -> str:
+		# The default name by Mongo, e.g. "channel_1_channel_type_1"
+		return '_'.join(f'{key}_1' for key in self.keys)
+
+	def spec(self) -> list[tuple[str, int]]:
+		return [(key, ASCENDING) for key in self.keys]
+
+@dataclass(frozen = True)
+class Query:
+	# What the query is for, shown in the report
+	description: str
+	filter: dict[str, Any]
+
+@dataclass(frozen = True)
+class Schema:
+	indexes: tuple[Index, ...] = ()
+	queries: tuple[Query, ...] = ()
+	# The names of the indexes created by the older versions and no longer used
+	obsolete: tuple[str, ...] = field(default = ())
+
+INSTALLATIONS = Schema(
+	indexes = (
+		Index(('channel_id', )),
+		Index(('guild_id', )),
+	),
+	queries = (
+		Query('installation of a channel', {'channel_id': 0}),
+		Query('installations of a guild', {'guild_id': 0}),
+		Query('save an installation', {'channel_id': 0, 'hooks': {'$exists': True}}),
+		Query('clean the legacy rows', {'channel_id': 0, 'hooks': {'$exists': False}}),
+	),
+)
+
+VARIABLES = Schema(
+	# Updates and deletions filter {scope_id, name}, and dropping a scope filters {scope_type, scope_id},
+	# so scope_id goes first; the ids of different scope types never collide.
+	indexes = (
+		Index(('scope_id', 'name')),
+	),
+	queries = (
+		Query('update or delete a variable', {'scope_id': 0, 'name': ''}),
+		Query('drop a scope', {'scope_type': '', 'scope_id': 0}),
+	),
+	obsolete = ('scope_type_1_scope_id_1_name_1', ),
+)
+
+POLLS = Schema(
+	indexes = (
+		Index(('uuid', )),
+	),
+	queries = (
+		Query('a poll', {'uuid': ''}),
+	),
+)
+
+def documents(key_fields: tuple[str, ...], unique: bool = False) -> Schema:
+	# A DocumentRepository looks up and writes its documents by the key fields only
+	return Schema(
+		indexes = (Index(key_fields, unique = unique), ),
+		queries = (Query('a document by key', {key: 0 for key in key_fields}), ),
+	)
+
+def _differs(info: dict[str, Any], index: Index) -> bool:
+	# The keys and the options of an existing index (from index_information()) against the declaration
+	keys = [(key, int(direction)) for key, direction in info['key']]
+	return keys != index.spec() or bool(info.get('unique', False)) != index.unique
+
+def ensure(col: Collection, schema: Schema):
+	# create_index() does nothing if the same index exists
+	existing = col.index_information()
+	for name in schema.obsolete:
+		if name in existing:
+			col.drop_index(name)
+	for index in schema.indexes:
+		if index.name in existing and _differs(existing[index.name], index):
+			# Created by an older version with other options, which create_index() refuses (IndexOptionsConflict)
+			col.drop_index(index.name)
+		col.create_index(index.spec(), name = index.name, unique = index.unique)
+
+def _stages(plan: dict[str, Any]) -> list[str]:
+	stages = [plan['stage']] if 'stage' in plan else []
+	for key in ('inputStage', 'queryPlan'):
+		if key in plan:
+			stages.extend(_stages(plan[key]))
+	for child in plan.get('inputStages', ()):
+		stages.extend(_stages(child))
+	return stages
+
+def explain(col: Collection, query: Query) -> list[str]:
+	# The stages of the winning plan, e.g. ['FETCH', 'IXSCAN']
+	return _stages(col.find(query.filter).explain()['queryPlanner']['winningPlan'])
+
+def verify(col: Collection, schema: Schema) -> list[tuple[Query, list[str]]]:
+	# The declared queries that would scan the collection, with their plans
+	result = []
+	for query in schema.queries:
+		stages = explain(col, query)
+		if 'COLLSCAN' in stages:
+			result.append((query, stages))
+	return result
+
+__all__ = ['Index', 'Query', 'Schema', 'INSTALLATIONS', 'VARIABLES', 'POLLS', 'documents', 'ensure', 'explain', 'verify']
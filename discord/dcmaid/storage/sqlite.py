@@ -0,0 +1,241 @@
+'''
+The repositories on a local SQLite file, for the deployments without Mongo.
+The file is in WAL mode, so reading never waits for writing.
+The statements are local and short, so they run in the loop directly instead of in a thread,
+and the SQL of each repository is fixed, so sqlite3 compiles every statement once and reuses it.
+Documents are stored as JSON, with datetimes and UUIDs tagged as Mongo's extended JSON does.
+'''
+from __future__ import annotations
+import json
+import sqlite3
+from collections.abc import Hashable, Iterator, Mapping
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from typing import Any, Optional
+from uuid import UUID
+from .base import *
+
+def _default(o):
+	if isinstance(o, datetime):
+		return {'$date': o.isoformat()}
+	if isinstance(o, UUID):
+		return {'$uuid': str(o)}
+	raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+def _object_hook(d: dict):
+	if len(d) == 1:
+		if '$date' in d:
+			return datetime.fromisoformat(d['$date'])
+		if '$uuid' in d:
+			return UUID(d['$uuid'])
+	return d
+
+_dumps = partial(json.dumps, default = _default, separators = (',', ':'))
+_loads = partial(json.loads, object_hook = _object_hook)
+
+def _quote(name: str) -> str:
+	# Collection names like "channel-installed-maids" are not valid identifiers
+	return '"' + name.replace('"', '""') + '"'
+
+class _SQLiteRepository:
+	def __init__(self, conn: sqlite3.Connection, name: str, *args):
+		super().__init__(name, *args)  # type: ignore[call-arg]
+		self.conn = conn
+		self.table = _quote(name)
+
+	@contextmanager
+	def _transaction(self) -> Iterator[sqlite3.Connection]:
+		conn = self.conn
+		conn.execute('BEGIN IMMEDIATE')
+		try:
+			yield conn
+		except:
+			conn.execute('ROLLBACK')
+			raise
+		conn.execute('COMMIT')
+
+class SQLiteMaidRepository(_SQLiteRepository, MaidRepository):
+	def __init__(self, conn: sqlite3.Connection, name: str, seed: list[Document]):
+		super().__init__(conn, name)
+		conn.execute(
+			f'CREATE TABLE IF NOT EXISTS {self.table} ('
+			'seq INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, display_name TEXT NOT NULL, avatar TEXT NOT NULL)'
+		)
+		if len(seed) > 0 and conn.execute(f'SELECT 1 FROM {self.table} LIMIT 1').fetchone() is None:
+			with self._transaction():
+				conn.executemany(
+					f'INSERT INTO {self.table} (name, display_name, avatar) VALUES (?, ?, ?)',
+					[(m['name'], m['display_name'], m['avatar']) for m in seed]
+				)
+
+	def all_sync(self) -> list[Document]:
+		return [
+			{'name': name, 'display_name': display_name, 'avatar': avatar}
+			for name, display_name, avatar in self.conn.execute(f'SELECT name, display_name, avatar FROM {self.table} ORDER BY seq')
+		]
+
+class SQLiteInstallationRepository(_SQLiteRepository, InstallationRepository):
+	def __init__(self, conn: sqlite3.Connection, name: str):
+		super().__init__(conn, name)
+		conn.execute(
+			f'CREATE TABLE IF NOT EXISTS {self.table} ('
+			'channel_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, hooks TEXT NOT NULL)'
+		)
+		conn.execute(f'CREATE INDEX IF NOT EXISTS {_quote(name + ".guild_id")} ON {self.table} (guild_id)')
+		self._find_channel = f'SELECT hooks FROM {self.table} WHERE channel_id = ?'
+		self._find_guild = f'SELECT channel_id, hooks FROM {self.table} WHERE guild_id = ?'
+		self._save = f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)'
+		self._delete = f'DELETE FROM {self.table} WHERE channel_id = ?'
+
+	def find_channel_sync(self, channel_id: int) -> tuple[Hooks, bool]:
+		row = self.conn.execute(self._find_channel, (channel_id, )).fetchone()
+		return ({} if row is None else _loads(row[0]), False)
+
+	def find_guild_sync(self, guild_id: int) -> dict[int, tuple[Hooks, bool]]:
+		return {channel_id: (_loads(hooks), False) for channel_id, hooks in self.conn.execute(self._find_guild, (guild_id, ))}
+
+	def save_sync(self, channel_id: int, guild_id: int, hooks: Mapping[str, dict[str, Any]], legacy: bool):
+		self.conn.execute(self._save, (channel_id, guild_id, _dumps(dict(hooks))))
+
+	def delete_sync(self, channel_id: int):
+		self.conn.execute(self._delete, (channel_id, ))
+
+class SQLiteDocumentRepository(_SQLiteRepository, DocumentRepository):
+	def __init__(self, conn: sqlite3.Connection, name: str, key_fields: tuple[str, ...]):
+		super().__init__(conn, name, key_fields)
+		conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID')
+		self._find = f'SELECT data FROM {self.table} WHERE key = ?'
+		self._all = f'SELECT data FROM {self.table}'
+		self._replace = f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)'
+		self._delete = f'DELETE FROM {self.table} WHERE key = ?'
+
+	@staticmethod
+	def _key(key: Hashable) -> str:
+		# Tuples become lists, which is still one string per key
+		return _dumps(key)
+
+	def find_sync(self, key: Hashable) -> Optional[Document]:
+		row = self.conn.execute(self._find, (self._key(key), )).fetchone()
+		return None if row is None else _loads(row[0])
+
+	def all_sync(self, limit: int = 0, has: tuple[str, ...] = ()) -> list[Document]:
+		result = []
+		for row in self.conn.execute(self._all):
+			if limit > 0 and len(result) >= limit:
+				break
+			document = _loads(row[0])
+			if all(field in document for field in has):
+				result.append(document)
+		return result
+
+	def write_many_sync(self, batch: Mapping[Hashable, Optional[Document]]):
+		replaced = []
+		deleted = []
+		for key, document in batch.items():
+			if document is None:
+				deleted.append((self._key(key), ))
+			else:
+				replaced.append((self._key(key), _dumps(document | self.filter(key))))
+
+		with self._transaction() as conn:
+			conn.executemany(self._replace, replaced)
+			conn.executemany(self._delete, deleted)
+
+class SQLiteVariableRepository(_SQLiteRepository, VariableRepository):
+	def __init__(self, conn: sqlite3.Connection, name: str):
+		super().__init__(conn, name)
+		conn.execute(
+			f'CREATE TABLE IF NOT EXISTS {self.table} ('
+			'scope_id INTEGER NOT NULL, name TEXT NOT NULL, scope_type TEXT NOT NULL, type TEXT NOT NULL, value TEXT NOT NULL, '
+			'PRIMARY KEY (scope_id, name)) WITHOUT ROWID'
+		)
+		self._scopes = f'SELECT scope_type, scope_id, name, type, value FROM {self.table} ORDER BY scope_id'
+		self._insert = f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?)'
+		self._update = f'UPDATE {self.table} SET type = ?, value = ? WHERE scope_id = ? AND name = ?'
+		self._delete = f'DELETE FROM {self.table} WHERE scope_id = ? AND name = ?'
+		self._delete_scope = f'DELETE FROM {self.table} WHERE scope_type = ? AND scope_id = ?'
+
+	def scopes_sync(self) -> list[tuple[str, int, list[Document]]]:
+		scopes: dict[tuple[str, int], list[Document]] = {}
+		for scope_type, scope_id, name, type, value in self.conn.execute(self._scopes):
+			scopes.setdefault((scope_type, scope_id), []).append({'name': name, 'type': type, 'value': value})
+		return [(scope_type, scope_id, variables) for (scope_type, scope_id), variables in scopes.items()]
+
+	def insert_sync(self, scope_type: str, scope_id: int, name: str, type: str, value: str):
+		self.conn.execute(self._insert, (scope_id, name, scope_type, type, value))
+
+	def update_sync(self, scope_id: int, name: str, type: str, value: str):
+		self.conn.execute(self._update, (type, value, scope_id, name))
+
+	def delete_sync(self, scope_id: int, name: str):
+		self.conn.execute(self._delete, (scope_id, name))
+
+	def delete_scope_sync(self, scope_type: str, scope_id: int):
+		self.conn.execute(self._delete_scope, (scope_type, scope_id))
+
+class SQLitePollRepository(_SQLiteRepository, PollRepository):
+	def __init__(self, conn: sqlite3.Connection, name: str):
+		super().__init__(conn, name)
+		conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (uuid TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID')
+		self._all = f'SELECT data FROM {self.table}'
+		self._find = f'SELECT data FROM {self.table} WHERE uuid = ?'
+		self._insert = f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)'
+		self._delete = f'DELETE FROM {self.table} WHERE uuid = ?'
+
+	def all_sync(self) -> list[Document]:
+		return [_loads(data) for data, in self.conn.execute(self._all)]
+
+	def insert_sync(self, document: Document):
+		self.conn.execute(self._insert, (str(document['uuid']), _dumps(document)))
+
+	def delete_sync(self, uuid: Any):
+		self.conn.execute(self._delete, (str(uuid), ))
+
+	def set_votes_sync(self, votes: list[Vote]):
+		# Read, modify and write each poll once in one transaction
+		by_poll: dict[str, list[Vote]] = {}
+		for vote in votes:
+			by_poll.setdefault(str(vote[0]), []).append(vote)
+
+		with self._transaction() as conn:
+			for uuid, poll_votes in by_poll.items():
+				row = conn.execute(self._find, (uuid, )).fetchone()
+				if row is None:
+					continue
+				document = _loads(row[0])
+				vote_casted = document.setdefault('vote_casted', {})
+				for _, member_id, option, count in poll_votes:
+					# JSON keys are strings
+					vote_casted.setdefault(str(member_id), {})[option] = count
+				conn.execute(self._insert, (uuid, _dumps(document)))
+
+class SQLiteStorage(Storage):
+	def __init__(self, path: str, maids: Optional[list[Document]] = None, timeout: float = 10.0):
+		super().__init__()
+		self.path = path
+		self._maid_list = maids or []
+		# Autocommit; the transactions are started explicitly
+		self.conn = sqlite3.connect(path, timeout = timeout, isolation_level = None, cached_statements = 256)
+		self.conn.execute('PRAGMA journal_mode = WAL')
+		self.conn.execute('PRAGMA synchronous = NORMAL')
+
+	def _maids(self, name: str) -> MaidRepository:
+		return SQLiteMaidRepository(self.conn, name, self._maid_list)
+
+	def _installations(self, name: str) -> InstallationRepository:
+		return SQLiteInstallationRepository(self.conn, name)
+
+	def _documents(self, name: str, key_fields: tuple[str, ...], unique: bool) -> DocumentRepository:
+		return SQLiteDocumentRepository(self.conn, name, key_fields)
+
+	def _variables(self, name: str) -> VariableRepository:
+		return SQLiteVariableRepository(self.conn, name)
+
+	def _polls(self, name: str) -> PollRepository:
+		return SQLitePollRepository(self.conn, name)
+
+	def close(self):
+		self.conn.close()
+
+__all__ = ['SQLiteStorage']
@@ -1,11 +1,15 @@
+import asyncio
 import discord
 import discord.abc
 import discord.utils
 from asyncio import get_running_loop
-from collections.abc import Generator
+from collections import OrderedDict
+from collections.abc import Awaitable, Generator
 from decouple import config, Csv  # type: ignore[import]
-from functools import wraps
+from functools import partial, wraps
+from time import monotonic
 from typing import Any, Callable, Concatenate, Optional, overload, ParamSpec, TypeGuard, TypeVar, TYPE_CHECKING
+from .exception import ParentChannelNotFound
 from .typing import Channelable, ChannelType, GuildChannel, GuildChannelType, PrivateChannel, QuasiContext, SlashType, Threadable
 
 if TYPE_CHECKING:
@@ -31,20 +35,113 @@ def autocomplete_get_maid_names(ctx: discord.AutocompleteContext) -> list[str]:
 
 	return list(cog.maids.keys())
 
+class _ParentResolver:
+	'''
+	Resolves the parent channels of threads without blocking the loop.
+	The parents missing in the client cache are fetched and kept here for a while;
+	concurrent fetches of the same parent (e.g. many threads of a forum) share one request,
+	and the parents that cannot be fetched are remembered so we do not ask again and again.
+	'''
+	def __init__(self, capacity: int = 4096, ttl: float = 600.0, negative_ttl: float = 60.0):
+		self.capacity = capacity
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		# thread id: parent id
+		self._parents: OrderedDict[int, int] = OrderedDict()
+		# parent id: (fetched parent, expire at)
+		self._fetched: OrderedDict[int, tuple[Threadable, float]] = OrderedDict()
+		# parent id: expire at
+		self._missing: dict[int, float] = {}
+		self._inflight: dict[int, asyncio.Task[Threadable]] = {}
+
+	def _remember(self, thread_id: int, parent_id: int):
+		self._parents[thread_id] = parent_id
+		self._parents.move_to_end(thread_id)
+		while len(self._parents) > self.capacity:
+			self._parents.popitem(last = False)
+
+	def parent_id(self, channel_id: int) -> Optional[int]:
+		# The parent id of a thread we have seen, or None
+		return self._parents.get(channel_id)
+
+	def cached(self, thread: discord.Thread) -> Optional[Threadable]:
+		self._remember(thread.id, thread.parent_id)
+		if thread.parent is not None:
+			return thread.parent
+
+		item = self._fetched.get(thread.parent_id)
+		if item is None:
+			return None
+		parent, expire_at = item
+		if expire_at <= monotonic():
+			del self._fetched[thread.parent_id]
+			return None
+		return parent
+
+	async def resolve(self, thread: discord.Thread) -> Threadable:
+		parent = self.cached(thread)
+		if parent is not None:
+			return parent
+
+		parent_id = thread.parent_id
+		missing_until = self._missing.get(parent_id)
+		if missing_until is not None:
+			if missing_until > monotonic():
+				raise ParentChannelNotFound(parent_id)
+			del self._missing[parent_id]
+
+		task = self._inflight.get(parent_id)
+		if task is None:
+			task = self._inflight[parent_id] = asyncio.create_task(self._fetch(thread.guild, parent_id))
+			task.add_done_callback(lambda _: self._inflight.pop(parent_id, None))
+		# A cancelled caller does not cancel the fetch shared with the others
+		return await asyncio.shield(task)
+
+	async def _fetch(self, guild: discord.Guild, parent_id: int) -> Threadable:
+		try:
+			parent = await discord.utils.get_or_fetch(guild, 'channel', parent_id)
+		except (discord.NotFound, discord.Forbidden):
+			self._missing[parent_id] = monotonic() + self.negative_ttl
+			raise ParentChannelNotFound(parent_id)
+
+		self._fetched[parent_id] = (parent, monotonic() + self.ttl)
+		self._fetched.move_to_end(parent_id)
+		while len(self._fetched) > self.capacity:
+			self._fetched.popitem(last = False)
+		return parent
+
+_parent_resolver = _ParentResolver()
+
 # Given a messageable chat room in a guild, returns the parent channel if the chat room
 # is a thread, otherwise returns the argument itself.
-def get_guild_channel(ch: GuildChannel | discord.Thread):
+# The parent is fetched if it is not cached, so prefer get_guild_channel_id() if only the id is needed.
+async def resolve_guild_channel(ch: GuildChannel | discord.Thread) -> Threadable:
 	if isinstance(ch, discord.Thread):
-		if ch.parent is None:
-			parent = get_running_loop().run_until_complete(discord.utils.get_or_fetch(ch.guild, 'channel', ch.parent_id))
-			if TYPE_CHECKING:
-				return cast(Threadable, parent)
-			else:
-				return parent
-		return ch.parent
+		return await _parent_resolver.resolve(ch)
 
 	return ch
 
+# The synchronous version of resolve_guild_channel(), only with the cached channels.
+# Raises ParentChannelNotFound if the parent of the thread is not cached.
+def get_guild_channel(ch: GuildChannel | discord.Thread) -> Threadable:
+	if isinstance(ch, discord.Thread):
+		parent = _parent_resolver.cached(ch)
+		if parent is None:
+			raise ParentChannelNotFound(ch.parent_id)
+		return parent
+
+	return ch
+
+# The id of what resolve_guild_channel() returns, without any request.
+def get_guild_channel_id(ch: discord.abc.Snowflake) -> int:
+	if isinstance(ch, discord.Thread):
+		_parent_resolver._remember(ch.id, ch.parent_id)
+		return ch.parent_id
+
+	# E.g. a PartialMessageable of a thread we have seen
+	parent_id = _parent_resolver.parent_id(ch.id)
+	return ch.id if parent_id is None else parent_id
+
 # A simple function to send an embed to indicate an error.
 # The embed contains one field only.
 # This method automatically detect whether the response is done or not to use followup.
@@ -87,18 +184,25 @@ def trim(string):
 	return None
 
 # This function removes the "thinking" mode without sending anything from the interaction.
-async def remove_thinking(ctx: QuasiContext):
+# Returns the number of requests made
+async def remove_thinking(ctx: QuasiContext) -> int:
+	requests = 0
 	try:
 		if isinstance(ctx, discord.ApplicationContext):
+			requests += 1
 			await ctx.defer()
+			requests += 1
 			await ctx.delete()
 		else:
+			requests += 1
 			await ctx.response.defer()
+			requests += 1
 			await ctx.delete_original_response()
 	except discord.HTTPException:
 		# Defer error: There is no "thinking" to remove
 		# Delete error: No thinking message to delete
-		return
+		pass
+	return requests
 
 def get_subcommand(group: discord.SlashCommandGroup, name: str) -> Optional[SlashType]:
 	for cmd in group.subcommands:
@@ -112,7 +216,33 @@ def walk_commands_and_groups(cmd: discord.ApplicationCommand) -> Generator[disco
 		for subcmd in cmd.subcommands:
 			yield from walk_commands_and_groups(subcmd)
 
-async def send_as(ctx: Channelable, webhook: Optional[discord.Webhook] = None, *args, **kwargs):
+# `refresh` is called when the webhook is gone (e.g. deleted by users),
+# and the message is sent again once with the webhook it returns.
+# With OUTBOUND_SCHEDULER, the message is queued and paced instead of sent at once,
+# and `coalesce` allows it to be merged with other short messages to the same place.
+async def send_as(ctx: Channelable, webhook: Optional[discord.Webhook] = None, *args, refresh: Optional[Callable[[], Awaitable[Optional[discord.Webhook]]]] = None, coalesce: bool = False, **kwargs):
+	if webhook is not None and refresh is not None:
+		try:
+			await send_as(ctx, webhook, *args, coalesce = coalesce, **kwargs)
+		except discord.NotFound:
+			await send_as(ctx, await refresh(), *args, coalesce = coalesce, **kwargs)
+		return
+
+	from .outbound import PRIORITY_INTERACTION, PRIORITY_TEXT, scheduler # Prevent circular dependency
+	if not scheduler.enabled:
+		await _send_as(ctx, webhook, *args, **kwargs)
+		return
+
+	channel = ctx.channel
+	route = ('channel', getattr(channel, 'id', None)) if webhook is None else ('webhook', webhook.id)
+	# Interaction followups are waited by users with "thinking", so they go first
+	priority = PRIORITY_TEXT if isinstance(ctx, discord.Message) else PRIORITY_INTERACTION
+	# Merged messages are sent by the first one, so only those of the same speaker (the route) to the same
+	# channel or thread are merged; the callers keep who the message is for in the content (e.g. a mention)
+	coalesce_key = (route, getattr(channel, 'id', None)) if coalesce else None
+	await scheduler.submit(route, priority, partial(_send_as, ctx, webhook), *args, coalesce_key = coalesce_key, **kwargs)
+
+async def _send_as(ctx: Channelable, webhook: Optional[discord.Webhook] = None, *args, **kwargs):
 	channel = ctx.channel
 	if webhook is None:
 		# Use bot
@@ -218,7 +348,9 @@ __all__ = (
 	'EmptyCharacter',
 	'check_server_text_channel',
 	'autocomplete_get_maid_names',
+	'resolve_guild_channel',
 	'get_guild_channel',
+	'get_guild_channel_id',
 	'send_error_embed',
 	'trim',
 	'remove_thinking',
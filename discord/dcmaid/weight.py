@@ -1,147 +1,411 @@
 from __future__ import annotations
 import discord
 import random
-from threading import Lock
-from typing import Optional
-from .basebot import Bot
-from .utils import proxy, generate_config
+from collections.abc import Mapping
+from typing import Any, Optional, TYPE_CHECKING
+from .cache import CachedDocuments
+from .utils import generate_config
+
+if TYPE_CHECKING:
+	from .basebot import Bot
+	from .maid import Maid
 
 config = generate_config(
 	MAID_WEIGHT_IN_CHANNEL_COLLECTION = {'default': 'channel-maids-weight'},
+	MAID_WEIGHT_IN_GUILD_COLLECTION = {'default': 'guild-maids-weight'},
+	MAID_WEIGHT_FLUSH_INTERVAL = {'default': 5.0, 'cast': float},
+	MAID_WEIGHT_FLUSH_BATCH = {'default': 100, 'cast': int},
+	MAID_WEIGHT_CACHE_SIZE = {'default': 4096, 'cast': int},
+	MAID_WEIGHT_CACHE_IDLE = {'default': 0, 'cast': float},
+	MAID_WEIGHT_PRELOAD = {'default': False, 'cast': bool},
 )
 
+class _AliasTable:
+	'''
+	Vose's alias method over integer weights.
+	The table is built in O(n) and each draw takes O(1) with only one call to the generator.
+	Integer arithmetic is used, so the probabilities are exact.
+	'''
+	__slots__ = ('keys', 'total', 'prob', 'alias')
+
+	def __init__(self, weights: Mapping[str, int]):
+		keys = [key for key, w in weights.items() if w > 0]
+		n = len(keys)
+		if n == 0:
+			raise ValueError('No positive weight to sample')
+
+		# Scale every weight by n so that each column has exactly "total" height
+		scaled = [weights[key] * n for key in keys]
+		total = sum(scaled) // n
+		prob = [total] * n
+		alias = list(range(n))
+
+		small = [i for i, w in enumerate(scaled) if w < total]
+		large = [i for i, w in enumerate(scaled) if w >= total]
+		while small and large:
+			s = small.pop()
+			l = large.pop()
+			prob[s] = scaled[s]
+			alias[s] = l
+			scaled[l] -= total - scaled[s]
+			if scaled[l] < total:
+				small.append(l)
+			else:
+				large.append(l)
+		# The remaining columns are full (prob = total) already
+
+		self.keys = keys
+		self.total = total
+		self.prob = prob
+		self.alias = alias
+
+	def draw(self, random_generator) -> str:
+		total = self.total
+		i, r = divmod(random_generator.randrange(len(self.keys) * total), total)
+		if r < self.prob[i]:
+			return self.keys[i]
+		return self.keys[self.alias[i]]
+
+	def draw_many(self, n: int, random_generator) -> list[str]:
+		keys, prob, alias, total = self.keys, self.prob, self.alias, self.total
+		bound = len(keys) * total
+		if hasattr(random_generator, 'randints'):
+			# The generators of rng draw them at once
+			draws = random_generator.randints(0, bound - 1, n)
+		else:
+			randrange = random_generator.randrange
+			draws = [randrange(bound) for _ in range(n)]
+		result = []
+		for draw in draws:
+			i, r = divmod(draw, total)
+			result.append(keys[i] if r < prob[i] else keys[alias[i]])
+		return result
+
 class Weight:
-	creation_lock = Lock()
+	'''
+	The weight table of a channel.
+	A channel only stores the weights overriding the defaults of its guild (see GuildWeight),
+	and the effective table is materialized when it is used.
+	Instances are created and shared by WeightRegistry, and they are only used
+	in the event loop thread, so there is no lock.
+	'''
 	col_name = config['MAID_WEIGHT_IN_CHANNEL_COLLECTION']
+	# Channel ids are unique, so the type is only stored
+	key_fields = ('channel', )
 	field_name = 'weights'
 	bot_key = '____bot'
-	d: dict[tuple[Bot, discord.abc.GuildChannel], Weight] = {}
 
-	@staticmethod
-	def _get_key(bot: Bot, channel: discord.abc.GuildChannel):
-		return (bot, channel)
+	def __init__(self,
+		maids: Mapping[str, Maid],
+		writer: CachedDocuments[int, Weight],
+		channel_id: int,
+		channel_type: int,
+		guild: GuildWeight,
+		data: Optional[Mapping[str, Any]],
+		random_generator: random.Random):
+
+		self._maids = maids
+		self._writer = writer
+		self.channel_id = channel_id
+		self.channel_type = channel_type
+		self._guild = guild
+		self._random = random_generator
+		self._table: Optional[dict[str, int]] = None
+		self._table_version = -1
+		self._sampler: Optional[_AliasTable] = None
+
+		if data is None:
+			overrides = {}
+			modified = False
+		else:
+			overrides = dict(data.get(self.field_name, {}))
+			# Old documents have no guild field
+			modified = data.get('guild') != guild.guild_id
+
+		# Old documents store the full table, so drop what the guild gives already
+		for key in list(overrides):
+			if (key != self.bot_key and key not in maids) or overrides[key] == guild.get(key):
+				modified = True
+				overrides.pop(key)
+
+		self._overrides: dict[str, int] = overrides
+		if modified:
+			self._upload()
+
+	def _get_table(self) -> dict[str, int]:
+		guild = self._guild
+		table = self._table
+		if table is None or self._table_version != guild.version:
+			table = {self.bot_key: guild.get(self.bot_key)}
+			table.update({maid: guild.get(maid) for maid in self._maids})
+			table.update(self._overrides)
+			self._table = table
+			self._table_version = guild.version
+			self._sampler = None
+		return table
 
-	@staticmethod
-	def _get_filter(channel: discord.abc.GuildChannel):
-		return {'channel': channel.id, 'channel_type': channel.type.value}
-
-	def __init__(self, bot: Bot, channel: discord.abc.GuildChannel):
-		assigned = False
-		self.bot = bot
-		self.channel = channel
-		key = self._get_key(bot, channel)
-		d = self.d
-		if key not in d:
-			with self.creation_lock:
-				# Ensure that each instabce of the same channel shares the same table.
-				if key in d:
-					# Some instance has already created when locking
-					pass
-				else:
-					# Create a real instance
-					assigned = True
-					d[key] = self
-
-					self._individual_lock = Lock()
-					col = self._col = bot.db[self.col_name]
-					maids = self._maids = bot.maids
-					data = col.find_one({'channel_id': channel.id})
-					if data is None:
-						weights = {}
-					else:
-						weights = data.get(self.field_name, {})
-
-					modified = False
-					# Fetch maids
-					for recorded_maid in weights:
-						if recorded_maid != self.bot_key and recorded_maid not in maids:
-							# Who?
-							modified = True
-							weights.pop(recorded_maid)
-
-					if self.bot_key not in weights:
-						# Bot field
-						modified = True
-						weights[self.bot_key] = 1 # Default
-
-					for maid in maids:
-						if maid not in weights:
-							modified = True
-							weights[maid] = 1 # Default
-
-					if modified:
-						filter = self._get_filter(channel)
-						col.replace_one(
-							filter = filter,
-							replacement = {**filter, 'weights': weights},
-							upsert = True
-						)
-
-					self._weights = weights
-					self._random = random.Random()
-
-		if not assigned:
-			self._proxy: Weight = d[(bot, channel)]
-
-	@proxy
 	def get_maid_weight(self, maid_name: str) -> int:
-		return self._weights[maid_name]
+		return self._get_table()[maid_name]
 
-	@proxy
 	def get_bot_weight(self) -> int:
-		return self._weights[self.bot_key]
+		return self._get_table()[self.bot_key]
 
 	def _update(self, key: str, i: int):
-		# Called in the internal singleton, so no proxy
-		with self._individual_lock:
-			self._weights[key] = i
-			self._upload()
+		if i < 0:
+			i = 0
+		if self._get_table()[key] == i:
+			return
+
+		if i == self._guild.get(key):
+			# Follow the guild again
+			self._overrides.pop(key, None)
+		else:
+			self._overrides[key] = i
+		self._table = None
+		self._upload()
 
 	def _upload(self):
-		filter = self._get_filter(self.channel)
-		self._col.replace_one(
-			filter = filter,
-			replacement = {**filter, 'weights': self._weights},
-			upsert = True
-		)
+		# Written back by the write-behind layer, so commands never wait for the db
+		if len(self._overrides) > 0:
+			document = {'channel_type': self.channel_type, 'guild': self._guild.guild_id, self.field_name: dict(self._overrides)}
+		else:
+			# Nothing to override, so no document is needed
+			document = None
+		self._writer.mark(self.channel_id, document)
 
-	@proxy
 	def set_maid_weight(self, maid_name: str, i: int):
-		ori_i = self._weights[maid_name]
-		if ori_i == i:
-			return
-		if i < 0:
-			i = 0
 		self._update(maid_name, i)
 
-	@proxy
 	def set_bot_weight(self, i: int):
-		ori_i = self._weights[self.bot_key]
-		if ori_i == i:
-			return
-		if i < 0:
-			i = 0
 		self._update(self.bot_key, i)
 
 	def _reset_weights(self):
-		with self._individual_lock:
-			self._weights = {self.bot_key: 1}
-			self._weights.update({maid: 1 for maid in self._maids})
-			self._upload()
+		self._overrides = {}
+		self._table = None
+		table = self._get_table()
+		if not any(table.values()):
+			# The guild defaults are all zero as well
+			self._overrides = {key: 1 for key in table}
+			self._table = None
+		self._upload()
+
+	def _get_sampler(self) -> _AliasTable:
+		table = self._get_table()
+		sampler = self._sampler
+		if sampler is None:
+			try:
+				sampler = _AliasTable(table)
+			except ValueError:
+				# All weights are zero
+				self._reset_weights()
+				sampler = _AliasTable(self._get_table())
+			self._sampler = sampler
+		return sampler
 
-	@proxy
 	def random_get(self, random_generator = None) -> Optional[str]:
 		# None for bot
 		if random_generator is None:
 			random_generator = self._random
 
-		items: list[tuple[str, int]] = list(self._weights.items())
-		try:
-			result = random_generator.choices([i[0] for i in items], [i[1] for i in items])[0]
-		except ValueError:
-			self._reset_weights()
-			return self.random_get(random_generator)
-
+		result = self._get_sampler().draw(random_generator)
 		if result == self.bot_key:
 			return None
 		return result
+
+	def random_get_many(self, n: int, random_generator = None) -> list[Optional[str]]:
+		# Draw n characters at once, None for bot
+		if random_generator is None:
+			random_generator = self._random
+
+		bot_key = self.bot_key
+		return [None if result == bot_key else result for result in self._get_sampler().draw_many(n, random_generator)]
+
+class GuildWeight:
+	'''
+	The default weights of a guild, inherited by every channel in it.
+	Only the weights different from the global default (1) are stored, and
+	a guild without such weights has no document.
+	`version` increases on every change so that channels know their tables are outdated.
+	'''
+	col_name = config['MAID_WEIGHT_IN_GUILD_COLLECTION']
+	key_fields = ('guild', )
+	field_name = 'weights'
+	default = 1
+
+	def __init__(self, maids: Mapping[str, Maid], writer: CachedDocuments[int, GuildWeight], guild_id: int, data: Optional[Mapping[str, Any]]):
+		self._maids = maids
+		self._writer = writer
+		self.guild_id = guild_id
+		self.version = 0
+
+		if data is None:
+			weights = {}
+		else:
+			weights = dict(data.get(self.field_name, {}))
+
+		modified = False
+		for key in list(weights):
+			if (key != Weight.bot_key and key not in maids) or weights[key] == self.default:
+				modified = True
+				weights.pop(key)
+
+		self._weights: dict[str, int] = weights
+		if modified:
+			self._upload()
+
+	def get(self, key: str) -> int:
+		return self._weights.get(key, self.default)
+
+	def get_maid_weight(self, maid_name: str) -> int:
+		return self.get(maid_name)
+
+	def get_bot_weight(self) -> int:
+		return self.get(Weight.bot_key)
+
+	def _update(self, key: str, i: int):
+		if i < 0:
+			i = 0
+		if self.get(key) == i:
+			return
+
+		if i == self.default:
+			self._weights.pop(key, None)
+		else:
+			self._weights[key] = i
+		self.version += 1
+		self._upload()
+
+	def _upload(self):
+		if len(self._weights) > 0:
+			document = {self.field_name: dict(self._weights)}
+		else:
+			document = None
+		self._writer.mark(self.guild_id, document)
+
+	def set_maid_weight(self, maid_name: str, i: int):
+		self._update(maid_name, i)
+
+	def set_bot_weight(self, i: int):
+		self._update(Weight.bot_key, i)
+
+class WeightRegistry:
+	'''
+	Keep the Weight of each channel, keyed by channel id, in the "weights" namespace of State.
+	At most `capacity` channels are kept, and the least recently used one is evicted first.
+	If `idle` is positive, channels not used for `idle` seconds are also evicted.
+	Evicting a channel is safe even if its weights have not been written yet,
+	because the cache consults the write-behind layer before the db.
+	Guild defaults are few and shared by channels, so they are never evicted.
+	'''
+	def __init__(self, bot: Bot, capacity: int = config['MAID_WEIGHT_CACHE_SIZE'], idle: float = config['MAID_WEIGHT_CACHE_IDLE']):
+		self._maids = bot.maids
+		self._capacity = max(capacity, 1)
+		# Used when the caller has no random generator
+		self._random = random.Random()
+		# Every channel has weights (maybe all from its guild), so there is nothing to cache as missing
+		self._d: CachedDocuments[int, Weight] = CachedDocuments(
+			bot,
+			bot.storage.documents(Weight.col_name, Weight.key_fields),
+			bot.state.namespace('weights', capacity = self._capacity, idle = idle),
+			self._build_weight,
+			interval = config['MAID_WEIGHT_FLUSH_INTERVAL'],
+			batch_size = config['MAID_WEIGHT_FLUSH_BATCH']
+		)
+		# Guild defaults are never evicted
+		self._guilds: CachedDocuments[int, GuildWeight] = CachedDocuments(
+			bot,
+			bot.storage.documents(GuildWeight.col_name, GuildWeight.key_fields),
+			bot.state.namespace('guild_weights', capacity = 0),
+			self._build_guild,
+			interval = config['MAID_WEIGHT_FLUSH_INTERVAL'],
+			batch_size = config['MAID_WEIGHT_FLUSH_BATCH']
+		)
+		# The weights are persisted in the db as well, so an unclean snapshot may be outdated
+		bot.state.register_codec('weights', self._dump_weight, self._load_weight, clean_only = True)
+		bot.state.register_codec('guild_weights', self._dump_guild, self._load_guild, clean_only = True)
+		# The restored weights whose guilds are not in memory yet, by channel id
+		self._deferred: dict[int, dict] = {}
+
+	def __len__(self):
+		return len(self._d)
+
+	def __contains__(self, channel_id: int):
+		return channel_id in self._d
+
+	async def get(self, channel: discord.abc.GuildChannel) -> Weight:
+		w = self._d.peek(channel.id)
+		if w is None:
+			guild = await self.get_guild(channel.guild.id)
+			# Restored from the snapshot before its guild, see _load_weight()
+			raw = self._deferred.pop(channel.id, None)
+			if raw is not None and raw['guild'] == guild.guild_id and channel.id not in self._d:
+				self._d.set(channel.id, Weight(self._maids, self._d, channel.id, raw['channel_type'], guild, raw, self._random))
+			channel_type = channel.type.value
+			w = await self._d.get(channel.id, lambda channel_id, data: self._build_weight(channel_id, data, channel_type, guild))
+		assert w is not None
+		return w
+
+	async def get_guild(self, guild: discord.Guild | int) -> GuildWeight:
+		g = await self._guilds.get(guild if isinstance(guild, int) else guild.id)
+		assert g is not None
+		return g
+
+	def _build_weight(self, channel_id: int, data: Optional[Mapping[str, Any]], channel_type: Optional[int] = None, guild: Optional[GuildWeight] = None) -> Optional[Weight]:
+		# Without the channel, only a document with its type can be built
+		if data is not None:
+			channel_type = data.get('channel_type', channel_type)
+		if channel_type is None or guild is None:
+			return None
+		return Weight(self._maids, self._d, channel_id, channel_type, guild, data, self._random)
+
+	def _build_guild(self, guild_id: int, data: Optional[Mapping[str, Any]]) -> GuildWeight:
+		return GuildWeight(self._maids, self._guilds, guild_id, data)
+
+	@staticmethod
+	def _dump_weight(w: Weight):
+		return {'channel_type': w.channel_type, 'guild': w._guild.guild_id, Weight.field_name: dict(w._overrides)}
+
+	def _load_weight(self, channel_id: int, raw: dict) -> Optional[Weight]:
+		# The guild is usually restored as well. Codecs cannot await and run in the loop,
+		# so on a miss the raw entry waits in get() for the guild to be loaded.
+		guild = self._guilds.peek(raw['guild'])
+		if guild is None:
+			self._deferred[channel_id] = raw
+			return None
+		return Weight(self._maids, self._d, channel_id, raw['channel_type'], guild, raw, self._random)
+
+	@staticmethod
+	def _dump_guild(g: GuildWeight):
+		return {GuildWeight.field_name: dict(g._weights)}
+
+	def _load_guild(self, guild_id: int, raw: dict) -> GuildWeight:
+		return GuildWeight(self._maids, self._guilds, guild_id, raw)
+
+	def preload(self):
+		'''
+		Load the guild defaults and the channel weights with one cursor each.
+		At most `capacity` channels are loaded.
+		Old channel documents without the guild field are left to be loaded on use.
+		This is called when the cog is loaded, before the loop starts, so it blocks.
+		'''
+		for data in self._guilds.repo.all_sync():
+			guild_id = data['guild']
+			if guild_id not in self._guilds:
+				self._guilds.set(guild_id, self._build_guild(guild_id, data))
+
+		# Channels without a document follow their guilds, so nothing to load for them
+		for data in self._d.repo.all_sync(limit = self._capacity, has = ('guild', )):
+			channel_id = data['channel']
+			if channel_id in self._d:
+				continue
+			guild_id = data['guild']
+			guild = self._guilds.peek(guild_id)
+			if guild is None:
+				# Every guild document is loaded above, so the guild has none
+				guild = self._build_guild(guild_id, None)
+				self._guilds.set(guild_id, guild)
+			w = self._build_weight(channel_id, data, guild = guild)
+			if w is not None:
+				self._d.set(channel_id, w)
+
+__all__ = ['Weight', 'GuildWeight', 'WeightRegistry']
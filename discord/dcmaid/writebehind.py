@@ -0,0 +1,103 @@
+'''
+This module defines a write-behind layer of a repository.
+Mutations only mark documents dirty, and a background task writes
+the coalesced changes back in bulk.
+'''
+from __future__ import annotations
+import asyncio
+from asyncio import get_running_loop
+from collections.abc import Hashable
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from .storage import Document, DocumentRepository
+
+class WriteBehind:
+	def __init__(self, repo: DocumentRepository, interval: float = 5.0, batch_size: int = 100):
+		self.repo = repo
+		self.interval = interval
+		self.batch_size = batch_size
+		# key: document, and None means deletion
+		self._dirty: dict[Hashable, Optional[Document]] = {}
+		# The batch being written now
+		self._writing: dict[Hashable, Optional[Document]] = {}
+		self._flush_lock = asyncio.Lock()
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+		self._closed = False
+
+	def mark(self, key: Hashable, document: Optional[Document]):
+		'''
+		Mark the document of the key dirty. Only the latest document of the same key is written.
+		The document should not be mutated afterwards, so pass a copy.
+		'''
+		self._dirty[key] = document
+
+		try:
+			loop = get_running_loop()
+		except RuntimeError:
+			loop = None
+
+		if loop is None or self._closed:
+			# Nobody will flush for us, so write it now
+			batch, self._dirty = self._dirty, {}
+			self.repo.write_many_sync(batch)
+			return
+
+		if self._task is None or self._task.done():
+			self._task = loop.create_task(self._run())
+
+		if len(self._dirty) >= self.batch_size:
+			self._wakeup.set()
+
+	def is_dirty(self, key: Hashable) -> bool:
+		return key in self._dirty
+
+	def pending(self, key: Hashable) -> tuple[bool, Optional[Document]]:
+		# Whether the key has a document not written yet (None for deletion), which is newer than the db
+		if key in self._dirty:
+			return (True, self._dirty[key])
+		if key in self._writing:
+			return (True, self._writing[key])
+		return (False, None)
+
+	async def _run(self):
+		while not self._closed:
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), self.interval)
+			except TimeoutError:
+				pass
+			self._wakeup.clear()
+
+			try:
+				await self.flush()
+			except Exception:
+				# The failed documents are kept dirty and retried in the next round
+				pass
+
+	async def flush(self):
+		async with self._flush_lock:
+			if len(self._dirty) == 0:
+				return
+
+			batch, self._dirty = self._dirty, {}
+			self._writing = batch
+			try:
+				await self.repo.write_many(batch)
+			except:
+				# Put them back unless they are marked again during the write
+				for key, value in batch.items():
+					self._dirty.setdefault(key, value)
+				raise
+			finally:
+				self._writing = {}
+
+	async def close(self):
+		# Stop the flusher and write everything left
+		self._closed = True
+		if self._task is not None and not self._task.done():
+			self._wakeup.set()
+			await self._task
+		await self.flush()
+
+__all__ = ['WriteBehind']
@@ -12,14 +12,15 @@ class _Secret(TypedDict):
 	debug_server_id: list[int]
 	load_ext: list[str]
 
+# The Mongo ones are only needed with STORAGE_BACKEND=mongo
 secret: _Secret = { # type: ignore # python-decouple doesn't provide typing
 	"app_id": config('APP_ID', cast = int),
 	"app_client_secret": config('APP_CLIENT_SECRET'),
 	"bot_token": config('BOT_TOKEN'),
-	"mongo_address": config('MONGO_ADDRESS'),
-	"mongo_admin": config('MONGO_ADMIN'),
-	"mongo_pwd": config('MONGO_PWD'),
-	"mongo_db": config('MONGO_DB'),
+	"mongo_address": config('MONGO_ADDRESS', default = ''),
+	"mongo_admin": config('MONGO_ADMIN', default = ''),
+	"mongo_pwd": config('MONGO_PWD', default = ''),
+	"mongo_db": config('MONGO_DB', default = ''),
 	"debug_server_id": config('DEBUG_SERVER_ID', cast = Csv(int)),
 	"load_ext": config('LOAD_EXT', default = '', cast = Csv())
 }
@@ -0,0 +1,56 @@
+from __future__ import annotations
+import asyncio
+from time import time
+from types import SimpleNamespace
+from dcmaid.activity import ActivityTracker, ChannelActivity, warm_up_guild
+from dcmaid.state import State
+from dcmaid.storage.memory import MemoryStorage
+
+def tracker(repo) -> ActivityTracker:
+	activity = ActivityTracker(State(), repo, half_life = 86400)
+	activity.load_sync()
+	return activity
+
+def test_top_channels_are_persisted():
+	repo = MemoryStorage().documents('channel-activity', ('channel', ))
+	activity = tracker(repo)
+	now = time()
+	for channel_id, score in ((1, 5), (2, 3), (3, 1)):
+		activity._d.set(channel_id, ChannelActivity(100, score, now))
+	asyncio.run(activity.persist(2))
+	assert sorted(document['channel'] for document in repo.all_sync()) == [1, 2]
+
+	# Without the snapshot, the next run starts from the storage
+	activity = tracker(repo)
+	assert activity.top(10) == [1, 2]
+	assert activity.top(10, 200) == []
+
+	# A channel falling out of the top is deleted
+	activity._d.set(3, ChannelActivity(100, 10, now))
+	asyncio.run(activity.persist(2))
+	assert sorted(document['channel'] for document in repo.all_sync()) == [1, 3]
+
+def test_snapshot_wins_over_storage():
+	repo = MemoryStorage().documents('channel-activity', ('channel', ))
+	repo.write_many_sync({1: {'guild': 100, 'score': 1, 'updated_at': 0}})
+	state = State()
+	state.namespace('channel_activity').set(1, ChannelActivity(100, 7, 0))
+	activity = ActivityTracker(state, repo)
+	activity.load_sync()
+	assert activity._d.get(1).score == 7
+
+def test_guild_hooks_are_called():
+	called = []
+
+	class Cog:
+		async def warmup_guild(self, guild):
+			called.append(guild)
+
+	class Failing:
+		async def warmup_guild(self, guild):
+			raise RuntimeError('no permission')
+
+	guild = object()
+	bot = SimpleNamespace(cogs = {'a': Failing(), 'b': Cog(), 'c': object()})
+	asyncio.run(warm_up_guild(bot, guild))
+	assert called == [guild]
@@ -0,0 +1,124 @@
+from __future__ import annotations
+import asyncio
+import pytest
+from dcmaid.basebot import Bot
+from dcmaid.cache import CachedDocuments, cache_stats
+from dcmaid.state import State
+from dcmaid.storage.memory import MemoryStorage
+
+def build(key, document):
+	return None if document is None else document['x']
+
+@pytest.fixture
+def loop():
+	# The bot takes the current loop when it is created
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	yield loop
+	loop.close()
+	asyncio.set_event_loop(None)
+
+@pytest.fixture
+def bot(loop):
+	return Bot(MemoryStorage(), State())
+
+def counting(repo):
+	# The keys looked up in the db
+	calls = []
+	find_sync = repo.find_sync
+
+	def find(key):
+		calls.append(key)
+		return find_sync(key)
+
+	repo.find_sync = find
+	return calls
+
+def test_concurrent_misses_share_one_load(bot, loop):
+	repo = bot.storage.documents('values', ('key', ))
+	repo.write_many_sync({1: {'x': 'one'}})
+	calls = counting(repo)
+
+	async def main():
+		cache = CachedDocuments(bot, repo, bot.state.namespace('values'), build)
+		results = await asyncio.gather(*(cache.get(1) for _ in range(5)))
+		assert results == ['one'] * 5
+		assert calls == [1]
+		assert cache.peek(1) == 'one' and 1 in cache and len(cache) == 1
+
+		stats = cache.stats.to_dict()
+		assert stats['misses'] == 1 and stats['hits'] == 4
+
+	loop.run_until_complete(main())
+
+def test_negative_cache(bot, loop):
+	repo = bot.storage.documents('values', ('key', ))
+	calls = counting(repo)
+
+	async def main():
+		cache = CachedDocuments(bot, repo, bot.state.namespace('values'), build, negative_ttl = 60)
+		assert await cache.get(1) is None
+		assert await cache.get(1) is None
+		assert calls == [1]
+		assert cache.stats.negative_hits == 1
+
+		# Setting a value forgets the miss
+		cache.set(1, 'new')
+		assert await cache.get(1) == 'new'
+
+	loop.run_until_complete(main())
+
+def test_without_negative_cache_misses_go_to_db(bot, loop):
+	repo = bot.storage.documents('values', ('key', ))
+	calls = counting(repo)
+
+	async def main():
+		cache = CachedDocuments(bot, repo, bot.state.namespace('values'), build)
+		await cache.get(1)
+		await cache.get(1)
+		assert calls == [1, 1]
+
+	loop.run_until_complete(main())
+
+def test_evicted_value_comes_back_from_pending_writes(bot, loop):
+	repo = bot.storage.documents('values', ('key', ))
+	calls = counting(repo)
+
+	async def main():
+		cache = CachedDocuments(bot, repo, bot.state.namespace('values'), build, interval = 60)
+		cache.set(1, 'old')
+		cache.mark(1, {'x': 'new'})
+		cache.invalidate(1)
+		# Not written yet, so the db must not be asked
+		assert await cache.get(1) == 'new'
+		assert calls == []
+		await bot.get_write_behind(repo).close()
+		assert repo.find_sync(1) == {'x': 'new', 'key': 1}
+
+	loop.run_until_complete(main())
+
+def test_get_sync_and_custom_builder(bot):
+	repo = bot.storage.documents('values', ('key', ))
+	repo.write_many_sync({1: {'x': 'one'}})
+	cache = CachedDocuments(bot, repo, bot.state.namespace('values'), build)
+	assert cache.get_sync(1, lambda key, document: (key, document['x'])) == (1, 'one')
+	assert cache.get_sync(1) == (1, 'one')
+
+def test_write_through(bot, loop):
+	repo = bot.storage.documents('values', ('key', ))
+
+	async def main():
+		cache = CachedDocuments(bot, repo, bot.state.namespace('values'), build, write_behind = False)
+		with pytest.raises(RuntimeError):
+			cache.mark(1, {'x': 1})
+		await cache.put(1, {'x': 1})
+		assert repo.find_sync(1) == {'x': 1, 'key': 1}
+		await cache.put(1, None)
+		assert repo.find_sync(1) is None
+
+	loop.run_until_complete(main())
+
+def test_stats_are_listed(bot):
+	repo = bot.storage.documents('values', ('key', ))
+	CachedDocuments(bot, repo, bot.state.namespace('listed_values'), build)
+	assert 'listed_values' in dict(cache_stats())
@@ -0,0 +1,317 @@
+from __future__ import annotations
+import asyncio
+import os
+import pickle
+import pytest
+import struct
+import threading
+from uuid import uuid4
+from dcmaid.storage import journal
+from dcmaid.storage.journal import Journal, JournaledStorage
+from dcmaid.storage.memory import MemoryStorage
+from dcmaid.storage.sqlite import SQLiteStorage
+
+SEGMENT_SIZE = 4096
+
+def segments(directory) -> list[str]:
+	return sorted(name for name in os.listdir(directory) if name.endswith('.journal'))
+
+def open_storage(directory, inner = None, **kwargs) -> JournaledStorage:
+	return JournaledStorage(inner or MemoryStorage(), Journal(str(directory), segment_size = SEGMENT_SIZE), **kwargs)
+
+def crash_after(storage: JournaledStorage, writes):
+	# Journal the writes in a loop, and stop before they are replicated
+	async def main():
+		await writes(storage)
+		if storage._task is not None:
+			storage._task.cancel()
+
+	asyncio.run(main())
+	storage.journal.close()
+
+def test_recovered_records_are_journaled_again(tmp_path):
+	async def writes(storage):
+		repo = storage.documents('weights', ('channel', ))
+		await repo.write_many({1: {'x': 1}})
+		await repo.write_many({2: {'x': 2}, 1: None})
+		await storage.variables('vars').insert('user', 1, 'a', 'int', '1')
+
+	crash_after(open_storage(tmp_path, interval = 60), writes)
+	[old] = segments(tmp_path)
+
+	inner = MemoryStorage()
+	storage = open_storage(tmp_path, inner)
+	# The old segment is gone once its records are in the new one
+	assert old not in segments(tmp_path)
+	assert len(storage._queue) == 3
+	# Readable before they are replicated
+	repo = storage.documents('weights', ('channel', ))
+	assert repo.find_sync(2) == {'x': 2}
+	assert repo.find_sync(1) is None
+
+	storage.settle_sync()
+	assert inner.documents('weights', ('channel', )).find_sync(2) == {'x': 2, 'channel': 2}
+	assert len(inner.variables('vars').scopes_sync()) == 1
+	storage.close()
+
+def test_stale_records_never_come_back(tmp_path):
+	db = str(tmp_path / 'maidbot.db')
+	directory = tmp_path / 'journal'
+
+	async def writes(storage):
+		await storage.documents('weights', ('channel', )).write_many({1: {'x': 'stale'}})
+
+	crash_after(open_storage(directory, SQLiteStorage(db), interval = 60), writes)
+
+	# The next run replicates the records but never touches the repository
+	storage = open_storage(directory, SQLiteStorage(db))
+	storage.settle_sync()
+	storage.close()
+
+	# Updated later without the journal
+	inner = SQLiteStorage(db)
+	inner.documents('weights', ('channel', )).write_many_sync({1: {'x': 'new'}})
+	inner.close()
+
+	storage = open_storage(directory, SQLiteStorage(db))
+	assert storage.documents('weights', ('channel', )).find_sync(1) == {'x': 'new', 'channel': 1}
+	storage.close()
+
+def test_torn_record_ends_the_replay(tmp_path):
+	journal = Journal(str(tmp_path), segment_size = SEGMENT_SIZE)
+	record = ('variables', 'vars', (), 'delete', (1, 'a'))
+	for _ in range(3):
+		journal.append(record)
+	journal.close()
+
+	[name] = segments(tmp_path)
+	path = tmp_path / name
+	data = bytearray(path.read_bytes())
+	# Flip a byte of the payload of the last record
+	end = data.rstrip(b'\0')
+	data[len(end) - 1] ^= 0xff
+	path.write_bytes(bytes(data))
+
+	journal = Journal(str(tmp_path), segment_size = SEGMENT_SIZE)
+	assert [seq for seq, _ in journal.recovered] == [1, 2]
+	# New records follow the last one read
+	assert journal.append(record) == 3
+	journal.close()
+
+def test_checkpoint_removes_replicated_segments(tmp_path):
+	storage = open_storage(tmp_path)
+	repo = storage.documents('weights', ('channel', ))
+	# Every batch is larger than half a segment
+	padding = 'x' * (SEGMENT_SIZE // 2)
+	for i in range(4):
+		storage._append(repo, 'write_many', ([(i, {'padding': padding})], ))
+	assert len(segments(tmp_path)) > 2
+
+	storage.settle_sync()
+	# Only the active segment is left
+	assert len(segments(tmp_path)) == 1
+	storage.close()
+
+	# and everything in it is checkpointed
+	journal = Journal(str(tmp_path), segment_size = SEGMENT_SIZE)
+	assert journal.recovered == []
+	journal.close()
+
+def test_replay_is_idempotent(tmp_path):
+	u = uuid4()
+
+	async def writes(storage):
+		await storage.variables('vars').insert('user', 1, 'a', 'int', '1')
+		await storage.polls('polls').insert({'uuid': u, 'vote_casted': {}})
+		await storage.documents('weights', ('channel', )).write_many({1: {'x': 1}})
+
+	inner = MemoryStorage()
+	storage = open_storage(tmp_path, inner, interval = 60)
+	crash_after(storage, writes)
+	# Replicated, but crashed before the checkpoint reached the disk
+	storage._apply_calls(storage._coalesce(list(storage._queue)))
+
+	storage = open_storage(tmp_path, inner)
+	storage.settle_sync()
+	[(_, _, variables)] = inner.variables('vars').scopes_sync()
+	assert len(variables) == 1
+	assert len(inner.polls('polls').all_sync()) == 1
+	assert inner.documents('weights', ('channel', )).find_sync(1) == {'x': 1, 'channel': 1}
+	storage.close()
+
+def test_writes_are_coalesced(tmp_path):
+	inner = MemoryStorage()
+	calls = []
+	repo = inner.documents('weights', ('channel', ))
+	write_many_sync = repo.write_many_sync
+	repo.write_many_sync = lambda batch: (calls.append(dict(batch)), write_many_sync(batch))
+
+	async def main():
+		storage = open_storage(tmp_path, inner, interval = 60)
+		journaled = storage.documents('weights', ('channel', ))
+		await asyncio.gather(*(journaled.write_many({i % 2: {'x': i}}) for i in range(5)))
+		assert calls == []
+		await storage.flush()
+		storage.close()
+
+	asyncio.run(main())
+	assert calls == [{0: {'x': 4}, 1: {'x': 3}}]
+
+def test_poison_record_is_dead_lettered(tmp_path, capsys):
+	inner = MemoryStorage()
+	repo = inner.variables('vars')
+	update_sync = repo.update_sync
+
+	def update(scope_id, name, type, value):
+		if value == 'poison':
+			raise ValueError('rejected')
+		update_sync(scope_id, name, type, value)
+
+	repo.update_sync = update
+	storage = open_storage(tmp_path, inner, max_attempts = 2)
+	journaled = storage.variables('vars')
+	storage._append(journaled, 'insert', ('user', 1, 'a', 'int', '1'))
+	storage._append(journaled, 'update', (1, 'a', 'int', 'poison'))
+
+	async def main():
+		# Alone in the queue, so it could be an outage
+		for _ in range(3):
+			with pytest.raises(ValueError):
+				await storage.settle()
+		assert len(storage._queue) == 1
+
+		storage._append(journaled, 'update', (1, 'a', 'int', '2'))
+		await storage.settle()
+		assert len(storage._queue) == 0
+
+	asyncio.run(main())
+	[(_, _, [variable])] = inner.variables('vars').scopes_sync()
+	assert variable['value'] == '2'
+	assert 'Dead-lettered the journal record 2 of vars' in capsys.readouterr().out
+	storage.close()
+
+	data = (tmp_path / 'dead-letters').read_bytes()
+	length, _ = struct.unpack_from('<II', data)
+	seq, record, error = pickle.loads(data[8:8 + length])
+	assert seq == 2 and record == ('variables', 'vars', (), 'update', (1, 'a', 'int', 'poison'))
+	assert 'rejected' in error
+
+	# Not replayed again
+	journal = Journal(str(tmp_path), segment_size = SEGMENT_SIZE)
+	assert journal.recovered == []
+	journal.close()
+
+def test_outage_keeps_every_record(tmp_path):
+	inner = MemoryStorage()
+
+	def delete(scope_id, name):
+		raise ConnectionError('db is down')
+
+	inner.variables('vars').delete_sync = delete
+	storage = open_storage(tmp_path, inner, max_attempts = 1)
+	journaled = storage.variables('vars')
+	for i in range(3):
+		storage._append(journaled, 'delete', (i, 'a'))
+
+	async def main():
+		for _ in range(3):
+			with pytest.raises(ConnectionError):
+				await storage.settle()
+
+	asyncio.run(main())
+	assert len(storage._queue) == 3
+	assert not (tmp_path / 'dead-letters').exists()
+	storage.close()
+
+def test_commits_share_a_sync_off_the_loop(tmp_path):
+	journal = Journal(str(tmp_path), segment_size = SEGMENT_SIZE)
+	threads = []
+	sync = journal.sync
+
+	def recording_sync():
+		threads.append(threading.current_thread())
+		sync()
+
+	journal.sync = recording_sync
+	record = ('variables', 'vars', (), 'delete', (1, 'a'))
+
+	async def commit():
+		journal.append(record)
+		await journal.commit()
+
+	async def main():
+		await asyncio.gather(*(commit() for _ in range(5)))
+		# Arrived after the sync, so it waits for another one
+		await commit()
+
+	asyncio.run(main())
+	assert len(threads) == 2
+	assert threading.main_thread() not in threads
+	journal.close()
+
+	journal = Journal(str(tmp_path), segment_size = SEGMENT_SIZE)
+	assert len(journal.recovered) == 6
+	journal.close()
+
+def test_replicated_segments_are_removed_in_the_loop(tmp_path):
+	async def main():
+		storage = open_storage(tmp_path, interval = 60)
+		repo = storage.documents('weights', ('channel', ))
+		padding = 'x' * (SEGMENT_SIZE // 2)
+		for i in range(4):
+			await repo.write_many({i: {'padding': padding}})
+		assert len(segments(tmp_path)) > 2
+
+		await storage.settle()
+		# Removed by the sync after the checkpoint
+		for _ in range(100):
+			if len(segments(tmp_path)) == 1:
+				break
+			await asyncio.sleep(0.01)
+		assert len(segments(tmp_path)) == 1
+		await storage.flush()
+		storage.close()
+
+	asyncio.run(main())
+
+def test_directory_is_synced_for_created_and_removed_segments(tmp_path, monkeypatch):
+	synced = []
+	monkeypatch.setattr(journal, '_sync_directory', lambda path: synced.append(path))
+
+	async def writes(storage):
+		await storage.variables('vars').insert('user', 1, 'a', 'int', '1')
+
+	crash_after(open_storage(tmp_path, interval = 60), writes)
+	# Created before the record is acknowledged
+	assert synced == [str(tmp_path)]
+
+	synced.clear()
+	storage = open_storage(tmp_path)
+	# Once for the new segment and once for the old one removed
+	assert synced == [str(tmp_path)] * 2
+	storage.close()
+
+def test_failed_sync_still_replicates(tmp_path):
+	inner = MemoryStorage()
+	storage = open_storage(tmp_path, inner, interval = 60)
+	sync = storage.journal.sync
+
+	def failing_sync():
+		raise OSError('disk is full')
+
+	async def main():
+		repo = storage.documents('weights', ('channel', ))
+		storage.journal.sync = failing_sync
+		with pytest.raises(OSError):
+			await repo.write_many({1: {'x': 1}})
+		# Not undone, since it is in the segment already
+		assert repo.find_sync(1) == {'x': 1}
+		assert len(storage._queue) == 1
+
+		storage.journal.sync = sync
+		await repo.write_many({2: {'x': 2}})
+		await storage.flush()
+
+	asyncio.run(main())
+	assert inner.documents('weights', ('channel', )).find_sync(1) == {'x': 1, 'channel': 1}
+	storage.close()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import asyncio
+import os
+import pytest
+from uuid import uuid4
+from dcmaid.storage.mongo import MongoStorage
+
+@pytest.fixture
+def db():
+	# A real mongod with MAIDBOT_TEST_MONGO_URI, or mongomock in memory
+	uri = os.environ.get('MAIDBOT_TEST_MONGO_URI')
+	if uri:
+		from pymongo import MongoClient
+		client = MongoClient(uri, uuidRepresentation = 'standard')
+		name = f'maidbot_test_{uuid4().hex}'
+		yield client[name]
+		client.drop_database(name)
+		client.close()
+	else:
+		mongomock = pytest.importorskip('mongomock')
+		yield mongomock.MongoClient()['maidbot_test']
+
+@pytest.fixture
+def storage(db):
+	return MongoStorage(db)
+
+def test_legacy_rows_are_merged_when_found(storage, db):
+	repo = storage.installations('installed')
+	db['installed'].insert_many([
+		{'channel_id': 1, 'name': 'alice', 'hook_id': 10},
+		{'channel_id': 1, 'name': 'bob', 'hook_id': 11, 'digest': 'b'},
+		# Saved once by a version before the guild id was recorded
+		{'channel_id': 1, 'hooks': {'carol': {'hook_id': 12, 'digest': 'c', 'pool': []}}},
+	])
+
+	hooks, legacy = repo.find_channel_sync(1)
+	assert legacy
+	assert hooks == {
+		'alice': {'hook_id': 10, 'digest': None},
+		'bob': {'hook_id': 11, 'digest': 'b'},
+		'carol': {'hook_id': 12, 'digest': 'c', 'pool': []},
+	}
+
+	# Saving the merged hooks drops the legacy rows
+	repo.save_sync(1, 100, hooks, legacy)
+	assert db['installed'].count_documents({'channel_id': 1}) == 1
+	assert repo.find_channel_sync(1) == (hooks, False)
+	assert repo.find_guild_sync(100) == {1: (hooks, False)}
+
+def test_document_hooks_win_over_legacy_rows(storage, db):
+	repo = storage.installations('installed')
+	db['installed'].insert_many([
+		{'channel_id': 1, 'hooks': {'alice': {'hook_id': 20, 'digest': 'new', 'pool': []}}, 'guild_id': 100},
+		{'channel_id': 1, 'name': 'alice', 'hook_id': 10},
+	])
+	hooks, legacy = repo.find_channel_sync(1)
+	assert legacy and hooks['alice']['hook_id'] == 20
+
+def test_migrate(storage, db):
+	repo = storage.installations('installed')
+	db['installed'].insert_many([
+		{'channel_id': 1, 'name': 'alice', 'hook_id': 10},
+		{'channel_id': 1, 'name': 'bob', 'hook_id': 11},
+		{'channel_id': 2, 'name': 'alice', 'hook_id': 20},
+		{'channel_id': 2, 'hooks': {'alice': {'hook_id': 21, 'digest': 'x', 'pool': []}}},
+	])
+	repo.migrate_sync()
+
+	assert db['installed'].count_documents({'hooks': {'$exists': False}}) == 0
+	assert db['installed'].count_documents({}) == 2
+	assert repo.find_channel_sync(1) == ({'alice': {'hook_id': 10, 'digest': None}, 'bob': {'hook_id': 11, 'digest': None}}, True)
+	# The newer document wins
+	assert repo.find_channel_sync(2)[0] == {'alice': {'hook_id': 21, 'digest': 'x', 'pool': []}}
+
+	# Nothing left to migrate
+	repo.migrate_sync()
+	assert db['installed'].count_documents({}) == 2
+
+def test_delete_removes_legacy_rows(storage, db):
+	repo = storage.installations('installed')
+	repo.save_sync(1, 100, {'alice': {'hook_id': 1}}, False)
+	db['installed'].insert_one({'channel_id': 1, 'name': 'bob', 'hook_id': 2})
+	repo.delete_sync(1)
+	assert db['installed'].count_documents({}) == 0
+
+def test_write_many_upserts(storage, db):
+	repo = storage.documents('weights', ('channel', ))
+	repo.write_many_sync({1: {'weights': {'alice': 1}}, 2: {'weights': {}}})
+	repo.write_many_sync({1: {'weights': {'alice': 2}}, 2: None, 3: {'weights': {}}})
+
+	assert db['weights'].count_documents({}) == 2
+	found = repo.find_sync(1)
+	assert found is not None
+	found.pop('_id')
+	# Replaced as a whole, with the key fields
+	assert found == {'weights': {'alice': 2}, 'channel': 1}
+	assert repo.find_sync(2) is None
+	assert len(repo.all_sync(limit = 1)) == 1
+
+	# An empty batch makes no request
+	repo.write_many_sync({})
+
+def test_write_many_by_compound_key(storage):
+	repo = storage.documents('pairs', ('a', 'b'))
+	repo.write_many_sync({(1, 2): {'x': 1}, (1, 3): {'x': 2}})
+	repo.write_many_sync({(1, 2): {'x': 3}})
+	found = repo.find_sync((1, 2))
+	assert found is not None and found['x'] == 3
+	assert len(repo.all_sync()) == 2
+
+def test_set_votes(storage):
+	repo = storage.polls('polls')
+	# mongomock cannot encode UUIDs, and any value does as the key
+	u = str(uuid4())
+	repo.insert_sync({'uuid': u, 'title': 'lunch', 'vote_casted': {}})
+	repo.set_votes_sync([(u, 7, 'rice', 1), (u, 7, 'noodle', 0), (u, 8, 'rice', 2)])
+	repo.set_votes_sync([(u, 7, 'rice', 3)])
+
+	[poll] = repo.all_sync()
+	# Only the votes given are set
+	assert poll['vote_casted'] == {'7': {'rice': 3, 'noodle': 0}, '8': {'rice': 2}}
+	repo.delete_sync(u)
+	assert repo.all_sync() == []
+
+def test_variables(storage):
+	repo = storage.variables('vars')
+	repo.insert_sync('user', 1, 'a', 'int', '1')
+	repo.insert_sync('user', 1, 'b', 'int', '2')
+	repo.insert_sync('guild', 2, 'a', 'str', 'x')
+	repo.update_sync(1, 'a', 'int', '3')
+	repo.delete_sync(1, 'b')
+
+	scopes = {(scope_type, scope_id): variables for scope_type, scope_id, variables in repo.scopes_sync()}
+	assert scopes == {
+		('user', 1): [{'name': 'a', 'type': 'int', 'value': '3'}],
+		('guild', 2): [{'name': 'a', 'type': 'str', 'value': 'x'}],
+	}
+	repo.delete_scope_sync('user', 1)
+	assert [scope_id for _, scope_id, _ in repo.scopes_sync()] == [2]
+
+def test_calls_run_in_the_executor(storage):
+	repo = storage.documents('weights', ('channel', ))
+	assert repo.blocking
+
+	async def main():
+		await repo.write_many({1: {'x': 1}})
+		found = await repo.find(1)
+		assert found is not None and found['x'] == 1
+
+	asyncio.run(main())
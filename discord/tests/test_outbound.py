@@ -0,0 +1,53 @@
+from __future__ import annotations
+import asyncio
+import pytest
+from types import SimpleNamespace
+from dcmaid.outbound import config as outbound_config, scheduler
+from dcmaid.utils import send_as
+
+class Webhook:
+	def __init__(self, id: int):
+		self.id = id
+		self.sent: list[str] = []
+
+	async def send(self, content):
+		self.sent.append(content)
+
+@pytest.fixture(autouse = True)
+def enabled(monkeypatch):
+	monkeypatch.setattr(scheduler, 'enabled', True)
+	monkeypatch.setitem(outbound_config, 'OUTBOUND_COALESCE_WINDOW', 0.01)
+
+def invocation(channel_id: int):
+	# Each command has its own context
+	return SimpleNamespace(channel = SimpleNamespace(id = channel_id))
+
+def test_replies_of_several_players_are_merged():
+	webhook = Webhook(1)
+
+	async def main():
+		coalesced = scheduler.coalesced
+		await asyncio.gather(
+			send_as(invocation(10), webhook, '<@1>\n3', coalesce = True),
+			send_as(invocation(10), webhook, '<@2>\n5', coalesce = True),
+		)
+		assert scheduler.coalesced == coalesced + 1
+
+	asyncio.run(main())
+	assert webhook.sent == ['<@1>\n3\n<@2>\n5']
+
+def test_other_channels_and_speakers_are_not_merged():
+	alice, bob = Webhook(1), Webhook(2)
+
+	async def main():
+		await asyncio.gather(
+			send_as(invocation(10), alice, 'a', coalesce = True),
+			# The same webhook posting into a thread
+			send_as(invocation(11), alice, 'b', coalesce = True),
+			send_as(invocation(10), bob, 'c', coalesce = True),
+			send_as(invocation(10), alice, 'd'),
+		)
+
+	asyncio.run(main())
+	assert sorted(alice.sent) == ['a', 'b', 'd']
+	assert bob.sent == ['c']
@@ -0,0 +1,91 @@
+from __future__ import annotations
+import asyncio
+from dcmaid.response import acknowledge, deliver, RequestStats
+import dcmaid.response as response
+
+class Response:
+	def __init__(self, interaction: Interaction):
+		self.interaction = interaction
+		self.done = False
+
+	def is_done(self) -> bool:
+		return self.done
+
+	async def send_message(self, content, ephemeral = False):
+		self.interaction.requests.append(('respond', content, ephemeral))
+		self.done = True
+
+	async def defer(self):
+		self.interaction.requests.append(('defer', ))
+		self.done = True
+
+class Interaction:
+	# Records the requests made through it
+	def __init__(self):
+		self.requests: list[tuple] = []
+		self.response = Response(self)
+		self.channel = None
+
+	async def delete_original_response(self):
+		self.requests.append(('delete', ))
+
+class Webhook:
+	id = 1
+
+	def __init__(self, interaction: Interaction):
+		self.interaction = interaction
+
+	async def send(self, content):
+		self.interaction.requests.append(('webhook', content))
+
+def run(monkeypatch, f) -> RequestStats:
+	stats = RequestStats()
+	monkeypatch.setattr(response, 'request_stats', stats)
+	asyncio.run(f())
+	return stats
+
+def test_deliver_makes_two_requests(monkeypatch):
+	interaction = Interaction()
+
+	async def main():
+		await deliver(interaction, Webhook(interaction), 'rolled 3', ack = 'Sent.')
+		# Later messages of the same invocation are just sent
+		await deliver(interaction, Webhook(interaction), 'rolled 5')
+
+	stats = run(monkeypatch, main)
+	assert sorted(interaction.requests) == [('respond', 'Sent.', True), ('webhook', 'rolled 3'), ('webhook', 'rolled 5')]
+	# 2 for the first message, which used to cost 3 (defer, delete and send), and 1 for the second
+	assert stats.top(1) == [('interaction', 1, 3)]
+
+def test_acknowledge_before_a_game(monkeypatch):
+	interaction = Interaction()
+
+	async def main():
+		await acknowledge(interaction, 'Sent.')
+		await acknowledge(interaction, 'Sent.')
+		await deliver(interaction, Webhook(interaction), 'result')
+
+	stats = run(monkeypatch, main)
+	assert interaction.requests == [('respond', 'Sent.', True), ('webhook', 'result')]
+	assert stats.top(1) == [('interaction', 1, 2)]
+
+def test_deferred_interaction_is_deleted(monkeypatch):
+	interaction = Interaction()
+
+	async def main():
+		await interaction.response.defer()
+		interaction.requests.clear()
+		await deliver(interaction, Webhook(interaction), 'result')
+
+	run(monkeypatch, main)
+	assert sorted(interaction.requests) == [('delete', ), ('webhook', 'result')]
+
+def test_direct_response(monkeypatch):
+	interaction = Interaction()
+
+	async def main():
+		await deliver(interaction, None, 'hello', direct = True)
+
+	stats = run(monkeypatch, main)
+	assert interaction.requests == [('respond', 'hello', False)]
+	assert stats.top(1) == [('interaction', 1, 1)]
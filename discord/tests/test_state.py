@@ -0,0 +1,46 @@
+from __future__ import annotations
+import asyncio
+from dcmaid.state import Namespace
+
+def test_lock_is_kept_for_a_woken_waiter():
+	ns: Namespace[int, int] = Namespace('values', capacity = 1)
+
+	async def main():
+		holders = 0
+		most = 0
+
+		async def hold():
+			nonlocal holders, most
+			async with ns.lock(1):
+				holders += 1
+				most = max(most, holders)
+				await asyncio.sleep(0)
+				holders -= 1
+
+		lock = ns.lock(1)
+		await lock.acquire()
+		waiter = asyncio.create_task(hold())
+		await asyncio.sleep(0)
+		ns.set(1, 1)
+		lock.release()
+		# Evicted after the release, before the waiter runs again
+		ns.set(2, 2)
+		assert ns.lock(1) is lock
+
+		await asyncio.gather(waiter, hold())
+		assert most == 1
+
+	asyncio.run(main())
+
+def test_idle_locks_are_dropped():
+	ns: Namespace[int, int] = Namespace('values', capacity = 1)
+
+	async def main():
+		async with ns.lock(1):
+			pass
+		ns.lock(2)
+		# Over the capacity, so the idle lock of a missing key goes
+		ns.lock(3)
+		assert 1 not in ns._locks
+
+	asyncio.run(main())
@@ -0,0 +1,182 @@
+from __future__ import annotations
+import asyncio
+import json
+import pytest
+import time
+from dcmaid.state import config as state_config, LeaseLost, State
+from dcmaid.statebackend import MemoryBackend, SQLiteBackend, create_backend
+
+@pytest.fixture(params = ['memory', 'sqlite'])
+def backend(request, tmp_path):
+	if request.param == 'memory':
+		b = MemoryBackend()
+	else:
+		b = SQLiteBackend(str(tmp_path / 'state.db'))
+	yield b
+	b.close()
+
+@pytest.fixture(autouse = True)
+def fast_poll(monkeypatch):
+	monkeypatch.setitem(state_config, 'STATE_LEASE_POLL', 0.01)
+
+def test_get_set(backend):
+	assert backend.get('ns', 'a') is None
+	backend.set('ns', 'a', '1')
+	backend.set('other', 'a', '2')
+	assert backend.get('ns', 'a') == '1'
+	assert backend.get('other', 'a') == '2'
+	backend.delete('ns', 'a')
+	assert backend.get('ns', 'a') is None
+
+def test_compare_and_set(backend):
+	assert backend.compare_and_set('ns', 'a', None, '1')
+	# Not absent any more
+	assert not backend.compare_and_set('ns', 'a', None, '2')
+	assert not backend.compare_and_set('ns', 'a', '0', '2')
+	assert backend.compare_and_set('ns', 'a', '1', '2')
+	assert backend.get('ns', 'a') == '2'
+	# None deletes
+	assert backend.compare_and_set('ns', 'a', '2', None)
+	assert backend.get('ns', 'a') is None
+
+def test_expiry_and_purge(backend):
+	backend.set('ns', 'short', '1', ttl = 0.05)
+	backend.set('ns', 'forever', '2')
+	assert backend.get('ns', 'short') == '1'
+	time.sleep(0.1)
+	assert backend.get('ns', 'short') is None
+	# An expired key counts as absent
+	assert backend.compare_and_set('ns', 'short', None, '3', ttl = 0.05)
+	time.sleep(0.1)
+
+	backend.purge()
+	if isinstance(backend, SQLiteBackend):
+		rows = backend._conn().execute('SELECT key FROM state').fetchall()
+		assert rows == [('forever', )]
+	else:
+		assert list(backend._d) == [('ns', 'forever')]
+
+def test_create_backend(tmp_path):
+	assert isinstance(create_backend(''), MemoryBackend)
+	backend = create_backend(f'sqlite:{tmp_path / "state.db"}')
+	assert isinstance(backend, SQLiteBackend) and backend.shared
+	backend.close()
+	with pytest.raises(ValueError):
+		create_backend('redis://localhost')
+
+def test_sqlite_file_is_private(tmp_path):
+	path = tmp_path / 'state.db'
+	SQLiteBackend(str(path)).close()
+	assert path.stat().st_mode & 0o777 == 0o600
+
+def two_states(tmp_path) -> tuple[State, State]:
+	path = str(tmp_path / 'state.db')
+	return State(SQLiteBackend(path)), State(SQLiteBackend(path))
+
+def test_lease_is_exclusive_across_states(tmp_path):
+	states = two_states(tmp_path)
+	holders = 0
+	most = 0
+
+	async def hold(state: State):
+		nonlocal holders, most
+		async with state.lease('installed_hooks', 1):
+			holders += 1
+			most = max(most, holders)
+			await asyncio.sleep(0.05)
+			holders -= 1
+
+	async def main():
+		await asyncio.gather(*(hold(state) for state in states * 3))
+
+	asyncio.run(main())
+	assert most == 1
+	for state in states:
+		state.close()
+
+def test_expired_lease_is_taken_over(tmp_path):
+	crashed, state = two_states(tmp_path)
+	# Held by a process that crashed without releasing it
+	crashed.backend.compare_and_set('__lease__', json.dumps(['installed_hooks', 1]), None, 'crashed', 0.2)
+
+	async def main():
+		started = time.monotonic()
+		async with state.lease('installed_hooks', 1):
+			assert time.monotonic() - started >= 0.15
+
+	asyncio.run(main())
+	crashed.close()
+	state.close()
+
+def test_lease_is_extended_while_held(tmp_path):
+	holder, other = two_states(tmp_path)
+
+	async def main():
+		async def hold():
+			async with holder.lease('installed_hooks', 1, ttl = 0.3):
+				await asyncio.sleep(0.8)
+
+		task = asyncio.create_task(hold())
+		await asyncio.sleep(0.05)
+		# Far longer than the ttl, but the holder keeps it
+		with pytest.raises(TimeoutError):
+			async with other.lease('installed_hooks', 1, wait = 0.6):
+				pass
+		await task
+
+	asyncio.run(main())
+	holder.close()
+	other.close()
+
+def test_lost_lease_aborts_the_body(tmp_path):
+	holder, other = two_states(tmp_path)
+	lease_key = json.dumps(['installed_hooks', 1])
+	finished = False
+
+	async def main():
+		nonlocal finished
+		with pytest.raises(LeaseLost):
+			async with holder.lease('installed_hooks', 1, ttl = 0.3) as lease:
+				# Taken by someone else behind our back, e.g. after a long pause
+				other.backend.set('__lease__', lease_key, 'other', 10)
+				await asyncio.sleep(1)
+				finished = True
+		assert lease.lost
+
+	asyncio.run(main())
+	assert not finished
+	# Not released, since it is not ours
+	assert other.backend.get('__lease__', lease_key) == 'other'
+	holder.close()
+	other.close()
+
+def test_lease_without_shared_backend():
+	state = State(MemoryBackend())
+
+	async def main():
+		async with state.lease('installed_hooks', 1) as first:
+			async with state.lease('installed_hooks', 1) as second:
+				assert not first.lost and not second.lost
+
+	asyncio.run(main())
+
+def test_snapshot_round_trip(tmp_path):
+	path = str(tmp_path / 'snapshot.json')
+	state = State(MemoryBackend())
+	state.register_codec('values', lambda value: value, lambda key, raw: raw)
+	state.namespace('values').set(1, {'x': 1})
+	state.namespace('later').set(2, 'no codec')
+	state.save(path, clean = True)
+
+	restored = State(MemoryBackend())
+	restored.restore(path)
+	assert restored.snapshot_clean
+	# Decoded when the codec comes
+	restored.register_codec('values', lambda value: value, lambda key, raw: raw)
+	assert restored.namespace('values').get(1) == {'x': 1}
+	assert restored.namespace('later').get(2) is None
+
+	# Only clean for the start that restored it
+	again = State(MemoryBackend())
+	again.restore(path)
+	assert not again.snapshot_clean
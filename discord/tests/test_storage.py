@@ -0,0 +1,148 @@
+from __future__ import annotations
+import asyncio
+import pytest
+from datetime import datetime, timezone
+from uuid import uuid4
+from dcmaid.storage import config as storage_config, Storage, create_storage
+from dcmaid.storage.memory import MemoryStorage
+from dcmaid.storage.sqlite import SQLiteStorage
+
+MAIDS = [
+	{'name': 'alice', 'display_name': 'Alice', 'avatar': 'a.png'},
+	{'name': 'bob', 'display_name': 'Bob', 'avatar': 'b.png'},
+]
+
+@pytest.fixture(params = ['memory', 'sqlite'])
+def storage(request, tmp_path):
+	if request.param == 'memory':
+		s: Storage = MemoryStorage(MAIDS)
+	else:
+		s = SQLiteStorage(str(tmp_path / 'maidbot.db'), MAIDS)
+	yield s
+	s.close()
+
+def test_maids_in_order(storage):
+	assert storage.maids('maid-list').all_sync() == MAIDS
+
+def test_sqlite_maids_are_seeded_once(tmp_path):
+	path = str(tmp_path / 'maidbot.db')
+	first = SQLiteStorage(path, MAIDS)
+	first.maids('maid-list')
+	first.close()
+	storage = SQLiteStorage(path, [{'name': 'carol', 'display_name': 'Carol', 'avatar': ''}])
+	assert storage.maids('maid-list').all_sync() == MAIDS
+	storage.close()
+
+def test_same_name_same_repository(storage):
+	repo = storage.documents('weights', ('channel', ))
+	assert storage.documents('weights', ('channel', )) is repo
+	with pytest.raises(TypeError):
+		storage.polls('weights')
+
+def test_installations(storage):
+	repo = storage.installations('installed')
+	hooks = {'alice': {'hook_id': 1, 'digest': 'x', 'pool': [2, 3]}}
+	assert repo.find_channel_sync(10) == ({}, False)
+
+	repo.save_sync(10, 100, hooks, False)
+	repo.save_sync(11, 100, {}, False)
+	repo.save_sync(20, 200, {}, False)
+	assert repo.find_channel_sync(10) == (hooks, False)
+	assert set(repo.find_guild_sync(100)) == {10, 11}
+
+	repo.delete_sync(10)
+	assert repo.find_channel_sync(10) == ({}, False)
+	assert set(repo.find_guild_sync(100)) == {11}
+
+def test_documents(storage):
+	repo = storage.documents('weights', ('channel', ))
+	assert repo.find_sync(1) is None
+
+	repo.write_many_sync({1: {'weights': {'alice': 2}}, 2: {'weights': {}, 'extra': True}})
+	# The key fields are put into the documents
+	assert repo.find_sync(1) == {'weights': {'alice': 2}, 'channel': 1}
+	assert len(repo.all_sync()) == 2
+	assert len(repo.all_sync(limit = 1)) == 1
+	assert repo.all_sync(has = ('extra', )) == [{'weights': {}, 'extra': True, 'channel': 2}]
+
+	# None deletes
+	repo.write_many_sync({1: None, 2: {'weights': {'bob': 1}}})
+	assert repo.find_sync(1) is None
+	assert repo.find_sync(2) == {'weights': {'bob': 1}, 'channel': 2}
+
+def test_documents_by_compound_key(storage):
+	repo = storage.documents('pairs', ('a', 'b'))
+	repo.write_many_sync({(1, 2): {'x': 1}, (1, 3): {'x': 2}})
+	assert repo.find_sync((1, 2)) == {'x': 1, 'a': 1, 'b': 2}
+	assert repo.find_sync((2, 1)) is None
+
+def test_documents_are_copied(storage):
+	repo = storage.documents('weights', ('channel', ))
+	document = {'weights': {'alice': 1}}
+	repo.write_many_sync({1: document})
+	document['weights']['alice'] = 5
+	found = repo.find_sync(1)
+	assert found is not None and found['weights']['alice'] == 1
+	found['weights']['alice'] = 7
+	assert repo.find_sync(1)['weights']['alice'] == 1
+
+def test_variables(storage):
+	repo = storage.variables('vars')
+	repo.insert_sync('user', 1, 'a', 'int', '1')
+	repo.insert_sync('user', 1, 'b', 'int', '2')
+	repo.insert_sync('guild', 2, 'a', 'str', 'x')
+	repo.update_sync(1, 'a', 'int', '3')
+	repo.delete_sync(1, 'b')
+
+	scopes = {(scope_type, scope_id): variables for scope_type, scope_id, variables in repo.scopes_sync()}
+	assert scopes[('user', 1)] == [{'name': 'a', 'type': 'int', 'value': '3'}]
+	assert scopes[('guild', 2)] == [{'name': 'a', 'type': 'str', 'value': 'x'}]
+
+	# The type must match as well
+	repo.delete_scope_sync('user', 2)
+	assert len(repo.scopes_sync()) == 2
+	repo.delete_scope_sync('guild', 2)
+	assert [scope_id for _, scope_id, _ in repo.scopes_sync()] == [1]
+
+def test_polls(storage):
+	repo = storage.polls('polls')
+	u = uuid4()
+	until = datetime(2030, 1, 1, tzinfo = timezone.utc)
+	repo.insert_sync({'uuid': u, 'until': until, 'title': 'lunch', 'vote_casted': {}})
+	repo.set_votes_sync([(u, 7, 'rice', 1), (u, 7, 'noodle', 0), (u, 8, 'rice', 2)])
+
+	[poll] = repo.all_sync()
+	# UUIDs and datetimes survive the round trip
+	assert poll['uuid'] == u and poll['until'] == until
+	# JSON keys are strings in SQLite
+	votes = {str(member_id): options for member_id, options in poll['vote_casted'].items()}
+	assert votes == {'7': {'rice': 1, 'noodle': 0}, '8': {'rice': 2}}
+
+	repo.delete_sync(u)
+	assert repo.all_sync() == []
+
+def test_async_wrappers(storage):
+	async def main():
+		documents = storage.documents('weights', ('channel', ))
+		await documents.write_many({1: {'x': 1}})
+		assert await documents.find(1) == {'x': 1, 'channel': 1}
+
+		polls = storage.polls('polls')
+		u = uuid4()
+		await polls.insert({'uuid': u, 'vote_casted': {}})
+		# An empty list does nothing
+		await polls.set_votes([])
+		assert len(await polls.all()) == 1
+
+	asyncio.run(main())
+
+def test_create_storage(tmp_path, monkeypatch):
+	monkeypatch.setitem(storage_config, 'STORAGE_SQLITE_PATH', str(tmp_path / 'maidbot.db'))
+	assert isinstance(create_storage(backend = 'memory'), MemoryStorage)
+	storage = create_storage(backend = 'sqlite')
+	assert isinstance(storage, SQLiteStorage)
+	storage.close()
+	with pytest.raises(ValueError):
+		create_storage(backend = 'mongo')
+	with pytest.raises(ValueError):
+		create_storage(backend = 'unknown')
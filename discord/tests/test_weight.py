@@ -0,0 +1,64 @@
+from __future__ import annotations
+import asyncio
+import pytest
+from types import SimpleNamespace
+from dcmaid.basebot import Bot
+from dcmaid.state import State
+from dcmaid.storage.memory import MemoryStorage
+from dcmaid.weight import GuildWeight, Weight, WeightRegistry
+
+@pytest.fixture
+def loop():
+	# The bot takes the current loop when it is created
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	yield loop
+	loop.close()
+	asyncio.set_event_loop(None)
+
+@pytest.fixture
+def bot(loop):
+	return Bot(MemoryStorage(), State())
+
+def channel(channel_id: int, guild_id: int):
+	return SimpleNamespace(id = channel_id, guild = SimpleNamespace(id = guild_id), type = SimpleNamespace(value = 0))
+
+def test_restored_weight_waits_for_its_guild(bot, loop):
+	guilds = bot.storage.documents(GuildWeight.col_name, GuildWeight.key_fields)
+	guilds.write_many_sync({100: {'weights': {Weight.bot_key: 3}}})
+	calls = []
+	find_sync = guilds.find_sync
+	guilds.find_sync = lambda key: (calls.append(key), find_sync(key))[1]
+
+	registry = WeightRegistry(bot)
+	registry._d.values.restore_entries([[1, {'channel_type': 0, 'guild': 100, 'weights': {Weight.bot_key: 5}}]])
+	# Rehydrated in the loop, so the db is never asked there
+	assert registry._d.peek(1) is None
+	assert calls == []
+
+	async def main():
+		w = await registry.get(channel(1, 100))
+		assert w.get_bot_weight() == 5
+		assert w._guild.get_bot_weight() == 3
+		assert (await registry.get(channel(1, 100))) is w
+
+	loop.run_until_complete(main())
+	# Loaded once, off the loop
+	assert calls == [100]
+
+def test_restored_weight_with_its_guild(bot):
+	registry = WeightRegistry(bot)
+	registry._guilds.values.restore_entries([[100, {'weights': {}}]])
+	registry._d.values.restore_entries([[1, {'channel_type': 0, 'guild': 100, 'weights': {Weight.bot_key: 5}}]])
+	w = registry._d.peek(1)
+	assert w is not None and w.get_bot_weight() == 5
+
+def test_preload_without_guild_document(bot):
+	bot.storage.documents(Weight.col_name, Weight.key_fields).write_many_sync({
+		1: {'channel_type': 0, 'guild': 100, 'weights': {Weight.bot_key: 5}},
+	})
+	registry = WeightRegistry(bot)
+	registry.preload()
+	w = registry._d.peek(1)
+	assert w is not None and w.get_bot_weight() == 5
+	assert w._guild.get_bot_weight() == GuildWeight.default
@@ -0,0 +1,81 @@
+from __future__ import annotations
+import asyncio
+import pytest
+from collections.abc import Hashable, Mapping
+from typing import Optional
+from dcmaid.storage import Document
+from dcmaid.storage.memory import MemoryDocumentRepository
+from dcmaid.writebehind import WriteBehind
+
+class RecordingRepository(MemoryDocumentRepository):
+	def __init__(self):
+		super().__init__('weights', ('channel', ))
+		self.batches: list[dict[Hashable, Optional[Document]]] = []
+		self.fail = False
+
+	def write_many_sync(self, batch: Mapping[Hashable, Optional[Document]]):
+		if self.fail:
+			raise ConnectionError('db is down')
+		self.batches.append(dict(batch))
+		super().write_many_sync(batch)
+
+def test_without_loop_writes_at_once():
+	repo = RecordingRepository()
+	writer = WriteBehind(repo)
+	writer.mark(1, {'x': 1})
+	assert repo.batches == [{1: {'x': 1}}]
+	assert writer.pending(1) == (False, None)
+
+def test_marks_are_coalesced():
+	repo = RecordingRepository()
+
+	async def main():
+		writer = WriteBehind(repo, interval = 60)
+		writer.mark(1, {'x': 1})
+		writer.mark(1, {'x': 2})
+		writer.mark(2, None)
+		assert writer.is_dirty(1)
+		assert writer.pending(1) == (True, {'x': 2})
+		# A pending deletion is found as well
+		assert writer.pending(2) == (True, None)
+		assert repo.batches == []
+
+		await writer.close()
+		assert repo.batches == [{1: {'x': 2}, 2: None}]
+		assert repo.find_sync(1) == {'x': 2, 'channel': 1}
+
+	asyncio.run(main())
+
+def test_full_batch_flushes_early():
+	repo = RecordingRepository()
+
+	async def main():
+		writer = WriteBehind(repo, interval = 60, batch_size = 3)
+		for i in range(3):
+			writer.mark(i, {'x': i})
+		for _ in range(10):
+			await asyncio.sleep(0)
+		assert repo.batches == [{0: {'x': 0}, 1: {'x': 1}, 2: {'x': 2}}]
+		await writer.close()
+
+	asyncio.run(main())
+
+def test_failed_flush_keeps_documents_dirty():
+	repo = RecordingRepository()
+
+	async def main():
+		writer = WriteBehind(repo, interval = 60)
+		writer.mark(1, {'x': 1})
+		writer.mark(2, {'x': 2})
+		repo.fail = True
+		with pytest.raises(ConnectionError):
+			await writer.flush()
+		assert writer.pending(1) == (True, {'x': 1})
+
+		# Marked again after the failure: the newer one wins
+		writer.mark(2, {'x': 3})
+		repo.fail = False
+		await writer.close()
+		assert repo.batches == [{2: {'x': 3}, 1: {'x': 1}}]
+
+	asyncio.run(main())